@@ -1,9 +1,38 @@
+"""Open-loop load generator for the DotLLM server.
+
+Requests arrive at a fixed average rate, following a Poisson process or at
+constant intervals, whether or not the previous requests are finished, like
+traffic from independent clients. Every response is streamed so the
+time-to-first-token (TTFT) and inter-token latency (ITL) can be recorded.
+
+The traffic mixes unguided requests with guided requests in JSON, regex and
+grammar modes. A fraction of the guided requests (`--novelty`) uses a
+definition that was never sent before, which has to be compiled, and the
+others reuse a definition from a small pool, which is cached after its first
+use. The results are broken down by these classes.
+
+    python bench.py --rates 1 4 16 --num-requests 200 --output report.json
+
+`--stub` starts the stub server of `benchmarks/stub_server.py` instead of
+using `--url`, which is useful to test this script without a GPU.
+
+"""
+
+import argparse
 import asyncio
-import time
+import csv
 import json
-from typing import List
+import os
+import random
+import socket
 import statistics
-import argparse
+import subprocess
+import sys
+import time
+import urllib.request
+from dataclasses import asdict, dataclass, field
+from typing import List, Optional
+
 from openai import AsyncOpenAI
 
 # Example JSON schemas of varying complexity
@@ -38,75 +67,353 @@ SCHEMAS = {
     },
 }
 
+REGEXES = {
+    "phone": r"\(\d{3}\) \d{3}-\d{4}",
+    "date": r"\d{4}-(0[1-9]|1[0-2])-(0[1-9]|[12]\d|3[01])",
+    "email": r"[a-z0-9._%+-]{1,20}@[a-z0-9.-]{1,20}\.[a-z]{2,4}",
+}
 
-async def make_request(client: AsyncOpenAI, prompt: str, schema: dict) -> float:
-    """Make a single request and return completion time"""
-    start = time.time()
+GRAMMARS = {
+    "arithmetic": """
+?start: expr
+?expr: term (("+" | "-") term)*
+?term: factor (("*" | "/") factor)*
+?factor: NUMBER | "(" expr ")"
+%import common.NUMBER
+""",
+    "list": """
+?start: "[" [item ("," item)*] "]"
+?item: WORD
+%import common.WORD
+""",
+}
 
-    await client.completions.create(
-        model="gpt2",
-        prompt=prompt,
-        temperature=0.7,
-        max_tokens=100,
-        extra_body={"guided_json": json.dumps(schema)},
-    )
+PROMPTS = {
+    "json": "Generate a JSON object with user details:",
+    "regex": "Write down a value:",
+    "grammar": "Write an expression:",
+    "none": "Tell me a short story:",
+}
+
+PERCENTILES = [50, 90, 99]
+
+
+@dataclass
+class RequestSpec:
+    """A request to send, and the class it belongs to."""
+
+    arrival: float
+    mode: str
+    name: str
+    novel: bool
+    definition: Optional[str] = None
+
+    @property
+    def kind(self) -> str:
+        if self.mode == "none":
+            return "unguided"
+        return "guided-novel" if self.novel else "guided-cached"
+
+
+@dataclass
+class RequestResult:
+    """Timings of one request, in seconds from its scheduled arrival."""
+
+    mode: str
+    name: str
+    kind: str
+    rate: float
+    scheduled: float
+    send_delay: float = 0.0
+    ttft: Optional[float] = None
+    latency: Optional[float] = None
+    num_chunks: int = 0
+    inter_token_latencies: List[float] = field(default_factory=list)
+    error: Optional[str] = None
+
+
+def make_definition(mode: str, name: str, nonce: Optional[int]) -> str:
+    """Return the definition `name` of `mode`, made unique by `nonce` if given."""
+    if mode == "json":
+        schema = SCHEMAS[name]
+        if nonce is not None:
+            schema = dict(schema, title=f"bench-{nonce}")
+        return json.dumps(schema)
+    if mode == "regex":
+        pattern = REGEXES[name]
+        if nonce is not None:
+            pattern = f"(?:{pattern})|bench-{nonce}"
+        return pattern
+    grammar = GRAMMARS[name]
+    if nonce is not None:
+        # An unused rule changes the definition without changing the language
+        grammar += f'\nbench{nonce}: "bench-{nonce}"\n'
+    return grammar
 
-    return time.time() - start
 
+def make_workload(args, rate: float, rng: random.Random) -> List[RequestSpec]:
+    """Draw the arrival times and the classes of the requests."""
+    definitions = {"json": SCHEMAS, "regex": REGEXES, "grammar": GRAMMARS}
+    specs = []
+    arrival = 0.0
+    for i in range(args.num_requests):
+        if args.arrivals == "poisson":
+            arrival += rng.expovariate(rate)
+        else:
+            arrival = i / rate
 
-async def run_concurrent_requests(
-    client: AsyncOpenAI, schema: dict, num_requests: int, prompt: str
-) -> List[float]:
-    """Run multiple requests concurrently"""
-    tasks = [make_request(client, prompt, schema) for _ in range(num_requests)]
+        if rng.random() >= args.guided_ratio:
+            specs.append(RequestSpec(arrival, "none", "none", False))
+            continue
+
+        mode = rng.choice(args.modes)
+        name = rng.choice(sorted(definitions[mode]))
+        novel = rng.random() < args.novelty
+        nonce = rng.getrandbits(64) if novel else None
+        specs.append(
+            RequestSpec(arrival, mode, name, novel, make_definition(mode, name, nonce))
+        )
+    return specs
+
+
+async def send_request(
+    client: AsyncOpenAI, args, spec: RequestSpec, start: float, rate: float
+) -> RequestResult:
+    """Send a request at its arrival time and record its streaming timings."""
+    result = RequestResult(spec.mode, spec.name, spec.kind, rate, spec.arrival)
+    await asyncio.sleep(max(0.0, start + spec.arrival - time.perf_counter()))
+    scheduled = start + spec.arrival
+    result.send_delay = time.perf_counter() - scheduled
+
+    extra_body = {}
+    if spec.mode != "none":
+        extra_body[f"guided_{spec.mode}"] = spec.definition
+
+    try:
+        stream = await client.completions.create(
+            model=args.model,
+            prompt=PROMPTS[spec.mode],
+            temperature=args.temperature,
+            max_tokens=args.max_tokens,
+            stream=True,
+            extra_body=extra_body,
+        )
+        last = None
+        async for chunk in stream:
+            if not chunk.choices or not chunk.choices[0].text:
+                continue
+            now = time.perf_counter()
+            if last is None:
+                result.ttft = now - scheduled
+            else:
+                result.inter_token_latencies.append(now - last)
+            last = now
+            result.num_chunks += 1
+        result.latency = time.perf_counter() - scheduled
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    return result
+
+
+async def run_rate(client: AsyncOpenAI, args, rate: float) -> List[RequestResult]:
+    """Send the whole workload at `rate` requests per second."""
+    specs = make_workload(args, rate, random.Random(f"{args.seed}-{rate}"))
+    start = time.perf_counter()
+    tasks = [
+        asyncio.create_task(send_request(client, args, spec, start, rate))
+        for spec in specs
+    ]
     return await asyncio.gather(*tasks)
 
 
-async def benchmark(base_url: str, concurrency_levels: List[int], prompt: str):
-    """Run benchmarks across different schemas and concurrency levels"""
-    client = AsyncOpenAI(
-        base_url=base_url,
-        api_key="not-needed",  # Or whatever is required for your setup
+def percentiles(values: List[float]) -> dict:
+    if not values:
+        return {f"p{p}": None for p in PERCENTILES} | {"mean": None}
+    values = sorted(values)
+    stats = {
+        f"p{p}": values[min(len(values) - 1, int(len(values) * p / 100))]
+        for p in PERCENTILES
+    }
+    stats["mean"] = statistics.fmean(values)
+    return stats
+
+
+def summarize(results: List[RequestResult], duration: float) -> dict:
+    """Return the latency percentiles and the throughput of `results`."""
+    ok = [r for r in results if r.error is None and r.ttft is not None]
+    return {
+        "num_requests": len(results),
+        "num_errors": sum(r.error is not None for r in results),
+        "throughput": len(ok) / duration if duration > 0 else None,
+        "tokens_per_s": sum(r.num_chunks for r in ok) / duration if duration else None,
+        "ttft": percentiles([r.ttft for r in ok]),
+        "itl": percentiles([t for r in ok for t in r.inter_token_latencies]),
+        "latency": percentiles([r.latency for r in ok]),
+        "send_delay_max": max((r.send_delay for r in results), default=0.0),
+    }
+
+
+def report(results: List[RequestResult], rate: float, duration: float) -> dict:
+    kinds = sorted({r.kind for r in results})
+    summary = {
+        "rate": rate,
+        "duration": duration,
+        "all": summarize(results, duration),
+        **{
+            kind: summarize([r for r in results if r.kind == kind], duration)
+            for kind in kinds
+        },
+    }
+    return summary
+
+
+def print_report(summary: dict):
+    print(f"\nRate {summary['rate']:g} req/s, {summary['duration']:.1f}s")
+    print(
+        f"{'class':>14} {'n':>5} {'err':>4} "
+        f"{'ttft p50':>9} {'ttft p99':>9} {'itl p50':>8} {'itl p99':>8} "
+        f"{'e2e p50':>8} {'e2e p99':>8}"
     )
 
-    results = {}
+    def ms(value):
+        return f"{value * 1e3:.0f}ms" if value is not None else "-"
 
-    for schema_name, schema in SCHEMAS.items():
-        results[schema_name] = {}
-        print(f"\nTesting schema: {schema_name}")
+    for kind, stats in summary.items():
+        if not isinstance(stats, dict):
+            continue
+        print(
+            f"{kind:>14} {stats['num_requests']:>5} {stats['num_errors']:>4} "
+            f"{ms(stats['ttft']['p50']):>9} {ms(stats['ttft']['p99']):>9} "
+            f"{ms(stats['itl']['p50']):>8} {ms(stats['itl']['p99']):>8} "
+            f"{ms(stats['latency']['p50']):>8} {ms(stats['latency']['p99']):>8}"
+        )
+    if summary["all"]["send_delay_max"] > 0.05:
+        print(
+            "Warning: requests were sent up to "
+            f"{summary['all']['send_delay_max']:.2f}s late, the client is saturated"
+        )
 
-        for num_requests in range(2, concurrency_levels):
-            print(f"Running {num_requests} concurrent requests...")
 
-            completion_times = await run_concurrent_requests(
-                client, schema, num_requests, prompt
-            )
+def write_csv(path: str, results: List[RequestResult]):
+    columns = [
+        "rate",
+        "mode",
+        "name",
+        "kind",
+        "scheduled",
+        "send_delay",
+        "ttft",
+        "latency",
+        "num_chunks",
+        "itl_mean",
+        "error",
+    ]
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        for result in results:
+            row = asdict(result)
+            itl = row.pop("inter_token_latencies")
+            row["itl_mean"] = statistics.fmean(itl) if itl else None
+            writer.writerow(row)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def start_stub_server(args) -> subprocess.Popen:
+    """Start the stub server on a free port and point `args.url` to it."""
+    port = free_port()
+    path = os.path.join(os.path.dirname(__file__), "benchmarks", "stub_server.py")
+    server = subprocess.Popen([sys.executable, path, "--port", str(port)])
+    args.url = f"http://localhost:{port}/v1"
+    for _ in range(100):
+        try:
+            with urllib.request.urlopen(f"http://localhost:{port}/health"):
+                return server
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError("The stub server did not start")
 
-            stats = {
-                "mean": statistics.mean(completion_times),
-                "median": statistics.median(completion_times),
-                "stddev": statistics.stdev(completion_times),
-                "throughput": num_requests / max(completion_times),
-            }
 
-            results[schema_name][num_requests] = stats
+async def benchmark(args) -> List[dict]:
+    """Run the workload at every rate of `args.rates`."""
+    client = AsyncOpenAI(base_url=args.url, api_key="not-needed")
 
-            print(f"Results for {num_requests} requests:")
-            print(f"  Mean time: {stats['mean']:.3f}s")
-            print(f"  Median time: {stats['median']:.3f}s")
-            print(f"  Throughput: {stats['throughput']:.2f} req/s")
+    summaries, all_results = [], []
+    for rate in args.rates:
+        start = time.perf_counter()
+        results = await run_rate(client, args, rate)
+        duration = time.perf_counter() - start
+        summary = report(results, rate, duration)
+        print_report(summary)
+        summaries.append(summary)
+        all_results.extend(results)
 
-    return results
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"arguments": vars(args), "runs": summaries}, f, indent=2)
+    if args.csv:
+        write_csv(args.csv, all_results)
+    return summaries
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--url", default="http://localhost:8000/v1")
-    parser.add_argument("--prompt", default="Generate a JSON object with user details:")
-    parser.add_argument("--max-concurrency", type=int, default=10)
+    parser.add_argument("--model", default="gpt2")
+    parser.add_argument(
+        "--rates",
+        type=float,
+        nargs="+",
+        default=[1.0, 4.0],
+        help="Average arrival rates to test, in requests per second",
+    )
+    parser.add_argument("--num-requests", type=int, default=100)
+    parser.add_argument(
+        "--arrivals", choices=["poisson", "constant"], default="poisson"
+    )
+    parser.add_argument(
+        "--guided-ratio",
+        type=float,
+        default=0.5,
+        help="Fraction of the requests that are guided",
+    )
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        choices=["json", "regex", "grammar"],
+        default=["json", "regex", "grammar"],
+    )
+    parser.add_argument(
+        "--novelty",
+        type=float,
+        default=0.1,
+        help="Fraction of the guided requests with a never seen definition",
+    )
+    parser.add_argument("--max-tokens", type=int, default=100)
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the summary to this JSON file")
+    parser.add_argument("--csv", help="Write the per-request timings to this CSV file")
+    parser.add_argument(
+        "--stub",
+        action="store_true",
+        help="Benchmark the stub server of benchmarks/stub_server.py",
+    )
     args = parser.parse_args()
 
-    asyncio.run(benchmark(args.url, args.max_concurrency, args.prompt))
+    server = start_stub_server(args) if args.stub else None
+    try:
+        asyncio.run(benchmark(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,144 @@
+"""Find the crossover points between the masking strategies on CPU.
+
+For each vocabulary size and number of allowed tokens, this times the three
+strategies of `dotllm.masking` on a single row of logits, once with the mask
+built at every step (a miss in the `MaskCache`) and once with a ready-made mask
+(a hit). It then prints, for hits and misses, the largest number of allowed
+tokens for which `sparse` beats `dense`, and the largest number of disallowed
+tokens for which `complement` beats `dense`: these bound the values to pass to
+`--guided-mask-sparse-max-tokens` and `--guided-mask-complement-max-tokens`.
+
+On a hit, `sparse` costs about as much as `dense` on CPU since filling the row
+with `-inf` and adding a cached mask are both bound by the memory bandwidth;
+it wins on a miss, and its cached masks are a fraction of the size of the
+dense ones, so more guide states fit in the cache.
+
+    python benchmarks/bench_adaptive_masking.py --vocab-sizes 32000 128256 256000
+
+The crossovers depend on the hardware; on GPU, run it with `--device cuda`.
+
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+import torch
+
+from dotllm.masking import apply_mask, build_mask
+
+
+STRATEGIES = ["sparse", "complement", "dense"]
+SIZES = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384]
+
+
+def timeit(func, repeat: int, device: str) -> float:
+    func()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings))
+
+
+def bench(vocab_size: int, num_allowed: int, args) -> dict:
+    rng = np.random.default_rng(num_allowed)
+    allowed_tokens = rng.choice(vocab_size, num_allowed, replace=False)
+    logits = torch.randn(vocab_size, device=args.device)
+    expected = None
+
+    result = {"vocab_size": vocab_size, "num_allowed": num_allowed}
+    for strategy in STRATEGIES:
+        mask = build_mask(strategy, allowed_tokens, vocab_size, args.device)
+
+        # All the strategies must produce the same logits
+        masked = apply_mask(strategy, logits.clone(), mask)
+        if expected is None:
+            expected = masked
+        assert torch.equal(masked, expected), strategy
+
+        # The logits are overwritten in place, which does not change the
+        # amount of work done by any of the strategies.
+        row = logits.clone()
+        result[f"{strategy}_hit_us"] = 1e6 * timeit(
+            lambda: apply_mask(strategy, row, mask), args.repeat, args.device
+        )
+        result[f"{strategy}_miss_us"] = 1e6 * timeit(
+            lambda: apply_mask(
+                strategy,
+                row,
+                build_mask(strategy, allowed_tokens, vocab_size, args.device),
+            ),
+            args.repeat,
+            args.device,
+        )
+    return result
+
+
+def crossover(results, vocab_size: int, strategy: str, kind: str, count) -> int:
+    """Return the largest `count` for which `strategy` beats `dense` on a `kind`."""
+    best = 0
+    for result in results:
+        if result["vocab_size"] != vocab_size:
+            continue
+        if result[f"{strategy}_{kind}_us"] < result[f"dense_{kind}_us"]:
+            best = max(best, count(result))
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--vocab-sizes", type=int, nargs="+", default=[32_000, 128_256, 256_000]
+    )
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--output", help="Write the results as JSON to this file.")
+    args = parser.parse_args()
+
+    results = []
+    header = " ".join(f"{f'{s} hit/miss (us)':>25}" for s in STRATEGIES)
+    for vocab_size in args.vocab_sizes:
+        print(f"\nvocab_size={vocab_size}")
+        print(f"{'allowed':>8} {header}")
+        counts = [n for n in SIZES if n < vocab_size // 2]
+        counts += [vocab_size // 2] + [vocab_size - n for n in reversed(counts)]
+        for num_allowed in counts:
+            result = bench(vocab_size, num_allowed, args)
+            results.append(result)
+            timings = " ".join(
+                f"{result[f'{s}_hit_us']:>12.1f}/{result[f'{s}_miss_us']:<12.1f}"
+                for s in STRATEGIES
+            )
+            print(f"{num_allowed:>8} {timings}")
+
+    print()
+    for vocab_size in args.vocab_sizes:
+        for kind in ("hit", "miss"):
+            sparse_max = crossover(
+                results, vocab_size, "sparse", kind, lambda r: r["num_allowed"]
+            )
+            complement_max = crossover(
+                results,
+                vocab_size,
+                "complement",
+                kind,
+                lambda r: r["vocab_size"] - r["num_allowed"],
+            )
+            print(
+                f"vocab_size={vocab_size} ({kind}): sparse up to {sparse_max} "
+                f"allowed tokens, complement up to {complement_max} disallowed "
+                "tokens"
+            )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"device": args.device, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""Report the compilation cache hit rate with and without canonicalization.
+
+The corpus is a JSONL file with one structure definition per line, as sent by
+the clients, for instance extracted from the server's request logs:
+
+    {"type": "json", "definition": {"type": "object", ...}}
+    {"type": "regex", "definition": "[0-9]{3,8}"}
+    {"type": "grammar", "definition": "?value: dict | list ..."}
+
+A line that is a bare JSON schema is treated as `{"type": "json", ...}`.
+
+    python benchmarks/bench_canonicalization.py requests.jsonl
+
+Without a corpus, `--synthetic N` replays N requests for a few schemas, each
+serialized the way a different client SDK would: with or without whitespace,
+with shuffled keys, and with `definitions` or `$defs`.
+
+    python benchmarks/bench_canonicalization.py --synthetic 10000
+
+"""
+
+import argparse
+import json
+import random
+import time
+from collections import Counter
+
+from dotllm.canonicalize import (
+    canonicalize_grammar,
+    canonicalize_json_schema,
+    canonicalize_regex,
+)
+from dotllm.compilation_manager import make_key
+
+
+CANONICALIZE = {
+    "json": canonicalize_json_schema,
+    "regex": canonicalize_regex,
+    "grammar": canonicalize_grammar,
+}
+
+
+def load_corpus(path: str):
+    corpus = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if "type" not in entry or "definition" not in entry:
+                entry = {"type": "json", "definition": entry}
+            corpus.append(entry)
+    return corpus
+
+
+SYNTHETIC_SCHEMAS = [
+    {
+        "type": "object",
+        "properties": {
+            "name": {"type": "string"},
+            "age": {"type": "integer", "minimum": 0},
+            "address": {"$ref": "#/$defs/Address"},
+        },
+        "required": ["name", "age"],
+        "$defs": {
+            "Address": {
+                "type": "object",
+                "properties": {
+                    "street": {"type": "string"},
+                    "city": {"type": "string"},
+                },
+                "required": ["city"],
+            }
+        },
+    },
+    {
+        "type": "object",
+        "properties": {
+            "sentiment": {"enum": ["positive", "negative", "neutral"]},
+            "confidence": {"type": "number", "minimum": 0, "maximum": 1},
+        },
+        "required": ["sentiment"],
+        "additionalProperties": False,
+    },
+    {
+        "type": "array",
+        "items": {"$ref": "#/$defs/Item"},
+        "$defs": {
+            "Item": {
+                "type": "object",
+                "properties": {"id": {"type": "integer"}, "tags": {"type": "array"}},
+            }
+        },
+    },
+]
+
+
+def shuffle_keys(schema, rng: random.Random):
+    """Shuffle the keys of every object, except the order of `properties`."""
+    if isinstance(schema, list):
+        return [shuffle_keys(value, rng) for value in schema]
+    if not isinstance(schema, dict):
+        return schema
+    keys = list(schema)
+    rng.shuffle(keys)
+    return {
+        key: (
+            {name: shuffle_keys(sub, rng) for name, sub in schema[key].items()}
+            if key == "properties"
+            else shuffle_keys(schema[key], rng)
+        )
+        for key in keys
+    }
+
+
+def synthetic_corpus(num_requests: int, seed: int = 0):
+    """Draw requests for a few schemas, serialized like different client SDKs."""
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(num_requests):
+        schema = rng.choice(SYNTHETIC_SCHEMAS)
+        if rng.random() < 0.5 and "$defs" in schema:
+            # Older SDKs still use `definitions`
+            serialized = json.dumps(schema).replace("$defs", "definitions")
+            schema = json.loads(serialized)
+        if rng.random() < 0.5:
+            schema = shuffle_keys(schema, rng)
+        separators = rng.choice([None, (",", ":")])
+        indent = rng.choice([None, 2])
+        corpus.append(
+            {
+                "type": "json",
+                "definition": json.dumps(schema, separators=separators, indent=indent),
+            }
+        )
+    return corpus
+
+
+def hit_rate(keys) -> float:
+    """Fraction of requests whose index was already compiled."""
+    return 1 - len(set(keys)) / max(len(keys), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("corpus", nargs="?", help="JSONL file of structure definitions")
+    parser.add_argument(
+        "--synthetic",
+        type=int,
+        default=0,
+        help="Replay this many synthetic requests instead of a corpus",
+    )
+    parser.add_argument("--model", default="gpt2")
+    args = parser.parse_args()
+    if not args.corpus and not args.synthetic:
+        parser.error("Pass a corpus or --synthetic")
+
+    corpus = load_corpus(args.corpus) if args.corpus else []
+    corpus += synthetic_corpus(args.synthetic)
+
+    raw_keys, canonical_keys = [], []
+    invalid = Counter()
+    elapsed = 0.0
+    for entry in corpus:
+        definition = entry["definition"]
+        raw = definition if isinstance(definition, str) else json.dumps(definition)
+        raw_keys.append(make_key(args.model, raw))
+
+        start = time.perf_counter()
+        try:
+            canonical = CANONICALIZE[entry["type"]](definition)
+        except ValueError:
+            invalid[entry["type"]] += 1
+            continue
+        finally:
+            elapsed += time.perf_counter() - start
+        canonical_keys.append(make_key(args.model, canonical))
+
+    print(f"Requests: {len(corpus)}")
+    print(f"Rejected as malformed: {sum(invalid.values())} {dict(invalid)}")
+    print(f"Distinct indexes before canonicalization: {len(set(raw_keys))}")
+    print(f"Distinct indexes after canonicalization: {len(set(canonical_keys))}")
+    print(f"Cache hit rate before: {hit_rate(raw_keys):.1%}")
+    print(f"Cache hit rate after: {hit_rate(canonical_keys):.1%}")
+    print(f"Mean canonicalization time: {elapsed / max(len(corpus), 1) * 1e6:.1f}us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Compare the time-to-first-token with the process, thread and inline executors.
+
+For each compilation mode this starts a `dotvllm` server, waits until it is
+healthy, and sends one streaming request per schema of `bench.py`. The disk
+cache is disabled so every schema is compiled, and the time-to-first-token
+includes the compilation and the deserialization of the index.
+
+    python benchmarks/bench_executors.py --model gpt2 --repeat 3
+
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+from openai import AsyncOpenAI
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from bench import SCHEMAS  # noqa: E402
+
+
+MODES = ["process", "thread", "inline"]
+
+
+def wait_until_healthy(port: int, server: subprocess.Popen, timeout: float):
+    start = time.time()
+    while time.time() - start < timeout:
+        if server.poll() is not None:
+            raise RuntimeError("The server exited during startup")
+        try:
+            with urllib.request.urlopen(f"http://localhost:{port}/health") as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            pass
+        time.sleep(1)
+    raise TimeoutError("The server did not become healthy")
+
+
+async def time_to_first_token(
+    client: AsyncOpenAI, model: str, prompt: str, schema: dict, nonce: int
+) -> float:
+    # A unique title makes the schema unique, so it is compiled every time
+    schema = dict(schema, title=f"bench-{nonce}")
+
+    start = time.perf_counter()
+    stream = await client.completions.create(
+        model=model,
+        prompt=prompt,
+        max_tokens=20,
+        stream=True,
+        extra_body={"guided_json": json.dumps(schema)},
+    )
+    async for _ in stream:
+        ttft = time.perf_counter() - start
+        break
+    async for _ in stream:
+        pass
+    return ttft
+
+
+async def run_mode(args, mode: str) -> dict:
+    command = [
+        "dotvllm",
+        "--model",
+        args.model,
+        "--port",
+        str(args.port),
+        "--guided-compile-mode",
+        mode,
+        "--guided-disk-cache-max-bytes",
+        "0",
+    ]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    try:
+        wait_until_healthy(args.port, server, args.startup_timeout)
+        client = AsyncOpenAI(base_url=f"http://localhost:{args.port}/v1", api_key="-")
+
+        results = {}
+        nonce = 0
+        for schema_name, schema in SCHEMAS.items():
+            timings = []
+            for _ in range(args.repeat):
+                nonce += 1
+                timings.append(
+                    await time_to_first_token(
+                        client, args.model, args.prompt, schema, nonce
+                    )
+                )
+            results[schema_name] = statistics.median(timings)
+        return results
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="gpt2")
+    parser.add_argument("--port", type=int, default=8123)
+    parser.add_argument("--prompt", default="Generate a JSON object with user details:")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--modes", nargs="+", default=MODES, choices=MODES)
+    parser.add_argument("--startup-timeout", type=float, default=600)
+    args = parser.parse_args()
+
+    results = {mode: asyncio.run(run_mode(args, mode)) for mode in args.modes}
+
+    print(f"\nMedian time-to-first-token (s), {args.repeat} requests per schema")
+    print(f"{'schema':>10} " + " ".join(f"{mode:>9}" for mode in args.modes))
+    for schema_name in SCHEMAS:
+        timings = " ".join(f"{results[mode][schema_name]:>9.3f}" for mode in args.modes)
+        print(f"{schema_name:>10} {timings}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,404 @@
+"""Offline microbenchmarks of the structured generation hot paths.
+
+This runs on CPU and needs neither a GPU, a model, nor the compilation
+backends: the vocabulary, the index and the guide are replaced by stubs with
+the same interface, and the logits are random tensors. Everything else is the
+code that runs in the server: the `CompilationManager` and its executors, the
+`SharedIndex` hand-over, the `LogitsProcessor` and the packed bitmasks.
+
+It measures:
+
+- `manager`: `CompilationManager.submit` + `get_index` throughput, for new
+  schemas (compiled by the executor) and for schemas already in the cache.
+- `serialization`: serializing an index, writing it to shared memory, and
+  mapping and deserializing it in the engine. With `--codecs`, also the
+  compression and decompression of the serialized index, and its ratio.
+- `guide`: building a guide over a deserialized index, and forking a guide
+  that read `--num-tokens` tokens (for `n > 1`) by copying it or, for guides
+  that cannot be copied, by building a new one and replaying the tokens.
+- `masking`: the per-token latency of `LogitsProcessor.__call__` and of the
+  batched bitmask path, per vocabulary and batch size.
+
+The results are written as JSON so that runs can be compared:
+
+    python benchmarks/bench_hot_paths.py --output before.json
+    python benchmarks/bench_hot_paths.py --output after.json --only masking
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from dotllm.bitmask import allocate_token_bitmask, apply_token_bitmask
+from dotllm.compilation_manager import CompilationManager
+from dotllm.config import DotConfig
+from dotllm.compression import get_codec
+from dotllm.logits_processor import LogitsProcessor, fork_guide
+from dotllm.shared_index import SharedIndex, write_shared_index
+
+
+BENCHMARKS = ["manager", "serialization", "guide", "masking"]
+
+
+class StubVocabulary:
+    """Vocabulary of `vocab_size` tokens, parsed from the stub model name."""
+
+    def __init__(self, model_name: str):
+        self.vocab_size = int(model_name.rsplit("-", 1)[-1])
+
+
+class StubIndex:
+    """Index whose states each allow a fixed number of random tokens.
+
+    It is serialized as a flat array of token ids, and deserialized without a
+    copy from any buffer, like the real backends do from a `SharedIndex`.
+
+    """
+
+    def __init__(self, allowed_tokens: np.ndarray):
+        self.allowed_tokens = allowed_tokens
+
+    def serialize(self) -> bytes:
+        num_states, num_allowed = self.allowed_tokens.shape
+        header = np.array([num_states, num_allowed], dtype=np.int32)
+        return header.tobytes() + self.allowed_tokens.tobytes()
+
+
+class StubGuide:
+    """Guide that walks the states of a `StubIndex` in a cycle."""
+
+    def __init__(self, index: StubIndex):
+        self.index = index
+        self.state = 0
+
+    def __copy__(self):
+        guide = StubGuide(self.index)
+        guide.state = self.state
+        return guide
+
+    def get_start_tokens(self):
+        return self.index.allowed_tokens[0]
+
+    def read_next_token(self, token_id: int):
+        self.state = (self.state + 1) % len(self.index.allowed_tokens)
+        return self.index.allowed_tokens[self.state]
+
+
+def compile_stub(model_name: str, schema: str) -> StubIndex:
+    """Draw a random index; `schema` is `<seed>:<num_states>:<allowed_fraction>`."""
+    vocabulary = StubVocabulary(model_name)
+    seed, num_states, allowed_fraction = schema.split(":")
+    seed, num_states = int(seed), int(num_states)
+    num_allowed = max(1, int(vocabulary.vocab_size * float(allowed_fraction)))
+    rng = np.random.default_rng(seed)
+    allowed_tokens = np.sort(
+        rng.integers(0, vocabulary.vocab_size, (num_states, num_allowed)), axis=1
+    ).astype(np.int32)
+    return StubIndex(allowed_tokens)
+
+
+def load_stub_index(serialized_index) -> StubIndex:
+    num_states, num_allowed = np.frombuffer(serialized_index, np.int32, count=2)
+    allowed_tokens = np.frombuffer(serialized_index, np.int32, offset=8)
+    return StubIndex(allowed_tokens.reshape(num_states, num_allowed))
+
+
+def build_stub_guide(index: StubIndex) -> StubGuide:
+    return StubGuide(index)
+
+
+def summarize(timings) -> dict:
+    """Return the median, p90 and mean of `timings`, in seconds."""
+    timings = sorted(timings)
+    return {
+        "median_s": statistics.median(timings),
+        "p90_s": timings[min(len(timings) - 1, int(0.9 * len(timings)))],
+        "mean_s": statistics.fmean(timings),
+        "samples": len(timings),
+    }
+
+
+def bench_manager(args) -> list:
+    results = []
+    model_name = f"stub-{args.vocab_sizes[0]}"
+    for mode in args.modes:
+        config = DotConfig(
+            disk_cache_dir=None,
+            compile_mode=mode,
+            compile_workers=args.compile_workers,
+        )
+        manager = CompilationManager(config, model_name)
+        manager.warmup()
+        try:
+            schemas = [
+                f"{seed}:{args.num_states}:{args.allowed_fraction}"
+                for seed in range(args.num_schemas)
+            ]
+            for cached in (False, True):
+                start = time.perf_counter()
+                keys = [manager.submit(compile_stub, model_name, s) for s in schemas]
+                submitted = time.perf_counter()
+                for key in keys:
+                    manager.get_index(key)
+                elapsed = time.perf_counter() - start
+                for key in keys:
+                    manager.release(key)
+
+                results.append(
+                    {
+                        "benchmark": "manager",
+                        "mode": mode,
+                        "cached": cached,
+                        "num_schemas": len(schemas),
+                        "submit_s": (submitted - start) / len(schemas),
+                        "throughput": len(schemas) / elapsed,
+                    }
+                )
+        finally:
+            manager.shutdown()
+    return results
+
+
+def bench_serialization(args) -> list:
+    results = []
+    directory = tempfile.mkdtemp(prefix="dotvllm-bench-")
+    for vocab_size in args.vocab_sizes:
+        index = compile_stub(
+            f"stub-{vocab_size}", f"0:{args.num_states}:{args.allowed_fraction}"
+        )
+        serialize, write, load = [], [], []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            serialized_index = index.serialize()
+            serialized = time.perf_counter()
+            path = write_shared_index(serialized_index, directory, os.getpid())
+            written = time.perf_counter()
+            shared_index = SharedIndex(path)
+            shared_index.load(load_stub_index)
+            loaded = time.perf_counter()
+            shared_index.close()
+
+            serialize.append(serialized - start)
+            write.append(written - serialized)
+            load.append(loaded - written)
+
+        for step, timings in (
+            ("serialize", serialize),
+            ("write_shared", write),
+            ("map_and_load", load),
+        ):
+            results.append(
+                {
+                    "benchmark": "serialization",
+                    "step": step,
+                    "vocab_size": vocab_size,
+                    "num_bytes": len(serialized_index),
+                    **summarize(timings),
+                }
+            )
+
+        for codec in map(get_codec, args.codecs):
+            compress, decompress = [], []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                compressed = codec.compress(serialized_index)
+                compressed_at = time.perf_counter()
+                codec.decompress(compressed)
+                decompressed_at = time.perf_counter()
+
+                compress.append(compressed_at - start)
+                decompress.append(decompressed_at - compressed_at)
+
+            for step, timings in (("compress", compress), ("decompress", decompress)):
+                results.append(
+                    {
+                        "benchmark": "serialization",
+                        "step": step,
+                        "codec": codec.name,
+                        "vocab_size": vocab_size,
+                        "num_bytes": len(compressed),
+                        "ratio": round(len(serialized_index) / len(compressed), 2),
+                        **summarize(timings),
+                    }
+                )
+    os.rmdir(directory)
+    return results
+
+
+def bench_guide(args) -> list:
+    results = []
+    for vocab_size in args.vocab_sizes:
+        index = compile_stub(
+            f"stub-{vocab_size}", f"0:{args.num_states}:{args.allowed_fraction}"
+        )
+        build, fork, replay = [], [], []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            guide = build_stub_guide(index)
+            built = time.perf_counter()
+            for token in range(args.num_tokens):
+                guide.read_next_token(token)
+
+            forking = time.perf_counter()
+            fork_guide(guide)
+            forked = time.perf_counter()
+            replayed_guide = build_stub_guide(index)
+            for token in range(args.num_tokens):
+                replayed_guide.read_next_token(token)
+            replayed = time.perf_counter()
+
+            build.append(built - start)
+            fork.append(forked - forking)
+            replay.append(replayed - forked)
+
+        for step, timings in (("build", build), ("fork", fork), ("replay", replay)):
+            results.append(
+                {
+                    "benchmark": "guide",
+                    "step": step,
+                    "vocab_size": vocab_size,
+                    **summarize(timings),
+                }
+            )
+    return results
+
+
+def make_processors(manager, model_name: str, batch_size: int, args):
+    processors = []
+    for seed in range(batch_size):
+        schema = f"{seed}:{args.num_states}:{args.allowed_fraction}"
+        key = manager.submit(compile_stub, model_name, schema)
+        processors.append(
+            LogitsProcessor(key, manager, load_stub_index, build_stub_guide)
+        )
+    return processors
+
+
+def bench_masking(args) -> list:
+    results = []
+    manager = CompilationManager(DotConfig(disk_cache_dir=None, compile_mode="inline"))
+    try:
+        for vocab_size in args.vocab_sizes:
+            model_name = f"stub-{vocab_size}"
+            for batch_size in args.batch_sizes:
+                for path in ("per-sequence", "batched"):
+                    processors = make_processors(
+                        manager, model_name, batch_size, args
+                    )
+                    logits = torch.randn(batch_size, vocab_size)
+                    timings = []
+                    for step in range(args.num_tokens + 1):
+                        input_ids = list(range(step))
+                        step_logits = logits.clone()
+                        start = time.perf_counter()
+                        if path == "per-sequence":
+                            for row, processor in enumerate(processors):
+                                processor(input_ids, step_logits[row])
+                        else:
+                            bitmask = allocate_token_bitmask(batch_size, vocab_size)
+                            for row, processor in enumerate(processors):
+                                processor.fill_bitmask(input_ids, bitmask[row])
+                            apply_token_bitmask(step_logits, bitmask)
+                        # The first step builds the guides
+                        if step > 0:
+                            timings.append((time.perf_counter() - start) / batch_size)
+
+                    for processor in processors:
+                        manager.release(processor.compilation_key)
+                    results.append(
+                        {
+                            "benchmark": "masking",
+                            "path": path,
+                            "vocab_size": vocab_size,
+                            "batch_size": batch_size,
+                            **summarize(timings),
+                        }
+                    )
+    finally:
+        manager.shutdown()
+    return results
+
+
+def print_results(results: list):
+    for result in results:
+        params = " ".join(
+            f"{k}={v}"
+            for k, v in result.items()
+            if k not in ("benchmark", "samples", "throughput") and not k.endswith("_s")
+        )
+        timings = " ".join(
+            f"{k[:-2]}={v * 1e6:.1f}us" for k, v in result.items() if k.endswith("_s")
+        )
+        if "throughput" in result:
+            timings += f" ({result['throughput']:.0f}/s)"
+        print(f"{result['benchmark']:>13} {params} {timings}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument(
+        "--vocab-sizes", type=int, nargs="+", default=[50_000, 128_000, 256_000]
+    )
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32, 128])
+    parser.add_argument("--num-states", type=int, default=64)
+    parser.add_argument(
+        "--allowed-fraction",
+        type=float,
+        default=0.01,
+        help="Fraction of the vocabulary allowed in each state of the indexes",
+    )
+    parser.add_argument("--num-tokens", type=int, default=32)
+    parser.add_argument("--num-schemas", type=int, default=64)
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        default=["inline", "thread", "process"],
+        choices=["inline", "thread", "process"],
+    )
+    parser.add_argument("--compile-workers", type=int, default=2)
+    parser.add_argument(
+        "--codecs", nargs="+", default=[], choices=["zlib", "zstd", "lz4"]
+    )
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    benchmarks = {
+        "manager": bench_manager,
+        "serialization": bench_serialization,
+        "guide": bench_guide,
+        "masking": bench_masking,
+    }
+    results = []
+    for name in args.only:
+        results.extend(benchmarks[name](args))
+    print_results(results)
+
+    if args.output:
+        report = {
+            "environment": {
+                "python": platform.python_version(),
+                "torch": torch.__version__,
+                "numpy": np.__version__,
+                "machine": platform.machine(),
+                "cpu_count": os.cpu_count(),
+            },
+            "arguments": vars(args),
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
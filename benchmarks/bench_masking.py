@@ -0,0 +1,110 @@
+"""Compare the per-sequence and batched masking of the logits on CPU.
+
+This does not need a GPU nor a compiled index: the guide is replaced by a stub
+that returns random sets of allowed tokens. Both paths are timed without and
+with the mask cache, in which case the masks are built once and then copied.
+
+    python benchmarks/bench_masking.py --vocab-size 128000 --batch-sizes 1 8 32 128
+
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from dotllm.bitmask import allocate_token_bitmask, apply_token_bitmask
+from dotllm.logits_processor import LogitsProcessor
+from dotllm.mask_cache import MaskCache
+
+
+class StubGuide:
+    """Guide that returns pre-drawn sets of allowed tokens."""
+
+    def __init__(self, vocab_size: int, num_allowed: int, seed: int):
+        rng = np.random.default_rng(seed)
+        self.allowed_tokens = rng.choice(vocab_size, num_allowed, replace=False)
+
+    def get_start_tokens(self):
+        return self.allowed_tokens
+
+    def read_next_token(self, token_id: int):
+        return self.allowed_tokens
+
+
+def make_processors(
+    batch_size: int, vocab_size: int, num_allowed: int, mask_cache_max_bytes: int
+):
+    mask_cache = MaskCache(mask_cache_max_bytes) if mask_cache_max_bytes else None
+    processors = []
+    for seed in range(batch_size):
+        # Each processor has its own guide, so its own masks in the cache
+        processor = LogitsProcessor(f"stub-{seed}", None, None, None)
+        processor.guide = StubGuide(vocab_size, num_allowed, seed)
+        processor.mask_cache = mask_cache
+        processors.append(processor)
+    return processors
+
+
+def per_sequence(processors, logits):
+    for row, processor in enumerate(processors):
+        processor([0], logits[row])
+
+
+def batched(processors, logits):
+    bitmask = allocate_token_bitmask(len(processors), logits.shape[-1])
+    for row, processor in enumerate(processors):
+        processor.fill_bitmask([0], bitmask[row])
+    apply_token_bitmask(logits, bitmask)
+
+
+def timeit(func, processors, logits, repeat: int) -> float:
+    func(processors, logits.clone())
+    timings = []
+    for _ in range(repeat):
+        batch_logits = logits.clone()
+        start = time.perf_counter()
+        func(processors, batch_logits)
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vocab-size", type=int, default=128_000)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32, 128])
+    parser.add_argument("--num-allowed", type=int, default=1_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"vocab_size={args.vocab_size} num_allowed={args.num_allowed}")
+    print(
+        f"{'batch':>6} {'cache':>6} {'per-sequence (ms)':>18} {'batched (ms)':>13} "
+        f"{'speedup':>8}"
+    )
+    for batch_size in args.batch_sizes:
+        for mask_cache_max_bytes in (0, 256 * 1024**2):
+            processors = make_processors(
+                batch_size, args.vocab_size, args.num_allowed, mask_cache_max_bytes
+            )
+            logits = torch.randn(batch_size, args.vocab_size)
+
+            # Both paths must produce the same logits
+            expected, actual = logits.clone(), logits.clone()
+            per_sequence(processors, expected)
+            batched(processors, actual)
+            assert torch.equal(expected, actual)
+
+            per_sequence_time = timeit(per_sequence, processors, logits, args.repeat)
+            batched_time = timeit(batched, processors, logits, args.repeat)
+            cache = "yes" if mask_cache_max_bytes else "no"
+            print(
+                f"{batch_size:>6} {cache:>6} {per_sequence_time * 1e3:>18.3f} "
+                f"{batched_time * 1e3:>13.3f} "
+                f"{per_sequence_time / batched_time:>7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
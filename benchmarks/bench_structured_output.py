@@ -0,0 +1,171 @@
+"""Check and time the V1 structured output grammar on CPU.
+
+This does not need a GPU nor a compiled index: the guide is replaced by a stub
+whose allowed tokens depend on the tokens read so far. For every request in
+the batch it checks that the row of V1's bitmask filled by
+`DotStructuredOutputGrammar` allows exactly the tokens allowed by the guide,
+that disallowed tokens are rejected, and that rollbacks, resets and the EOS
+token leave the grammar in the expected state, whether the rollbacks go back
+to a forked guide or replay the tokens. It then times the filling of
+the bitmask of a step, with and without the mask cache.
+
+    python benchmarks/bench_structured_output.py --vocab-size 128000
+
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from dotllm.logits_processor import LogitsProcessor
+from dotllm.mask_cache import MaskCache
+from dotllm.structured_output import DotStructuredOutputGrammar
+
+
+class StubGuide:
+    """Guide over `num_states` states, each allowing random tokens and EOS.
+
+    The EOS token is the last token of the vocabulary.
+
+    """
+
+    def __init__(self, vocab_size: int, num_states: int, num_allowed: int):
+        rng = np.random.default_rng(0)
+        self.allowed = [
+            np.append(
+                np.sort(rng.choice(vocab_size - 1, num_allowed - 1, replace=False)),
+                vocab_size - 1,
+            )
+            for _ in range(num_states)
+        ]
+        self.state = 0
+
+    def __copy__(self):
+        guide = StubGuide.__new__(StubGuide)
+        guide.allowed = self.allowed
+        guide.state = self.state
+        return guide
+
+    def get_start_tokens(self):
+        return self.allowed[0]
+
+    def read_next_token(self, token_id: int):
+        if not np.any(self.allowed[self.state] == token_id):
+            raise ValueError(f"Token {token_id} is not allowed")
+        self.state = (self.state * 31 + token_id) % len(self.allowed)
+        return self.allowed[self.state]
+
+    def get_state(self):
+        return self.state
+
+
+class StubManager:
+    """The part of the `CompilationManager` used by the logits processors."""
+
+    def __init__(self, guide_args, mask_cache_max_bytes: int):
+        self.guide_args = guide_args
+        self.mask_cache = MaskCache(mask_cache_max_bytes)
+
+    def get_live_index(self, key, load_index):
+        return None
+
+
+def make_grammar(manager: StubManager, eos_token_id: int):
+    processor = LogitsProcessor(
+        "stub", manager, None, lambda index: StubGuide(*manager.guide_args)
+    )
+    return DotStructuredOutputGrammar(processor, eos_token_id)
+
+
+def unpack(bitmask_row: torch.Tensor, vocab_size: int) -> np.ndarray:
+    """Return the ids of the tokens allowed by a row of the bitmask."""
+    bits = np.unpackbits(bitmask_row.numpy().view(np.uint8), bitorder="little")
+    return np.flatnonzero(bits[:vocab_size])
+
+
+def check(grammar: DotStructuredOutputGrammar, guide: StubGuide, args, rng):
+    """Walk a grammar and a reference guide in lockstep, and compare the masks."""
+    bitmask = torch.full((1, (args.vocab_size + 31) // 32), -1, dtype=torch.int32)
+    history = []
+    expected = guide.get_start_tokens()
+    disallowed = np.setdiff1d(np.arange(args.vocab_size), expected)
+    assert not grammar.accept_tokens("check", [int(disallowed[0])])
+    for _ in range(args.num_tokens):
+        grammar.fill_bitmask(bitmask, 0)
+        assert np.array_equal(unpack(bitmask[0], args.vocab_size), expected)
+
+        token = int(rng.choice(expected[:-1]))
+        assert grammar.accept_tokens("check", [token])
+        history.append(expected)
+        expected = guide.read_next_token(token)
+
+    # Roll back two tokens, and check that the mask is the one before them
+    grammar.rollback(2)
+    grammar.fill_bitmask(bitmask, 0)
+    assert np.array_equal(unpack(bitmask[0], args.vocab_size), history[-2])
+
+    # The EOS token terminates the grammar and can be rolled back
+    assert grammar.accept_tokens("check", [grammar.eos_token_id])
+    assert grammar.is_terminated()
+    grammar.rollback(1)
+    assert not grammar.is_terminated()
+
+    grammar.reset()
+    grammar.fill_bitmask(bitmask, 0)
+    assert np.array_equal(unpack(bitmask[0], args.vocab_size), history[0])
+
+
+def timeit(grammars, bitmask, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for batch_index, grammar in enumerate(grammars):
+            grammar.fill_bitmask(bitmask, batch_index)
+        timings.append(time.perf_counter() - start)
+        for grammar in grammars:
+            grammar.accept_tokens("bench", [int(grammar.allowed_tokens()[0])])
+    return float(np.median(timings))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vocab-size", type=int, default=128_000)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--num-allowed", type=int, default=1_000)
+    parser.add_argument("--num-states", type=int, default=16)
+    parser.add_argument("--num-tokens", type=int, default=32)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    guide_args = (args.vocab_size, args.num_states, args.num_allowed)
+    eos_token_id = args.vocab_size - 1
+    rng = np.random.default_rng(0)
+    default_max_rollback_tokens = DotStructuredOutputGrammar.max_rollback_tokens
+    for mask_cache_max_bytes in (0, 256 * 1024**2):
+        for max_rollback_tokens in (default_max_rollback_tokens, 1):
+            # With a single fork kept, the rollbacks of several tokens are replayed
+            DotStructuredOutputGrammar.max_rollback_tokens = max_rollback_tokens
+            manager = StubManager(guide_args, mask_cache_max_bytes)
+            grammar = make_grammar(manager, eos_token_id)
+            check(grammar, StubGuide(*guide_args), args, rng)
+    DotStructuredOutputGrammar.max_rollback_tokens = default_max_rollback_tokens
+    print("The bitmasks match the guide")
+
+    print(f"vocab_size={args.vocab_size} num_allowed={args.num_allowed}")
+    print(f"{'batch':>6} {'no cache (ms)':>14} {'mask cache (ms)':>16}")
+    for batch_size in args.batch_sizes:
+        bitmask = torch.full(
+            (batch_size, (args.vocab_size + 31) // 32), -1, dtype=torch.int32
+        )
+        timings = []
+        for mask_cache_max_bytes in (0, 256 * 1024**2):
+            manager = StubManager(guide_args, mask_cache_max_bytes)
+            grammars = [make_grammar(manager, eos_token_id) for _ in range(batch_size)]
+            timings.append(timeit(grammars, bitmask, args.repeat))
+        print(f"{batch_size:>6} {timings[0] * 1e3:>14.3f} {timings[1] * 1e3:>16.3f}")
+
+
+if __name__ == "__main__":
+    main()
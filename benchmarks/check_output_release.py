@@ -0,0 +1,89 @@
+"""Check that `DotEngine` releases the indexes of the finished requests.
+
+vLLM V0 processes the outputs of a step asynchronously by default
+(`use_async_output_proc`): they are handed to
+`AsyncLLMEngine.process_request_outputs` by a callback, and `step_async`
+returns none of them. This runs on CPU without a model: it wires a
+`DotEngine` to that callback like `AsyncLLMEngine.__init__` does, finishes
+requests through it, and checks that their timings are recorded and their
+indexes unpinned and evicted, with and without asynchronous output processing.
+
+    python benchmarks/check_output_release.py
+
+"""
+
+from types import SimpleNamespace
+
+from vllm.engine.async_llm_engine import RequestTracker
+from vllm.utils import weak_bind
+
+from bench_hot_paths import compile_stub
+from dotllm.compilation_manager import CompilationManager
+from dotllm.config import DotConfig
+from dotllm.engine import DotEngine, _DotAsyncLLMEngine
+from dotllm.request_timings import FinishedTimings, RequestTimings
+
+
+def make_engine(use_async_output_proc: bool) -> DotEngine:
+    """Build a `DotEngine` around an engine that only tracks the indexes."""
+    engine = _DotAsyncLLMEngine.__new__(_DotAsyncLLMEngine)
+    engine.compilation_manager = CompilationManager(
+        DotConfig(disk_cache_dir=None, compile_mode="inline", index_cache_max_entries=1)
+    )
+    engine._compilation_keys = {}
+    engine._request_timings = {}
+    engine.finished_timings = FinishedTimings()
+
+    client = DotEngine.__new__(DotEngine)
+    client.engine = engine
+    client._request_tracker = RequestTracker()
+    engine.process_request_outputs_callback = None
+    if use_async_output_proc:
+        engine.process_request_outputs_callback = weak_bind(
+            client.process_request_outputs
+        )
+    return client
+
+
+def finish(client: DotEngine, request_id: str) -> None:
+    """Hand the last output of a request over, like vLLM's output processing."""
+    request_outputs = [
+        SimpleNamespace(request_id=request_id, finished=True, metrics=None)
+    ]
+    callback = client.engine.process_request_outputs_callback
+    if callback is not None:
+        callback(request_outputs)
+        # `_process_model_outputs` clears the outputs once they are handed over
+        request_outputs.clear()
+    client.process_request_outputs(request_outputs)
+
+
+def check(use_async_output_proc: bool) -> None:
+    client = make_engine(use_async_output_proc)
+    manager = client.engine.compilation_manager
+    for i in range(4):
+        request_id = f"request-{i}"
+        key = manager.submit(compile_stub, "stub-5000", f"{i}:8:0.1")
+        manager.get_index(key)
+        client.engine._compilation_keys[request_id] = key
+        client.engine._request_timings[request_id] = RequestTimings(request_id)
+        finish(client, request_id)
+        assert client.engine.finished_timings.pop(request_id), "Timings not recorded"
+
+    assert not client.engine._compilation_keys, "Some requests were not released"
+    assert not client.engine._request_timings, "Some timings were not released"
+    assert len(manager._indexes) == 1, "Unpinned indexes were not evicted"
+    manager.shutdown()
+
+
+def main():
+    for use_async_output_proc in (False, True):
+        check(use_async_output_proc)
+        print(
+            f"use_async_output_proc={use_async_output_proc}: "
+            "timings recorded, indexes released"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""Check `DotStructuredOutputBackend`, the guides of the vLLM V1 engine, on CPU.
+
+The compilation backends are replaced by the stubs of `bench_hot_paths.py`,
+with a guide that rejects the tokens its state does not allow, like the real
+guides do. Everything else is the code that runs in the engine core: the
+backend compiles the indexes with the `CompilationManager` and builds the
+grammars of the V1 scheduler. It checks that:
+
+- a grammar allows the tokens of the guide, fills the bitmask with them,
+  and rejects the other tokens;
+- a definition that fails to compile is rejected by the frontend's
+  `add_request` with a `CompilationError`, and yields a grammar that only
+  allows EOS if it reaches the engine core anyway;
+- a guide that raises anything but `ValueError` falls back to EOS only,
+  rather than taking down the engine core;
+- the index stays pinned while its grammars are alive, and is unpinned once
+  they are collected;
+- with `--guided-request-timings`, the masks are recorded in the request's
+  timings.
+
+    python benchmarks/check_structured_output_backend.py
+
+"""
+
+import asyncio
+import gc
+
+import numpy as np
+from vllm.sampling_params import GuidedDecodingParams, SamplingParams
+from vllm.v1.engine.async_llm import AsyncLLM
+from vllm.v1.structured_output.backend_types import StructuredOutputOptions
+
+import dotllm.logits_processor
+from bench_hot_paths import StubGuide, StubIndex, compile_stub, load_stub_index
+from dotllm.compilation_manager import CompilationError, CompilationManager
+from dotllm.config import DotConfig
+from dotllm.structured_output import DotStructuredOutputBackend, add_request
+
+
+VOCAB_SIZE = 5000
+
+
+class CheckedStubGuide(StubGuide):
+    """Stub guide that rejects the tokens that its state does not allow."""
+
+    def __copy__(self):
+        guide = CheckedStubGuide(self.index)
+        guide.state = self.state
+        return guide
+
+    def read_next_token(self, token_id: int):
+        if not np.any(self.index.allowed_tokens[self.state] == token_id):
+            raise ValueError(f"Token {token_id} is not allowed")
+        return super().read_next_token(token_id)
+
+
+class BrokenStubGuide(CheckedStubGuide):
+    """Stub guide that fails on any token, like a guide with a bug."""
+
+    def __copy__(self):
+        guide = BrokenStubGuide(self.index)
+        guide.state = self.state
+        return guide
+
+    def read_next_token(self, token_id: int):
+        raise RuntimeError("Broken guide")
+
+
+class StubTokenizer:
+    name_or_path = f"stub-{VOCAB_SIZE}"
+    eos_token_id = VOCAB_SIZE - 1
+
+    def get_vocab(self):
+        return {str(token_id): token_id for token_id in range(VOCAB_SIZE)}
+
+
+class StubAsyncLLM(AsyncLLM):
+    """Frontend of the V1 engine, with the compilation manager of the backend."""
+
+    def __init__(self, backend: DotStructuredOutputBackend):
+        self.tokenizer = backend.tokenizer
+        self.dot_compilation_manager = backend.compilation_manager
+
+    async def get_tokenizer(self, lora_request=None):
+        return self.tokenizer
+
+
+def compile_failing(model_name: str, schema: str) -> StubIndex:
+    raise ValueError(f"Cannot compile {schema}")
+
+
+def make_backend(dot_config: DotConfig) -> DotStructuredOutputBackend:
+    """Build the backend without the vLLM configuration and tokenizer."""
+    backend = DotStructuredOutputBackend.__new__(DotStructuredOutputBackend)
+    backend.tokenizer = StubTokenizer()
+    backend.vocab_size = VOCAB_SIZE
+    backend.dot_config = dot_config
+    backend.compilation_manager = CompilationManager(
+        dot_config, backend.tokenizer.name_or_path
+    )
+    return backend
+
+
+def unpack(bitmask_row) -> np.ndarray:
+    """Return the ids of the tokens allowed by a row of the bitmask."""
+    bits = np.unpackbits(bitmask_row.numpy().view(np.uint8), bitorder="little")
+    return np.flatnonzero(bits[:VOCAB_SIZE])
+
+
+def check(backend: DotStructuredOutputBackend) -> None:
+    manager = backend.compilation_manager
+    index = compile_stub(backend.tokenizer.name_or_path, "1:8:0.1")
+    bitmask = backend.allocate_token_bitmask(2)
+    assert len(unpack(bitmask[0])) == VOCAB_SIZE, "The bitmask must allow all tokens"
+
+    grammars = [
+        backend.compile_grammar(StructuredOutputOptions.REGEX, "1:8:0.1")
+        for _ in range(2)
+    ]
+    key = grammars[0].processor.compilation_key
+    assert manager._indexes._pins[key] == 2, "The index is not pinned by the grammars"
+    # The stub guide walks the states of the index in order
+    for row, grammar in enumerate(grammars):
+        for state in range(2):
+            expected = index.allowed_tokens[state]
+            grammar.fill_bitmask(bitmask, row)
+            assert np.array_equal(unpack(bitmask[row]), np.unique(expected))
+            assert grammar.accept_tokens(f"request-{row}", [int(expected[row])])
+        disallowed = np.setdiff1d(np.arange(VOCAB_SIZE), index.allowed_tokens[2])
+        assert not grammar.accept_tokens(f"request-{row}", [int(disallowed[0])])
+        assert grammar.token_ids == [int(index.allowed_tokens[s][row]) for s in (0, 1)]
+
+    timings = grammars[0].processor.timings
+    if timings is not None:
+        assert timings.request_id == "request-0" and timings.num_masks == 2
+    del grammars, grammar
+    gc.collect()
+    assert key not in manager._indexes._pins, "The index was not unpinned"
+
+    dotllm.logits_processor.compile_regex = compile_failing
+    params = SamplingParams(guided_decoding=GuidedDecodingParams(regex="2:8:0.1"))
+    try:
+        asyncio.run(add_request(StubAsyncLLM(backend), "failed", "", params))
+        raise AssertionError("The frontend did not reject the definition")
+    except CompilationError:
+        pass
+    assert not manager._indexes._pins, "The rejected compilation was not released"
+    grammar = backend.compile_grammar(StructuredOutputOptions.REGEX, "2:8:0.1")
+    assert grammar.processor is None
+    assert not grammar.accept_tokens("failed", [0])
+    grammar.fill_bitmask(bitmask, 0)
+    assert np.array_equal(unpack(bitmask[0]), [backend.tokenizer.eos_token_id])
+    assert grammar.accept_tokens("failed", [backend.tokenizer.eos_token_id])
+    assert grammar.is_terminated()
+    assert not manager._indexes._pins, "The failed compilation was not released"
+    dotllm.logits_processor.compile_regex = compile_stub
+
+    dotllm.logits_processor.build_regex_guide = BrokenStubGuide
+    grammar = backend.compile_grammar(StructuredOutputOptions.REGEX, "3:8:0.1")
+    assert not grammar.accept_tokens("broken", [0])
+    assert grammar.processor is None, "The broken guide was not given up"
+    grammar.fill_bitmask(bitmask, 0)
+    assert np.array_equal(unpack(bitmask[0]), [backend.tokenizer.eos_token_id])
+    assert grammar.accept_tokens("broken", [backend.tokenizer.eos_token_id])
+    dotllm.logits_processor.build_regex_guide = CheckedStubGuide
+    del grammar
+    gc.collect()
+
+
+def main():
+    dotllm.logits_processor.compile_regex = compile_stub
+    dotllm.logits_processor.load_regex_index = load_stub_index
+    dotllm.logits_processor.build_regex_guide = CheckedStubGuide
+
+    for compile_mode in ("inline", "thread"):
+        for request_timings in (False, True):
+            backend = make_backend(
+                DotConfig(
+                    disk_cache_dir=None,
+                    compile_mode=compile_mode,
+                    compile_workers=1,
+                    request_timings=request_timings,
+                )
+            )
+            try:
+                check(backend)
+            finally:
+                backend.destroy()
+            print(
+                f"compile_mode={compile_mode} request_timings={request_timings}: "
+                "grammars match the guides, indexes released"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Stub of the OpenAI-compatible completions endpoint, to test `bench.py` offline.
+
+It streams random words at a fixed inter-token latency. Guided requests wait
+for a simulated compilation the first time their definition is seen, so the
+difference between novel and cached definitions shows in the time-to-first-
+token, like with the real server.
+
+    python benchmarks/stub_server.py --port 8001 --compile-time 0.5
+
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing"]
+
+
+def make_app(args) -> FastAPI:
+    app = FastAPI()
+    compiled = {}
+
+    async def wait_for_index(definition: str):
+        key = hashlib.sha256(definition.encode("utf-8")).hexdigest()
+        if key not in compiled:
+            compiled[key] = asyncio.ensure_future(asyncio.sleep(args.compile_time))
+        await compiled[key]
+
+    @app.get("/health")
+    async def health():
+        return {}
+
+    @app.post("/v1/completions")
+    async def completions(request: Request):
+        body = await request.json()
+        for mode in ("guided_json", "guided_regex", "guided_grammar"):
+            if body.get(mode):
+                await wait_for_index(str(body[mode]))
+
+        request_id = f"cmpl-{random.getrandbits(64):x}"
+        max_tokens = body.get("max_tokens") or 16
+
+        async def stream():
+            await asyncio.sleep(args.prefill_time)
+            for _ in range(max_tokens):
+                chunk = {
+                    "id": request_id,
+                    "object": "text_completion",
+                    "created": int(time.time()),
+                    "model": body.get("model", "stub"),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "text": f" {random.choice(WORDS)}",
+                            "logprobs": None,
+                            "finish_reason": None,
+                        }
+                    ],
+                }
+                yield f"data: {json.dumps(chunk)}\n\n"
+                await asyncio.sleep(args.inter_token_time)
+            yield "data: [DONE]\n\n"
+
+        if not body.get("stream"):
+            return {"error": "the stub server only supports streaming"}
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--compile-time", type=float, default=0.5)
+    parser.add_argument("--prefill-time", type=float, default=0.02)
+    parser.add_argument("--inter-token-time", type=float, default=0.01)
+    args = parser.parse_args()
+
+    uvicorn.run(make_app(args), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,12 @@
 """DotLLM API server implementation."""
 
+import json
 import logging
 import sys
 import os
 import uvloop
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
 
 from vllm.engine.arg_utils import AsyncEngineArgs
 from vllm.engine.protocol import EngineClient
@@ -18,7 +21,9 @@ from vllm.reasoning import ReasoningParserManager
 from vllm.utils import FlexibleArgumentParser, is_valid_ipv6_address
 
 
+from dotllm.config import V0_ONLY_OPTIONS, DotConfig
 from dotllm.engine import DotEngine
+from dotllm.structured_output import install_structured_output_backend
 
 # Configure logging
 logging.basicConfig(
@@ -30,9 +35,50 @@ logging.basicConfig(
 logger = logging.getLogger("dotllm.api_server")
 
 # Force V0 mode by setting environment variable directly
-# Without this vLLM will try to instantiate a V1 `LLMEngine`
+# Without this vLLM will try to instantiate a V1 `LLMEngine`. `cli_main`
+# only switches to V1 when `--guided-engine v1` is passed.
 os.environ["VLLM_USE_V1"] = "0"
 
+# The endpoints whose responses carry the timings of their requests
+TIMED_ENDPOINTS = ("/v1/chat/completions", "/v1/completions")
+
+
+def add_request_timings(app: FastAPI, engine_client: DotEngine) -> None:
+    """Add the timings of the guided requests to the responses of the server.
+
+    vLLM's OpenAI layer builds the responses from the request outputs only, so
+    the timings are added to the JSON body by a middleware, in a
+    `dotvllm_timings` field that lists the timings of the engine requests
+    behind the response. Streamed responses are left untouched.
+
+    Args:
+        app: The FastAPI application.
+        engine_client: The engine, with `--guided-request-timings` set.
+    """
+
+    @app.middleware("http")
+    async def add_timings_to_response(request: Request, call_next):
+        response = await call_next(request)
+        if (
+            request.url.path not in TIMED_ENDPOINTS
+            or response.headers.get("content-type") != "application/json"
+        ):
+            return response
+
+        body = b"".join([chunk async for chunk in response.body_iterator])
+        headers = {
+            k: v for k, v in response.headers.items() if k.lower() != "content-length"
+        }
+        content = json.loads(body)
+        timings = []
+        if isinstance(content, dict) and "id" in content:
+            timings = engine_client.pop_request_timings(content["id"])
+        if not timings:
+            return Response(body, status_code=response.status_code, headers=headers)
+
+        content["dotvllm_timings"] = timings
+        return JSONResponse(content, status_code=response.status_code, headers=headers)
+
 
 async def run_dot_server(args) -> None:
     """Run the DotLLM API server with a custom engine.
@@ -46,7 +92,9 @@ async def run_dot_server(args) -> None:
     Code copied from vLLM:
     https://github.com/vllm-project/vllm/blob/9b70e2b4c147ea650f9b943e6aecd977377fbbfd/vllm/entrypoints/openai/api_server.py#L1041
 
-    We only changed the definition of `engine_client`
+    We only changed the definition of `engine_client`, and apply the DotLLM
+    configuration to it. With `--guided-engine v1` the client is vLLM's V1
+    `AsyncLLM`, with our structured output backend installed.
 
     """
     logger.info("DotLLM API server starting...")
@@ -88,11 +136,25 @@ async def run_dot_server(args) -> None:
     vllm_config = engine_args.create_engine_config(
         usage_context=UsageContext.OPENAI_API_SERVER
     )
-    engine_client: EngineClient = DotEngine.from_vllm_config(
-        vllm_config=vllm_config,
-        disable_log_requests=args.disable_log_requests,
-        disable_log_stats=args.disable_log_stats,
-    )
+    dot_config = DotConfig.from_cli_args(args)
+    if dot_config.engine == "v1":
+        from vllm.v1.engine.async_llm import AsyncLLM
+
+        install_structured_output_backend(dot_config)
+        engine_client: EngineClient = AsyncLLM.from_vllm_config(
+            vllm_config=vllm_config,
+            disable_log_requests=args.disable_log_requests,
+            disable_log_stats=args.disable_log_stats,
+        )
+    else:
+        engine_client = DotEngine.from_vllm_config(
+            vllm_config=vllm_config,
+            disable_log_requests=args.disable_log_requests,
+            disable_log_stats=args.disable_log_stats,
+        )
+        engine_client.configure(dot_config)
+        if dot_config.request_timings:
+            add_request_timings(app, engine_client)
 
     try:
         # Initialize the app state with our engine
@@ -157,7 +219,25 @@ def cli_main():
     # Parse and validate arguments
     parser = FlexibleArgumentParser(description="DotLLM OpenAI-Compatible API server.")
     parser = make_arg_parser(parser)
+    parser = DotConfig.add_cli_args(parser)
     args = parser.parse_args()
+    os.environ["VLLM_USE_V1"] = "1" if args.engine == "v1" else "0"
+    if args.engine == "v1":
+        v0_only_flags = [
+            flag
+            for flag, dest in V0_ONLY_OPTIONS.items()
+            if getattr(args, dest) != parser.get_default(dest)
+        ]
+        if v0_only_flags:
+            parser.error(f"{', '.join(v0_only_flags)} need --guided-engine v0")
+        if args.request_timings:
+            logger.warning(
+                "With --guided-engine v1 the request timings are only logged"
+            )
+    elif args.jump_forward:
+        # See `_DotAsyncLLMEngine._can_jump_forward`
+        args.enable_chunked_prefill = True
+        args.disable_async_output_proc = True
     validate_parsed_serve_args(args)
 
     # Run the server
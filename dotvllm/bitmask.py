@@ -0,0 +1,64 @@
+"""DotLLM packed token bitmasks."""
+
+import numpy as np
+import torch
+
+
+def allocate_token_bitmask(batch_size: int, vocab_size: int) -> np.ndarray:
+    """Allocate an empty packed bitmask.
+
+    Token `i` of row `b` is allowed if bit `i % 32` of `bitmask[b, i // 32]`
+    is set.
+
+    Args:
+        batch_size: The number of sequences.
+        vocab_size: The size of the vocabulary.
+
+    Returns:
+        A `(batch_size, ceil(vocab_size / 32))` array of zeros.
+    """
+    return np.zeros((batch_size, (vocab_size + 31) // 32), dtype=np.uint32)
+
+
+def fill_token_bitmask(bitmask_row: np.ndarray, allowed_tokens) -> None:
+    """Set the bits of the allowed tokens in one row of a packed bitmask.
+
+    Args:
+        bitmask_row: A row of a bitmask allocated with `allocate_token_bitmask`.
+        allowed_tokens: The ids of the allowed tokens.
+    """
+    # `np.bitwise_or.at` is unbuffered and slow, so we set the tokens in a
+    # boolean row and pack it, which costs one byte per token of the vocabulary
+    allowed = np.zeros(bitmask_row.shape[0] * 32, dtype=np.bool_)
+    allowed[np.asarray(allowed_tokens, dtype=np.int64)] = True
+    packed = np.packbits(allowed, bitorder="little").view(np.uint32)
+    np.bitwise_or(bitmask_row, packed, out=bitmask_row)
+
+
+def apply_token_bitmask(logits: torch.Tensor, bitmask: np.ndarray) -> None:
+    """Mask the logits of the disallowed tokens in place.
+
+    On CPU the bitmask is unpacked by numpy straight into a boolean mask of
+    the disallowed tokens. On other devices only the packed bitmask is copied
+    to the device, where it is unpacked byte by byte. Every row is then
+    masked with a single `masked_fill_`.
+
+    Args:
+        logits: A `(batch_size, vocab_size)` tensor of logits.
+        bitmask: A packed bitmask with the same number of rows as `logits`.
+    """
+    batch_size, vocab_size = logits.shape
+    # The words are little-endian, so bit `i % 8` of byte `i // 8` is token `i`
+    packed = bitmask.view(np.uint8)
+    if logits.device.type == "cpu":
+        disallowed = np.unpackbits(
+            ~packed, axis=1, count=vocab_size, bitorder="little"
+        ).view(np.bool_)
+        logits.masked_fill_(torch.from_numpy(disallowed), -torch.inf)
+        return
+
+    packed = torch.from_numpy(packed).to(logits.device, non_blocking=True)
+    shifts = torch.arange(8, dtype=torch.uint8, device=logits.device)
+    allowed = (packed.unsqueeze(-1) >> shifts) & 1
+    allowed = allowed.view(batch_size, -1)[:, :vocab_size]
+    logits.masked_fill_(allowed == 0, -torch.inf)
@@ -0,0 +1,251 @@
+"""DotLLM canonicalization and validation of the structure definitions.
+
+The compilation key is a hash of the structure definition, so the same JSON
+schema sent with different whitespace, key order or `definitions` layout by
+different client SDKs would be compiled and stored several times. We rewrite
+every definition into a canonical form before computing its key.
+
+This is also where we reject malformed definitions: it takes microseconds
+here, while a failed compilation occupies a worker for much longer.
+
+"""
+
+import json
+from typing import Any, Callable, Union
+
+
+# Keywords whose value is a schema
+SCHEMA_KEYWORDS = {
+    "additionalItems",
+    "additionalProperties",
+    "contains",
+    "else",
+    "if",
+    "items",
+    "not",
+    "propertyNames",
+    "then",
+    "unevaluatedItems",
+    "unevaluatedProperties",
+}
+
+# Keywords whose value is a list of schemas
+SCHEMA_LIST_KEYWORDS = {"allOf", "anyOf", "oneOf", "prefixItems"}
+
+# Keywords whose value maps names to schemas, in an order that does not matter.
+# The order of `properties` is the order of the fields in the generated object,
+# so it is preserved.
+SCHEMA_MAP_KEYWORDS = {"$defs", "definitions", "dependentSchemas", "patternProperties"}
+
+
+def canonicalize_json_schema(schema: Union[str, dict]) -> str:
+    """Return the canonical serialization of a JSON schema.
+
+    Keys are sorted, except for the keys of `properties`, whitespace is
+    removed, and `definitions` is renamed to `$defs` along with the references
+    to it.
+
+    Args:
+        schema: The JSON schema, serialized or not.
+
+    Returns:
+        The canonical serialization of the schema.
+
+    Raises:
+        ValueError: If the schema is not valid JSON, is not an object or a
+            boolean, or contains a local reference that does not resolve.
+
+    """
+    if isinstance(schema, str):
+        try:
+            schema = json.loads(schema)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"The JSON schema is not valid JSON: {e}") from e
+
+    if not isinstance(schema, (dict, bool)):
+        raise ValueError(
+            f"A JSON schema must be an object or a boolean, got {type(schema).__name__}"
+        )
+
+    if isinstance(schema, dict) and "definitions" in schema and "$defs" not in schema:
+        schema = dict(schema)
+        schema["$defs"] = schema.pop("definitions")
+        schema = _rewrite_refs(schema, "#/definitions/", "#/$defs/")
+
+    canonical_schema = _canonicalize(schema)
+    _check_refs(canonical_schema, canonical_schema)
+
+    return json.dumps(canonical_schema, separators=(",", ":"), ensure_ascii=False)
+
+
+def _canonicalize(schema: Any) -> Any:
+    if not isinstance(schema, dict):
+        return schema
+
+    result = {}
+    for key in sorted(schema):
+        value = schema[key]
+        if key == "properties" and isinstance(value, dict):
+            result[key] = {name: _canonicalize(sub) for name, sub in value.items()}
+        elif key in SCHEMA_MAP_KEYWORDS and isinstance(value, dict):
+            result[key] = {name: _canonicalize(value[name]) for name in sorted(value)}
+        elif key in SCHEMA_LIST_KEYWORDS and isinstance(value, list):
+            result[key] = [_canonicalize(sub) for sub in value]
+        elif key in SCHEMA_KEYWORDS and isinstance(value, list):
+            result[key] = [_canonicalize(sub) for sub in value]
+        elif key in SCHEMA_KEYWORDS:
+            result[key] = _canonicalize(value)
+        else:
+            # `const`, `enum`, `default`... are values, not schemas
+            result[key] = value
+    return result
+
+
+def _map_subschemas(schema: dict, func: Callable[[Any], Any]) -> dict:
+    """Apply `func` to the subschemas of `schema`, and copy the other values.
+
+    Only the values of the schema keywords are subschemas: `$ref` inside
+    `const`, `enum`, `default` or `examples` is data.
+
+    """
+    result = {}
+    for key, value in schema.items():
+        if (key == "properties" or key in SCHEMA_MAP_KEYWORDS) and isinstance(
+            value, dict
+        ):
+            result[key] = {name: func(sub) for name, sub in value.items()}
+        elif (key in SCHEMA_LIST_KEYWORDS or key in SCHEMA_KEYWORDS) and isinstance(
+            value, list
+        ):
+            result[key] = [func(sub) for sub in value]
+        elif key in SCHEMA_KEYWORDS:
+            result[key] = func(value)
+        else:
+            result[key] = value
+    return result
+
+
+def _rewrite_refs(schema: Any, old_prefix: str, new_prefix: str) -> Any:
+    if not isinstance(schema, dict):
+        return schema
+
+    schema = _map_subschemas(
+        schema, lambda sub: _rewrite_refs(sub, old_prefix, new_prefix)
+    )
+    ref = schema.get("$ref")
+    if isinstance(ref, str) and ref.startswith(old_prefix):
+        schema["$ref"] = new_prefix + ref[len(old_prefix) :]
+    return schema
+
+
+def _check_refs(schema: Any, root: Any) -> Any:
+    """Check that the local references resolve to a definition in the schema."""
+    if not isinstance(schema, dict):
+        return schema
+
+    ref = schema.get("$ref")
+    if isinstance(ref, str) and ref.startswith("#"):
+        target = root
+        for part in ref[1:].split("/")[1:]:
+            part = part.replace("~1", "/").replace("~0", "~")
+            if isinstance(target, dict) and part in target:
+                target = target[part]
+            elif isinstance(target, list) and part.isdigit():
+                if int(part) >= len(target):
+                    raise ValueError(f"The reference {ref} cannot be resolved")
+                target = target[int(part)]
+            else:
+                raise ValueError(f"The reference {ref} cannot be resolved")
+
+    return _map_subschemas(schema, lambda sub: _check_refs(sub, root))
+
+
+def canonicalize_regex(regex: str) -> str:
+    """Return the canonical form of a regular expression.
+
+    The guide matches the whole output, so `^` at the start of the pattern and
+    `$` at its end are implied and removed, and so are non-capturing groups
+    that wrap the whole pattern, e.g. `^(?:[0-9]+)$` becomes `[0-9]+`. Very
+    few other rewrites of a regular expression are always safe, so the
+    pattern is otherwise kept as is.
+
+    Raises:
+        ValueError: If the regular expression is empty.
+
+    """
+    if not isinstance(regex, str) or not regex:
+        raise ValueError("The regular expression must be a non-empty string")
+
+    while True:
+        stripped = regex
+        if stripped.startswith("^"):
+            stripped = stripped[1:]
+        if stripped.endswith("$") and not _is_escaped(stripped, len(stripped) - 1):
+            stripped = stripped[:-1]
+        if stripped.startswith("(?:") and _closing_paren(stripped) == len(stripped) - 1:
+            stripped = stripped[3:-1]
+        if not stripped or stripped == regex:
+            return regex
+        regex = stripped
+
+
+def _is_escaped(regex: str, position: int) -> bool:
+    """Return whether the character at `position` is escaped by a backslash."""
+    start = position
+    while start > 0 and regex[start - 1] == "\\":
+        start -= 1
+    return (position - start) % 2 == 1
+
+
+def _closing_paren(regex: str) -> int:
+    """Return the position of the parenthesis that closes the group at 0, or -1."""
+    depth = 0
+    in_class = False
+    i = 0
+    while i < len(regex):
+        char = regex[i]
+        if char == "\\":
+            i += 2
+            continue
+        if in_class:
+            in_class = char != "]"
+        elif char == "[":
+            in_class = True
+            # A `]` right after `[` or `[^` is a literal
+            if regex[i + 1 : i + 2] == "^":
+                i += 1
+            if regex[i + 1 : i + 2] == "]":
+                i += 1
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth == 0:
+                return i
+        i += 1
+    return -1
+
+
+def canonicalize_grammar(grammar: str) -> str:
+    """Return the canonical form of a Lark grammar.
+
+    Line endings are normalized, trailing whitespace and comment lines are
+    removed, and so are blank lines.
+
+    Raises:
+        ValueError: If the grammar is empty.
+
+    """
+    if not isinstance(grammar, str):
+        raise ValueError("The grammar must be a string")
+
+    lines = []
+    for line in grammar.replace("\r\n", "\n").replace("\r", "\n").split("\n"):
+        line = line.rstrip()
+        if not line or line.lstrip().startswith("//"):
+            continue
+        lines.append(line)
+
+    if not lines:
+        raise ValueError("The grammar is empty")
+    return "\n".join(lines)
@@ -1,13 +1,35 @@
 """DotLLM CompilationManager for non-blocking logits processor compilation."""
 
+import asyncio
 import hashlib
 import logging
-from concurrent.futures import ProcessPoolExecutor
-from typing import Callable
+import threading
+import time
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from dotllm import metrics
+from dotllm.compilation_queue import CompilationQueue
+from dotllm.compression import CompressedIndex, get_codec
+from dotllm.config import DotConfig
+from dotllm.disk_cache import DiskCache
+from dotllm.executors import CompilationLimitError, CompilationLimits, make_executor
+from dotllm.index_store import IndexStore, live_sizeof
+from dotllm.mask_cache import MaskCache
+from dotllm.request_timings import RequestTimings
 
 logger = logging.getLogger("dotllm.compilation_manager")
 
 
+class CompilationError(ValueError):
+    """Raised when an index fails to compile.
+
+    This subclasses `ValueError` so that vLLM's OpenAI server returns it to
+    the client as a bad request instead of an internal error.
+
+    """
+
+
 def make_key(model_name: str, schema: str):
     return hashlib.sha256(f"{model_name}:{schema}".encode("utf-8")).hexdigest()
 
@@ -15,43 +37,268 @@ def make_key(model_name: str, schema: str):
 class CompilationManager:
     """Manager for asynchronous compilation tasks.
 
-    `CompilationManager` provides a process pool for running compilation tasks
-    in the background.
+    `CompilationManager` provides an executor for running compilation tasks
+    in the background, by default a process pool (see `dotllm.executors`).
 
     To be able to run compilation in a process pool we need to
     serialize/deserialize the index, which might incur a performance penalty:
-    https://github.com/dottxt-ai/dotregex/issues/335.
+    https://github.com/dottxt-ai/dotregex/issues/335. To limit the copies the
+    workers write the serialized index to shared memory and the engine maps it
+    read-only, see `SharedIndex`. The `thread` and `inline` executors keep the
+    index objects and avoid serialization altogether.
+
+    Compiled indexes are also written to an on-disk cache that is shared across
+    restarts and across the servers running on the same host. The disk cache is
+    checked before submitting work to the process pool.
+
+    Indexes are kept in memory in an `IndexStore` with a byte budget and an
+    entry cap. Every call to `submit` pins the index so it cannot be evicted
+    while the request that uses it is in flight; callers must call `release`
+    once the request is finished.
+
+    Deserializing an index is expensive, so the manager also keeps the live,
+    deserialized index objects so that requests that share a schema only
+    need to build a lightweight `Guide` over the shared index. Live indexes
+    are dropped when the corresponding serialized index is evicted.
+
+    Compilations go through a `CompilationQueue`, which runs them by priority
+    and tenant. A queued compilation is cancelled once its index has no pins
+    left, since no in-flight request is waiting for it anymore.
+
+    Compilations that exceed the time or memory limits are killed, and their
+    key is rejected for `compile_failure_ttl` seconds so that the same bad
+    schema cannot monopolize the workers again.
+
+    The token masks of the guide states are cached in a `MaskCache` shared by
+    the logits processors of all the requests.
+
+    When the served model is known each process worker imports the backends
+    and builds the model's vocabulary once, when it starts, and `warmup` starts
+    all the workers ahead of the first request.
 
     A production version would include a `CachingManager` class that handles
     caching better than what I did here.
 
     """
 
-    def __init__(self):
-        """Initialize the CompilationManager."""
-        self.process_pool = ProcessPoolExecutor()
-        self._indexes = {}
+    def __init__(
+        self, config: Optional[DotConfig] = None, model_name: Optional[str] = None
+    ):
+        """Initialize the CompilationManager.
+
+        Args:
+            config: The DotLLM configuration.
+            model_name: The name of the served model, whose vocabulary is
+                preloaded in every worker.
+        """
+        config = config or DotConfig()
+        # Only the indexes serialized by the process workers are compressed
+        self.codec = None
+        if config.compile_mode == "process":
+            self.codec = get_codec(config.index_codec)
+        elif config.index_codec != "none":
+            logger.warning(f"Indexes are not compressed in {config.compile_mode} mode")
+        self.executor = make_executor(
+            config.compile_mode,
+            config.compile_workers,
+            config.shared_memory_dir,
+            model_name,
+            CompilationLimits(
+                config.compile_timeout,
+                config.compile_max_rss_bytes,
+                config.compile_max_tasks_per_worker,
+            ),
+            self.codec,
+        )
+        self.num_workers = self.executor.num_workers
+        self._queue = CompilationQueue(
+            self.executor, self.num_workers, config.compile_tenant_limit
+        )
+        self._indexes = IndexStore(
+            config.index_cache_max_bytes,
+            config.index_cache_max_entries,
+            on_evict=self._on_evict,
+        )
+        self.mask_cache = MaskCache(config.mask_cache_max_bytes)
+        metrics.mask_cache_bytes.set_function(lambda: self.mask_cache.num_bytes)
+        metrics.index_cache_bytes.set_function(lambda: self._indexes.num_bytes)
+        metrics.index_cache_entries.set_function(lambda: len(self._indexes))
         self._futures = {}
+        self._failures = {}
+        # Pinning and joining a compilation, and unpinning and cancelling
+        # it, happen under this lock so a new request cannot join a
+        # compilation that is being cancelled
+        self._submit_lock = threading.Lock()
+        self._rejected = {}
+        self.failure_ttl = config.compile_failure_ttl
+        self._live_indexes = {}
+        self._live_indexes_lock = threading.Lock()
+        self._live_index_locks = {}
+        self.live_index_hits = 0
+        self.live_index_misses = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        self.disk_cache = None
+        self._disk_writer = None
+        if config.disk_cache_dir and config.disk_cache_max_bytes > 0:
+            self.disk_cache = DiskCache(
+                config.disk_cache_dir,
+                config.disk_cache_max_bytes,
+                self.codec.name if self.codec is not None else None,
+            )
+            # Writes lock the cache directory, fsync and evict old entries, so
+            # they run in their own thread rather than in the executor's
+            # callbacks, which dispatch the next queued compilation.
+            self._disk_writer = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="dotllm-disk-cache"
+            )
+
+    def warmup(self):
+        """Start all the workers and wait until they are initialized."""
+        self.executor.warmup()
+
+    def shutdown(self):
+        """Stop the workers and release the indexes held in shared memory."""
+        self.executor.shutdown()
+        if self._disk_writer is not None:
+            self._disk_writer.shutdown(wait=True)
+        self._indexes.clear()
+
+    def submit(
+        self,
+        func: Callable,
+        model_name: str,
+        schema: str,
+        fingerprint: str = "",
+        priority: int = 0,
+        tenant: Optional[str] = None,
+        timings: Optional[RequestTimings] = None,
+    ) -> str:
+        """Submit a task to be executed by the executor.
 
-    def submit(self, func: Callable, model_name: str, schema: str) -> str:
-        """Submit a task to be executed in the process pool.
+        The task is not submitted if the index is already compiled or being
+        compiled, or if it can be found in the disk cache.
 
         Args:
-            func: The function to execute in the process pool.
+            func: The function that compiles the index.
             model_name: The name of the model.
             schema: The schema or pattern to compile.
-            guide_creator: Function to create a Guide from a deserialized Index.
+            fingerprint: The fingerprint of the tokenizer's vocabulary, used
+                to key the disk cache.
+            priority: The priority of the request. Lower values go first.
+            tenant: The tenant that sent the request, e.g. its LoRA adapter.
+            timings: The timings of the request, where the index cache lookup
+                is recorded.
 
         Returns:
-            A key representing the compilation task.
+            A key representing the compilation task. The index is pinned until
+            `release` is called with this key.
+
+        Raises:
+            CompilationError: If the same schema recently exceeded the
+                compilation limits.
         """
-        logger.info(f"Compiling schema: {schema[:50]}")
         key = make_key(model_name, schema)
-        if key not in self._futures and key not in self._indexes:
-            self._futures[key] = self.process_pool.submit(func, model_name, schema)
+        rejected = self._rejected.get(key)
+        if rejected is not None:
+            expires_at, error = rejected
+            if time.monotonic() < expires_at:
+                raise CompilationError(f"Guide compilation failed: {error}")
+            del self._rejected[key]
+
+        if timings is not None:
+            timings.compilation_key = key
+            timings.index_cache = "memory"
+
+        with self._submit_lock:
+            self._indexes.pin(key)
+            if key in self._futures:
+                self._queue.join(key, priority)
+                self.cache_hits += 1
+                metrics.index_cache_hits.labels(tier="memory").inc()
+                return key
+        if key in self._indexes:
+            self.cache_hits += 1
+            metrics.index_cache_hits.labels(tier="memory").inc()
+            return key
+
+        if self.disk_cache is not None:
+            serialized_index = self.disk_cache.get(key, fingerprint)
+            if serialized_index is not None:
+                logger.info(f"Loaded index from the disk cache: {schema[:50]}")
+                if self.codec is not None:
+                    serialized_index = CompressedIndex(serialized_index, self.codec)
+                self._indexes.put(key, serialized_index)
+                self.cache_hits += 1
+                metrics.index_cache_hits.labels(tier="disk").inc()
+                if timings is not None:
+                    timings.index_cache = "disk"
+                return key
+
+        self.cache_misses += 1
+        if timings is not None:
+            timings.index_cache = "miss"
+        metrics.index_cache_misses.inc()
+        logger.info(f"Compiling schema: {schema[:50]}")
+        with self._submit_lock:
+            self._failures.pop(key, None)
+            # Another request may have submitted the compilation in the meantime
+            future = self._futures.get(key)
+            if future is not None:
+                self._queue.join(key, priority)
+                return key
+            future = self._queue.submit(key, func, model_name, schema, priority, tenant)
+            self._futures[key] = future
+        future.add_done_callback(lambda future: self._on_done(key, future))
+        if self.disk_cache is not None:
+            future.add_done_callback(
+                lambda future: self._write_to_disk(key, fingerprint, future)
+            )
 
         return key
 
+    def _on_done(self, key: str, future: Future):
+        """Store the compiled index, or forget or reject the failed compilation.
+
+        A compilation that was already running when all its requests went away
+        still completes. Its index is stored here rather than by `get_index`,
+        which nobody calls anymore, so that it counts against the budget of
+        the `IndexStore` and is closed when it is evicted.
+        """
+        if not future.cancelled() and future.exception() is None:
+            self._indexes.put(key, future.result())
+            self._discard_future(key, future)
+            return
+
+        if not future.cancelled() and isinstance(
+            future.exception(), CompilationLimitError
+        ):
+            now = time.monotonic()
+            self._rejected = {k: v for k, v in self._rejected.items() if v[0] > now}
+            if self.failure_ttl > 0:
+                self._rejected[key] = (now + self.failure_ttl, future.exception())
+        # The requests that are already pinned get the error from `get_index`,
+        # and the next request compiles again rather than joining a job that
+        # no longer exists
+        if self._indexes.is_pinned(key):
+            self._failures[key] = future
+        self._discard_future(key, future)
+
+    def _write_to_disk(self, key: str, fingerprint: str, future: Future):
+        """Hand a compiled index over to the disk cache writer thread."""
+        if future.cancelled() or future.exception() is not None:
+            return
+        self._disk_writer.submit(self._put_on_disk, key, fingerprint, future.result())
+
+    def _put_on_disk(self, key: str, fingerprint: str, serialized_index):
+        """Write a compiled index to the disk cache, in the writer thread."""
+        try:
+            self.disk_cache.put(key, fingerprint, serialized_index.to_buffer())
+        except ValueError:
+            # The index was evicted and unmapped before it could be written
+            logger.debug(f"Index {key[:12]} was evicted before being cached on disk")
+
     def get_index(self, key: str):
         """Get the index corresponding to `key`
 
@@ -61,16 +308,185 @@ class CompilationManager:
         Returns:
             A serialized index
         """
-        if key in self._indexes:
-            return self._indexes[key]
+        serialized_index = self._indexes.get(key)
+        if serialized_index is not None:
+            return serialized_index
 
+        future = self._futures.get(key) or self._failures.get(key)
+        if future is None:
+            # The compilation finished and `_on_done` stored the index since
+            return self._indexes.get(key)
+        start = time.perf_counter()
         try:
-            serialized_index = self._futures[key].result()
+            serialized_index = future.result()
+        except CancelledError as e:
+            raise CompilationError("Guide compilation was cancelled") from e
+        except Exception as e:
+            self._discard_future(key, future)
+            logger.error(f"Guide compilation failed: {e}")
+            raise e
+        finally:
+            metrics.index_wait.labels(mode="sync").observe(time.perf_counter() - start)
 
-            self._indexes[key] = serialized_index
-            del self._futures[key]
+        self._indexes.put(key, serialized_index)
+        self._discard_future(key, future)
+
+        return serialized_index
+
+    async def get_index_async(self, key: str):
+        """Get the index corresponding to `key` without blocking the event loop.
+
+        The compilation is shielded so that a cancelled waiter (e.g. a client
+        disconnecting) does not cancel the compilation for the other waiters.
+
+        Args:
+            key: The index's key
+
+        Returns:
+            A serialized index
 
+        Raises:
+            CompilationError: If the compilation failed.
+        """
+        serialized_index = self._indexes.get(key)
+        if serialized_index is not None:
             return serialized_index
+
+        future = self._futures.get(key) or self._failures.get(key)
+        if future is None:
+            # The compilation finished and `_on_done` stored the index since
+            return self._indexes.get(key)
+        start = time.perf_counter()
+        try:
+            serialized_index = await asyncio.shield(asyncio.wrap_future(future))
+        except asyncio.CancelledError as e:
+            if not future.cancelled():
+                # This request was cancelled, not the compilation
+                raise
+            raise CompilationError("Guide compilation was cancelled") from e
         except Exception as e:
+            self._discard_future(key, future)
             logger.error(f"Guide compilation failed: {e}")
-            raise e
+            raise CompilationError(f"Guide compilation failed: {e}") from e
+        finally:
+            metrics.index_wait.labels(mode="async").observe(time.perf_counter() - start)
+
+        self._indexes.put(key, serialized_index)
+        self._discard_future(key, future)
+
+        return serialized_index
+
+    def _discard_future(self, key: str, future: Future):
+        """Forget a finished compilation, so that a failed one can be retried."""
+        if self._futures.get(key) is future:
+            del self._futures[key]
+
+    def get_live_index(self, key: str, load_index: Callable[[Any], Any]):
+        """Get the deserialized index corresponding to `key`.
+
+        The index is deserialized only the first time it is requested, and
+        then shared by all the requests that use it. Waiting for the
+        compilation and deserializing only hold a lock on `key`, so the
+        lookups of the other indexes are not blocked. The deserialized index
+        is charged to the budget of the `IndexStore`, and dropped with its
+        entry.
+
+        Args:
+            key: The index's key
+            load_index: Function that deserializes the index.
+
+        Returns:
+            A deserialized index
+        """
+        with self._live_indexes_lock:
+            index = self._live_indexes.get(key)
+            if index is not None:
+                self.live_index_hits += 1
+                return index
+            key_lock = self._live_index_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            # Another request may have loaded the index while we waited
+            with self._live_indexes_lock:
+                index = self._live_indexes.get(key)
+                if index is not None:
+                    self.live_index_hits += 1
+                    return index
+                self.live_index_misses += 1
+
+            try:
+                serialized_index = self.get_index(key)
+                start = time.perf_counter()
+                index = serialized_index.load(load_index)
+                metrics.index_load_duration.observe(time.perf_counter() - start)
+                if isinstance(serialized_index, CompressedIndex):
+                    logger.info(
+                        f"Decompressed index {key[:12]} with "
+                        f"{serialized_index.codec.name}: {len(serialized_index)} "
+                        f"-> {serialized_index.decompressed_size} bytes "
+                        f"({serialized_index.compression_ratio:.1f}x) in "
+                        f"{serialized_index.decompress_time * 1e3:.1f} ms"
+                    )
+                with self._live_indexes_lock:
+                    self._live_indexes[key] = index
+                # Charging can evict, and `_on_evict` takes the lock of the
+                # live indexes, so it is called without holding it
+                if not self._indexes.charge(
+                    key, serialized_index, live_sizeof(serialized_index)
+                ):
+                    # The entry was evicted while the index was deserialized
+                    with self._live_indexes_lock:
+                        if self._live_indexes.get(key) is index:
+                            del self._live_indexes[key]
+                return index
+            finally:
+                with self._live_indexes_lock:
+                    self._live_index_locks.pop(key, None)
+
+    def _on_evict(self, key: str, compiled_index):
+        """Drop the live index and unmap the serialized index when it is evicted."""
+        with self._live_indexes_lock:
+            self._live_indexes.pop(key, None)
+        compiled_index.close()
+        metrics.index_cache_evictions.inc()
+
+    def stats(self) -> dict:
+        """Return statistics about the compiled indexes.
+
+        Returns:
+            A dictionary with the number of indexes and bytes held in memory,
+            the hits and misses of the compilation cache (in memory or on
+            disk), the hits and misses of the live index cache, the number of
+            compilations killed and of schemas rejected for exceeding the
+            limits, and the statistics of the compilation queue and of the
+            mask cache.
+        """
+        return {
+            **self._queue.stats(),
+            **self.mask_cache.stats(),
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "num_indexes": len(self._indexes),
+            "num_bytes": self._indexes.num_bytes,
+            "num_live_indexes": len(self._live_indexes),
+            "live_index_hits": self.live_index_hits,
+            "live_index_misses": self.live_index_misses,
+            "num_killed_compilations": self.executor.num_killed,
+            "num_rejected_schemas": len(self._rejected),
+        }
+
+    def release(self, key: str):
+        """Release the pin taken on `key` by `submit`.
+
+        If the index is still queued for compilation and no other request is
+        waiting for it, i.e. the index has no pins left, the compilation is
+        cancelled.
+
+        Args:
+            key: The index's key
+        """
+        with self._submit_lock:
+            if self._indexes.unpin(key) > 0:
+                return
+            self._failures.pop(key, None)
+            self._queue.cancel(key)
@@ -0,0 +1,235 @@
+"""DotLLM priority queue of compilation jobs."""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+from dotllm import metrics
+from dotllm.executors import CompilationExecutor, CompilationLimitError
+
+
+logger = logging.getLogger("dotllm.compilation_queue")
+
+DEFAULT_TENANT = "default"
+
+
+@dataclass
+class CompilationJob:
+    key: str
+    func: Callable
+    model_name: str
+    schema: str
+    priority: int
+    tenant: str
+    future: Future = field(default_factory=Future)
+    enqueued_at: float = field(default_factory=time.perf_counter)
+    dispatched_at: float = 0.0
+    running: bool = False
+
+
+class CompilationQueue:
+    """Priority queue in front of the compilation executor.
+
+    Jobs are dispatched to the executor by priority (lower values first, like
+    vLLM's `priority` argument) and then in arrival order, with at most
+    `max_running` jobs running at once and at most `tenant_limit` per tenant,
+    so that a flood of one-off schemas from one tenant cannot starve the
+    others.
+
+    Requests that need the same index share the same job. The queue does not
+    count them: the `CompilationManager` knows which requests hold the index,
+    and cancels the queued job when the last of them goes away (the requests
+    were aborted or the clients disconnected). Running jobs cannot be
+    interrupted and run to completion; their index is cached.
+
+    """
+
+    def __init__(
+        self, executor: CompilationExecutor, max_running: int, tenant_limit: int = 0
+    ):
+        """Initialize the CompilationQueue.
+
+        Args:
+            executor: The executor that compiles the indexes.
+            max_running: The maximum number of jobs running at once.
+            tenant_limit: The maximum number of jobs running at once for a
+                single tenant. 0 means no limit.
+        """
+        self.executor = executor
+        self.max_running = max_running
+        self.tenant_limit = tenant_limit
+        self._heap = []
+        self._counter = itertools.count()
+        self._jobs = {}
+        self._num_running = 0
+        self._running_per_tenant = defaultdict(int)
+        self._wait_times = defaultdict(lambda: [0, 0.0, 0.0])
+        self._lock = threading.Lock()
+
+        metrics.compile_queue_depth.set_function(
+            lambda: len(self._jobs) - self._num_running
+        )
+        metrics.compile_running.set_function(lambda: self._num_running)
+
+    def submit(
+        self,
+        key: str,
+        func: Callable,
+        model_name: str,
+        schema: str,
+        priority: int = 0,
+        tenant: Optional[str] = None,
+    ) -> Future:
+        """Queue a compilation job, or join the job already queued for `key`.
+
+        Args:
+            key: The index's key
+            func: The function that compiles the index.
+            model_name: The name of the model.
+            schema: The schema or pattern to compile.
+            priority: The priority of the request. Lower values go first.
+            tenant: The tenant that sent the request.
+
+        Returns:
+            A future whose result is the compiled index.
+        """
+        with self._lock:
+            # Looked up under the lock, so the job cannot finish or be
+            # cancelled between the lookup and the new waiter
+            job = self._jobs.get(key)
+            if job is not None:
+                self._raise_priority(job, priority)
+            else:
+                job = CompilationJob(
+                    key, func, model_name, schema, priority, tenant or DEFAULT_TENANT
+                )
+                self._jobs[key] = job
+                heapq.heappush(self._heap, (priority, next(self._counter), job))
+
+        self._dispatch()
+        return job.future
+
+    def join(self, key: str, priority: int = 0):
+        """Wait for the job of `key` too, if it is queued or running.
+
+        Args:
+            key: The index's key
+            priority: The priority of the new waiter.
+        """
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None:
+                return
+            self._raise_priority(job, priority)
+
+        self._dispatch()
+
+    def _raise_priority(self, job: CompilationJob, priority: int):
+        """Raise the priority of a queued `job`. Called with the lock held."""
+        if not job.running and priority < job.priority:
+            # The old heap entry is skipped when popped
+            job.priority = priority
+            heapq.heappush(self._heap, (priority, next(self._counter), job))
+
+    def cancel(self, key: str):
+        """Cancel the job of `key` if it has not started yet."""
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None or job.running:
+                return
+            # The heap entry is skipped when popped
+            del self._jobs[key]
+
+        logger.info(f"Cancelled the compilation of {key[:12]}: no request is waiting")
+        job.future.cancel()
+
+    def _dispatch(self):
+        """Start the queued jobs while there are free slots."""
+        to_start = []
+        with self._lock:
+            skipped = []
+            while self._heap and self._num_running + len(to_start) < self.max_running:
+                priority, count, job = heapq.heappop(self._heap)
+                if self._jobs.get(job.key) is not job or job.running:
+                    continue
+                if priority != job.priority:
+                    continue
+                if (
+                    self.tenant_limit > 0
+                    and self._running_per_tenant[job.tenant] >= self.tenant_limit
+                ):
+                    skipped.append((priority, count, job))
+                    continue
+
+                job.running = True
+                job.dispatched_at = time.perf_counter()
+                self._running_per_tenant[job.tenant] += 1
+                stats = self._wait_times[priority]
+                wait_time = job.dispatched_at - job.enqueued_at
+                metrics.compile_queue_wait.observe(wait_time)
+                stats[0] += 1
+                stats[1] += wait_time
+                stats[2] = max(stats[2], wait_time)
+                to_start.append(job)
+
+            for entry in skipped:
+                heapq.heappush(self._heap, entry)
+            self._num_running += len(to_start)
+
+        for job in to_start:
+            future = self.executor.submit(job.func, job.model_name, job.schema)
+            future.add_done_callback(lambda future, job=job: self._on_done(job, future))
+
+    def _on_done(self, job: CompilationJob, future: Future):
+        with self._lock:
+            self._num_running -= 1
+            self._running_per_tenant[job.tenant] -= 1
+            if self._jobs.get(job.key) is job:
+                del self._jobs[job.key]
+
+        if future.cancelled():
+            status = "cancelled"
+            job.future.cancel()
+        elif future.exception() is not None:
+            if isinstance(future.exception(), CompilationLimitError):
+                status = "killed"
+            else:
+                status = "error"
+            job.future.set_exception(future.exception())
+        else:
+            status = "success"
+            job.future.set_result(future.result())
+
+        metrics.compile_duration.labels(
+            backend=metrics.backend_label(job.func), status=status
+        ).observe(time.perf_counter() - job.dispatched_at)
+
+        self._dispatch()
+
+    def stats(self) -> dict:
+        """Return the queue depth and the wait times per priority.
+
+        Returns:
+            A dictionary with the number of queued and running jobs, and for
+            each priority the number of dispatched jobs and their mean and
+            maximum wait time in the queue, in seconds.
+        """
+        with self._lock:
+            return {
+                "queue_depth": sum(not job.running for job in self._jobs.values()),
+                "num_running": self._num_running,
+                "wait_times": {
+                    priority: {
+                        "count": count,
+                        "mean": total / count,
+                        "max": maximum,
+                    }
+                    for priority, (count, total, maximum) in self._wait_times.items()
+                },
+            }
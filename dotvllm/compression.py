@@ -0,0 +1,166 @@
+"""DotLLM compression of the serialized indexes.
+
+Serialized indexes for large vocabularies take hundreds of megabytes, and the
+`IndexStore` keeps them in memory so that new requests with a known schema do
+not wait for a compilation. With `--guided-index-codec` the compilation
+workers compress the indexes before writing them to shared memory, and they
+are only decompressed when the index is deserialized to build a guide. More
+schemas fit in the store's byte budget, at the cost of a decompression on the
+first request that uses an index after it was compiled or loaded from disk.
+
+`zlib` is always available; `zstd` and `lz4` need the `zstandard` and `lz4`
+packages (`pip install dotvllm[compression]`).
+
+"""
+
+import logging
+import time
+import zlib
+from typing import Any, Callable, Optional
+
+from dotllm import metrics
+
+
+logger = logging.getLogger("dotllm.compression")
+
+
+class Codec:
+    """Compress and decompress serialized indexes."""
+
+    name = "none"
+
+    def compress(self, data) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, data) -> bytes:
+        raise NotImplementedError
+
+
+class ZlibCodec(Codec):
+    name = "zlib"
+
+    def compress(self, data) -> bytes:
+        return zlib.compress(data, 1)
+
+    def decompress(self, data) -> bytes:
+        return zlib.decompress(data)
+
+
+class ZstdCodec(Codec):
+    name = "zstd"
+
+    def __init__(self):
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError(
+                "The zstd codec needs the `zstandard` package: "
+                "pip install zstandard"
+            ) from e
+        self._zstandard = zstandard
+
+    def compress(self, data) -> bytes:
+        return self._zstandard.ZstdCompressor(level=3).compress(data)
+
+    def decompress(self, data) -> bytes:
+        # The frames written by `compress` contain the decompressed size
+        return self._zstandard.ZstdDecompressor().decompress(data)
+
+
+class Lz4Codec(Codec):
+    name = "lz4"
+
+    def __init__(self):
+        try:
+            import lz4.frame
+        except ImportError as e:
+            raise ImportError(
+                "The lz4 codec needs the `lz4` package: pip install lz4"
+            ) from e
+        self._lz4_frame = lz4.frame
+
+    def compress(self, data) -> bytes:
+        return self._lz4_frame.compress(data)
+
+    def decompress(self, data) -> bytes:
+        return self._lz4_frame.decompress(data)
+
+
+CODECS = {"zlib": ZlibCodec, "zstd": ZstdCodec, "lz4": Lz4Codec}
+
+
+def get_codec(name: Optional[str]) -> Optional[Codec]:
+    """Return the codec called `name`, or None if the indexes are not compressed.
+
+    Args:
+        name: One of `none`, `zlib`, `zstd` or `lz4`.
+
+    Raises:
+        ValueError: If the codec is unknown.
+        ImportError: If the package needed by the codec is not installed.
+    """
+    if name is None or name == "none":
+        return None
+    if name not in CODECS:
+        raise ValueError(f"Unknown index codec {name}")
+    return CODECS[name]()
+
+
+class CompressedIndex:
+    """Compressed serialized index, decompressed when it is deserialized.
+
+    It wraps the `SharedIndex` that holds the compressed bytes, and has the
+    same interface, so the `IndexStore` counts the compressed size against
+    its budget and the disk cache stores the compressed bytes.
+
+    """
+
+    def __init__(self, compressed_index, codec: Codec):
+        """Initialize the CompressedIndex.
+
+        Args:
+            compressed_index: The `SharedIndex` that holds the compressed index.
+            codec: The codec used to compress the index.
+        """
+        self.compressed_index = compressed_index
+        self.codec = codec
+        self.decompressed_size: Optional[int] = None
+        self.decompress_time: Optional[float] = None
+
+    def __len__(self) -> int:
+        return len(self.compressed_index)
+
+    @property
+    def compression_ratio(self) -> Optional[float]:
+        """The ratio of the decompressed size to the compressed size, once known."""
+        if self.decompressed_size is None or len(self) == 0:
+            return None
+        return self.decompressed_size / len(self)
+
+    def load(self, load_index: Callable[[Any], Any]) -> Any:
+        """Decompress and deserialize the index.
+
+        Args:
+            load_index: Function that deserializes the index.
+
+        Returns:
+            A deserialized index
+        """
+        start = time.perf_counter()
+        serialized_index = self.codec.decompress(self.compressed_index.to_buffer())
+        self.decompress_time = time.perf_counter() - start
+        self.decompressed_size = len(serialized_index)
+        metrics.index_decompress_duration.labels(codec=self.codec.name).observe(
+            self.decompress_time
+        )
+        metrics.index_compression_ratio.labels(codec=self.codec.name).observe(
+            self.compression_ratio or 0.0
+        )
+        return load_index(serialized_index)
+
+    def to_buffer(self) -> memoryview:
+        """Return the compressed index, e.g. to write it to the disk cache."""
+        return self.compressed_index.to_buffer()
+
+    def close(self):
+        self.compressed_index.close()
@@ -0,0 +1,327 @@
+"""DotLLM configuration and CLI arguments."""
+
+import argparse
+import os
+from dataclasses import dataclass, field, fields
+from typing import Optional
+
+from dotllm.shared_index import default_shared_memory_dir
+
+
+def default_compile_workers() -> int:
+    """Return the default number of compilation workers.
+
+    The engine process and vLLM's own workers need CPU cores too, so we only
+    use half of the available cores, and at most 4.
+
+    """
+    return max(1, min(4, (os.cpu_count() or 1) // 2))
+
+
+def default_cache_dir() -> str:
+    """Return the default directory of the on-disk index cache."""
+    cache_home = os.environ.get(
+        "XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")
+    )
+    return os.path.join(cache_home, "dotvllm", "indexes")
+
+
+# Options of DotLLM's V0 engine that vLLM's V1 engine has no equivalent for,
+# by flag and `DotConfig` field
+V0_ONLY_OPTIONS = {
+    "--guided-masking": "masking",
+    "--guided-mask-prefetch-workers": "mask_prefetch_workers",
+    "--guided-mask-sparse-max-tokens": "mask_sparse_max_tokens",
+    "--guided-mask-complement-max-tokens": "mask_complement_max_tokens",
+    "--guided-mask-cached-sparse-max-tokens": "mask_cached_sparse_max_tokens",
+    "--guided-mask-cached-complement-max-tokens": "mask_cached_complement_max_tokens",
+    "--guided-prewarm": "prewarm_path",
+    "--guided-prewarm-concurrency": "prewarm_concurrency",
+    "--guided-prewarm-wait": "prewarm_wait",
+    "--guided-compile-tenant-limit": "compile_tenant_limit",
+    "--guided-jump-forward": "jump_forward",
+}
+
+
+@dataclass
+class DotConfig:
+    """Configuration of the structured generation components of DotLLM.
+
+    These options are parsed alongside vLLM's own CLI arguments in
+    `api_server.cli_main`, and then passed to the engine.
+
+    """
+
+    engine: str = "v0"
+    disk_cache_dir: Optional[str] = None
+    disk_cache_max_bytes: int = 10 * 1024**3
+    index_cache_max_bytes: int = 4 * 1024**3
+    index_cache_max_entries: int = 1024
+    masking: str = "per-sequence"
+    mask_prefetch_workers: int = 2
+    mask_cache_max_bytes: int = 256 * 1024**2
+    # From `benchmarks/bench_adaptive_masking.py` at a 128k vocabulary on CPU
+    mask_sparse_max_tokens: int = 16384
+    mask_complement_max_tokens: int = 1024
+    mask_cached_sparse_max_tokens: int = 0
+    mask_cached_complement_max_tokens: int = 2048
+    compile_workers: int = field(default_factory=default_compile_workers)
+    prewarm_path: Optional[str] = None
+    prewarm_concurrency: int = 0
+    prewarm_wait: bool = False
+    shared_memory_dir: str = field(default_factory=default_shared_memory_dir)
+    index_codec: str = "none"
+    compile_mode: str = "process"
+    compile_tenant_limit: int = 0
+    compile_timeout: float = 60.0
+    compile_max_rss_bytes: int = 8 * 1024**3
+    compile_max_tasks_per_worker: int = 1000
+    compile_failure_ttl: float = 600.0
+    jump_forward: bool = False
+    request_timings: bool = False
+
+    @staticmethod
+    def add_cli_args(parser: argparse.ArgumentParser) -> argparse.ArgumentParser:
+        """Add the DotLLM arguments to vLLM's argument parser."""
+        group = parser.add_argument_group("DotLLM structured generation")
+        group.add_argument(
+            "--guided-engine",
+            dest="engine",
+            type=str,
+            choices=["v0", "v1"],
+            default=DotConfig.engine,
+            help="The vLLM engine that serves the requests. `v0` uses "
+            "DotLLM's own engine; `v1` plugs our guides into V1's structured "
+            "output backend, and does not support prewarming, jump-forward "
+            "decoding, the masking options nor the compilation tenant limit.",
+        )
+        group.add_argument(
+            "--guided-disk-cache-dir",
+            dest="disk_cache_dir",
+            type=str,
+            default=default_cache_dir(),
+            help="Directory where compiled indexes are cached on disk. The "
+            "cache can be shared by several servers running on the same host.",
+        )
+        group.add_argument(
+            "--guided-disk-cache-max-bytes",
+            dest="disk_cache_max_bytes",
+            type=int,
+            default=DotConfig.disk_cache_max_bytes,
+            help="Maximum size of the on-disk index cache in bytes. Least "
+            "recently used entries are evicted first. Set to 0 to disable "
+            "the on-disk cache.",
+        )
+        group.add_argument(
+            "--guided-cache-max-bytes",
+            dest="index_cache_max_bytes",
+            type=int,
+            default=DotConfig.index_cache_max_bytes,
+            help="Maximum size in bytes of the compiled indexes kept in memory. "
+            "Least recently used indexes are evicted first, except those used "
+            "by in-flight requests.",
+        )
+        group.add_argument(
+            "--guided-cache-max-entries",
+            dest="index_cache_max_entries",
+            type=int,
+            default=DotConfig.index_cache_max_entries,
+            help="Maximum number of compiled indexes kept in memory.",
+        )
+        group.add_argument(
+            "--guided-masking",
+            dest="masking",
+            type=str,
+            choices=["batched", "per-sequence"],
+            default=DotConfig.masking,
+            help="How the token masks are applied to the logits. `batched` "
+            "builds a packed bitmask for all the guided sequences of a step "
+            "and applies it in one operation; `per-sequence` calls each "
+            "sequence's logits processor separately, which is faster on CPU "
+            "(see `benchmarks/bench_masking.py`).",
+        )
+        group.add_argument(
+            "--guided-mask-prefetch-workers",
+            dest="mask_prefetch_workers",
+            type=int,
+            default=DotConfig.mask_prefetch_workers,
+            help="Number of threads that compute the next token masks while "
+            "the model runs the forward pass. Set to 0 to compute the masks "
+            "after the forward pass.",
+        )
+        group.add_argument(
+            "--guided-mask-cache-max-bytes",
+            dest="mask_cache_max_bytes",
+            type=int,
+            default=DotConfig.mask_cache_max_bytes,
+            help="Maximum size in bytes of the cache of token masks per guide "
+            "state, shared by the requests that use the same index. Least "
+            "recently used masks are evicted first. Set to 0 to disable.",
+        )
+        group.add_argument(
+            "--guided-mask-sparse-max-tokens",
+            dest="mask_sparse_max_tokens",
+            type=int,
+            default=DotConfig.mask_sparse_max_tokens,
+            help="With `--guided-masking per-sequence` and the mask cache "
+            "disabled, keep only the logits of the allowed tokens, over a row "
+            "of `-inf`, when at most this many tokens are allowed.",
+        )
+        group.add_argument(
+            "--guided-mask-complement-max-tokens",
+            dest="mask_complement_max_tokens",
+            type=int,
+            default=DotConfig.mask_complement_max_tokens,
+            help="With `--guided-masking per-sequence` and the mask cache "
+            "disabled, only set the logits of the disallowed tokens to `-inf` "
+            "when at most this many tokens are disallowed. Other steps add a "
+            "full-vocabulary mask.",
+        )
+        group.add_argument(
+            "--guided-mask-cached-sparse-max-tokens",
+            dest="mask_cached_sparse_max_tokens",
+            type=int,
+            default=DotConfig.mask_cached_sparse_max_tokens,
+            help="Same as `--guided-mask-sparse-max-tokens` when the mask "
+            "cache is enabled: the masks are then built once per guide state, "
+            "and applying a cached full-vocabulary mask is usually as fast.",
+        )
+        group.add_argument(
+            "--guided-mask-cached-complement-max-tokens",
+            dest="mask_cached_complement_max_tokens",
+            type=int,
+            default=DotConfig.mask_cached_complement_max_tokens,
+            help="Same as `--guided-mask-complement-max-tokens` when the mask "
+            "cache is enabled.",
+        )
+        group.add_argument(
+            "--guided-compile-workers",
+            dest="compile_workers",
+            type=int,
+            default=default_compile_workers(),
+            help="Number of processes that compile the indexes. They are "
+            "started with the server and preload the model's vocabulary.",
+        )
+        group.add_argument(
+            "--guided-prewarm",
+            dest="prewarm_path",
+            type=str,
+            default=None,
+            help="File or directory of JSON schemas (.json), regular "
+            "expressions (.regex) and grammars (.lark) to compile at startup. "
+            "A .jsonl file can contain several definitions.",
+        )
+        group.add_argument(
+            "--guided-prewarm-concurrency",
+            dest="prewarm_concurrency",
+            type=int,
+            default=DotConfig.prewarm_concurrency,
+            help="Maximum number of definitions compiled at the same time "
+            "during prewarming. Defaults to the number of compilation workers.",
+        )
+        group.add_argument(
+            "--guided-prewarm-wait",
+            dest="prewarm_wait",
+            action="store_true",
+            help="Report the server as unhealthy until prewarming is done.",
+        )
+        group.add_argument(
+            "--guided-shm-dir",
+            dest="shared_memory_dir",
+            type=str,
+            default=default_shared_memory_dir(),
+            help="Directory, ideally backed by shared memory, where the "
+            "compilation workers write the serialized indexes for the engine "
+            "to map.",
+        )
+        group.add_argument(
+            "--guided-index-codec",
+            dest="index_codec",
+            type=str,
+            choices=["none", "zlib", "zstd", "lz4"],
+            default=DotConfig.index_codec,
+            help="Compress the serialized indexes held in memory and on disk, "
+            "so more of them fit in the caches. They are decompressed when a "
+            "guide is first built. Only applies to `--guided-compile-mode "
+            "process`; `zstd` and `lz4` need the `zstandard` and `lz4` "
+            "packages.",
+        )
+        group.add_argument(
+            "--guided-compile-mode",
+            dest="compile_mode",
+            type=str,
+            choices=["process", "thread", "inline"],
+            default=DotConfig.compile_mode,
+            help="Where the indexes are compiled. `process` uses a process "
+            "pool and hands the serialized indexes over in shared memory; "
+            "`thread` uses a thread pool and keeps the index objects without "
+            "serialization; `inline` compiles in the event loop and is only "
+            "meant for debugging.",
+        )
+        group.add_argument(
+            "--guided-compile-tenant-limit",
+            dest="compile_tenant_limit",
+            type=int,
+            default=DotConfig.compile_tenant_limit,
+            help="Maximum number of indexes compiled at the same time for a "
+            "single tenant (LoRA adapter), so that one tenant's one-off "
+            "schemas cannot starve the others. Set to 0 for no limit.",
+        )
+        group.add_argument(
+            "--guided-compile-timeout",
+            dest="compile_timeout",
+            type=float,
+            default=DotConfig.compile_timeout,
+            help="Wall-clock time in seconds after which a compilation is "
+            "killed, along with its worker. Only enforced with "
+            "`--guided-compile-mode process`. Set to 0 for no limit.",
+        )
+        group.add_argument(
+            "--guided-compile-max-rss-bytes",
+            dest="compile_max_rss_bytes",
+            type=int,
+            default=DotConfig.compile_max_rss_bytes,
+            help="Resident memory in bytes above which a compilation worker "
+            "is killed. Only enforced with `--guided-compile-mode process`. "
+            "Set to 0 for no limit.",
+        )
+        group.add_argument(
+            "--guided-compile-max-tasks-per-worker",
+            dest="compile_max_tasks_per_worker",
+            type=int,
+            default=DotConfig.compile_max_tasks_per_worker,
+            help="Number of compilations after which a worker is replaced, to "
+            "reclaim the memory it leaked. Set to 0 to never replace them.",
+        )
+        group.add_argument(
+            "--guided-compile-failure-ttl",
+            dest="compile_failure_ttl",
+            type=float,
+            default=DotConfig.compile_failure_ttl,
+            help="Time in seconds during which a schema whose compilation was "
+            "killed is rejected without being compiled again.",
+        )
+        group.add_argument(
+            "--guided-jump-forward",
+            dest="jump_forward",
+            action="store_true",
+            help="Append the tokens forced by the guide (e.g. property names "
+            "in a JSON object) without sampling them, and process them in a "
+            "single forward pass. Enables chunked prefill and disables "
+            "asynchronous output processing.",
+        )
+        group.add_argument(
+            "--guided-request-timings",
+            dest="request_timings",
+            action="store_true",
+            help="Record where the time of each guided request went (index "
+            "cache, compilation wait, guide construction, token masks), log "
+            "it when the request finishes, and return it in the "
+            "`dotvllm_timings` field of non-streamed responses.",
+        )
+        return parser
+
+    @classmethod
+    def from_cli_args(cls, args: argparse.Namespace) -> "DotConfig":
+        """Create a `DotConfig` from the parsed CLI arguments."""
+        return cls(**{f.name: getattr(args, f.name) for f in fields(cls)})
@@ -0,0 +1,173 @@
+"""DotLLM on-disk cache for compiled indexes."""
+
+import fcntl
+import functools
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from contextlib import contextmanager
+from importlib.metadata import PackageNotFoundError, version
+from typing import Iterator, Optional
+
+from transformers import PreTrainedTokenizerBase
+
+from dotllm.shared_index import SharedIndex
+
+
+logger = logging.getLogger("dotllm.disk_cache")
+
+BACKENDS = ("dotregex", "dotcfg")
+
+
+def backend_versions() -> str:
+    """Return the versions of the compilation backends.
+
+    Serialized indexes are not guaranteed to be compatible across versions of
+    the backend libraries, so their versions are part of the cache key.
+
+    """
+    versions = []
+    for backend in BACKENDS:
+        try:
+            versions.append(f"{backend}={version(backend)}")
+        except PackageNotFoundError:
+            versions.append(f"{backend}=none")
+    return ";".join(versions)
+
+
+@functools.lru_cache(maxsize=8)
+def tokenizer_fingerprint(tokenizer: PreTrainedTokenizerBase) -> str:
+    """Return a fingerprint of the tokenizer's vocabulary.
+
+    Two checkpoints with the same name can ship different tokenizers (e.g.
+    local paths that get overwritten), and the index depends on the exact
+    vocabulary.
+
+    """
+    vocabulary = sorted(tokenizer.get_vocab().items())
+    payload = json.dumps([vocabulary, tokenizer.eos_token_id])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class DiskCache:
+    """Content-addressed on-disk cache of serialized indexes.
+
+    Entries are written atomically (write to a temporary file, then rename) so
+    that readers never see partial entries, and writes and evictions are
+    serialized with an exclusive lock on the cache directory so several
+    processes on the same host can share the cache safely.
+
+    The cache is bounded in size: when it grows larger than `max_bytes` the
+    least recently used entries are evicted. Reading an entry updates its
+    modification time.
+
+    """
+
+    suffix = ".idx"
+
+    def __init__(self, directory: str, max_bytes: int, codec: Optional[str] = None):
+        """Initialize the DiskCache.
+
+        Args:
+            directory: The directory where the entries are stored.
+            max_bytes: The maximum total size of the entries.
+            codec: The codec of the entries, if they are compressed. Entries
+                written with different codecs do not collide.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.namespace = backend_versions()
+        if codec is not None:
+            self.namespace += f";codec={codec}"
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key: str, fingerprint: str) -> str:
+        """Return the path of the entry corresponding to `key`."""
+        digest = hashlib.sha256(
+            f"{key}:{fingerprint}:{self.namespace}".encode("utf-8")
+        ).hexdigest()
+        return os.path.join(self.directory, digest + self.suffix)
+
+    @contextmanager
+    def _lock(self) -> Iterator[None]:
+        with open(os.path.join(self.directory, ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get(self, key: str, fingerprint: str) -> Optional[SharedIndex]:
+        """Map an entry of the cache.
+
+        The entry is memory-mapped rather than read, so the index can be
+        deserialized without copying it. The mapping remains valid if the entry
+        is evicted by another process.
+
+        Args:
+            key: The compilation key.
+            fingerprint: The fingerprint of the tokenizer's vocabulary.
+
+        Returns:
+            The serialized index, or None if it is not in the cache.
+        """
+        path = self.path(key, fingerprint)
+        try:
+            serialized_index = SharedIndex(path, owned=False)
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read {path} from the index cache: {e}")
+            return None
+
+        return serialized_index
+
+    def put(self, key: str, fingerprint: str, serialized_index: memoryview):
+        """Write an entry to the cache and evict old entries if needed.
+
+        Args:
+            key: The compilation key.
+            fingerprint: The fingerprint of the tokenizer's vocabulary.
+            serialized_index: The serialized index.
+        """
+        if len(serialized_index) > self.max_bytes:
+            return
+
+        path = self.path(key, fingerprint)
+        try:
+            with self._lock():
+                fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+                try:
+                    with os.fdopen(fd, "wb") as f:
+                        f.write(serialized_index)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(tmp_path, path)
+                except BaseException:
+                    os.unlink(tmp_path)
+                    raise
+                self._evict()
+        except OSError as e:
+            logger.warning(f"Could not write {path} to the index cache: {e}")
+
+    def _evict(self):
+        """Evict the least recently used entries. Must hold the lock."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.suffix):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+                total_bytes -= size
+                logger.info(f"Evicted {path} from the index cache")
+            except FileNotFoundError:
+                pass
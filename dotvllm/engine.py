@@ -1,17 +1,29 @@
 """DotLLM Engine implementation."""
 
+import asyncio
 import logging
-from typing import Optional, Type, Any, Union, Mapping
+import time
+from typing import AsyncGenerator, Iterable, List, Optional, Type, Any, Union, Mapping
 from vllm.engine.async_llm_engine import AsyncLLMEngine, _AsyncLLMEngine
 from vllm.sampling_params import SamplingParams
 from vllm.pooling_params import PoolingParams
 from vllm.prompt_adapter.request import PromptAdapterRequest
 from vllm.lora.request import LoRARequest
+from vllm.transformers_utils.tokenizer import AnyTokenizer
 from vllm.inputs import PromptType
+from vllm.outputs import PoolingRequestOutput, RequestOutput
+from vllm.sequence import Logprob, SequenceGroup, SequenceStage
 
 
-from dotllm.logits_processor import get_logits_processor
+from dotllm import metrics
+from dotllm.logits_processor import LogitsProcessor, get_logits_processor
 from dotllm.compilation_manager import CompilationManager
+from dotllm.config import DotConfig
+from dotllm.prefetch import MaskPrefetcher
+from dotllm.prewarm import prewarm
+from dotllm.request_timings import FinishedTimings, RequestTimings
+from dotllm.sampler import install_batched_logits_processors, install_mask_prefetcher
+from dotllm.stop_checker import install_guided_stop_checker
 
 
 logger = logging.getLogger("dotllm.engine")
@@ -22,7 +34,78 @@ class _DotAsyncLLMEngine(_AsyncLLMEngine):
 
     def __init__(self, *args: Any, **kwargs: Any) -> None:
         super().__init__(*args, **kwargs)
-        self.compilation_manager = CompilationManager()
+        self.compilation_manager = None
+        self.mask_prefetcher = None
+        self.jump_forward = False
+        self._compilation_keys = {}
+        self._request_timings = {}
+        self.finished_timings = FinishedTimings()
+        self.configure(DotConfig(), warmup=False)
+
+    def configure(self, dot_config: DotConfig, warmup: bool = True) -> None:
+        """Apply the DotLLM configuration.
+
+        `AsyncLLMEngine.from_vllm_config` does not forward extra arguments to
+        the engine's constructor, so the configuration is applied once the
+        engine is instantiated. No request can have been added at this point.
+
+        Args:
+            dot_config: The DotLLM configuration.
+            warmup: Whether to start the compilation workers now.
+
+        """
+        if self.compilation_manager is not None:
+            self.compilation_manager.shutdown()
+        self.dot_config = dot_config
+
+        model_name = None
+        if self.tokenizer is not None:
+            model_name = self.get_tokenizer().name_or_path
+        self.compilation_manager = CompilationManager(dot_config, model_name)
+        if warmup:
+            self.compilation_manager.warmup()
+        install_batched_logits_processors(dot_config.masking == "batched")
+        LogitsProcessor.sparse_max_tokens = dot_config.mask_sparse_max_tokens
+        LogitsProcessor.complement_max_tokens = dot_config.mask_complement_max_tokens
+        LogitsProcessor.cached_sparse_max_tokens = (
+            dot_config.mask_cached_sparse_max_tokens
+        )
+        LogitsProcessor.cached_complement_max_tokens = (
+            dot_config.mask_cached_complement_max_tokens
+        )
+
+        if self.mask_prefetcher is not None:
+            self.mask_prefetcher.executor.shutdown(wait=False)
+        self.mask_prefetcher = None
+        if dot_config.mask_prefetch_workers > 0:
+            self.mask_prefetcher = MaskPrefetcher(dot_config.mask_prefetch_workers)
+        install_mask_prefetcher(self.mask_prefetcher)
+        install_guided_stop_checker(self.output_processor)
+
+        self.jump_forward = dot_config.jump_forward and self._can_jump_forward()
+
+    def _can_jump_forward(self) -> bool:
+        """Check that the engine's configuration supports jump-forward decoding.
+
+        The forced tokens are processed as a prefill chunk of a running
+        sequence, which only the chunked prefill scheduler supports, and they
+        must be detokenized before the sampled tokens that follow them, which
+        asynchronous output processing would defer.
+
+        """
+        if not self.scheduler_config.chunked_prefill_enabled:
+            reason = "chunked prefill is disabled"
+        elif self.model_config.use_async_output_proc:
+            reason = "asynchronous output processing is enabled"
+        elif self.scheduler_config.is_multi_step:
+            reason = "multi-step scheduling is enabled"
+        elif self.speculative_config is not None:
+            reason = "speculative decoding is enabled"
+        else:
+            return True
+
+        logger.warning(f"Jump-forward decoding is disabled: {reason}")
+        return False
 
     async def add_request_async(
         self,
@@ -61,24 +144,11 @@ class _DotAsyncLLMEngine(_AsyncLLMEngine):
         """
 
         if isinstance(params, SamplingParams) and params.guided_decoding is not None:
-            logger.info(f"Using guided decoding for request {request_id}")
             tokenizer = await self.get_tokenizer_async(lora_request)
-            guided_decoding = params.guided_decoding
-
-            # Validate the schema here
-            processor = get_logits_processor(
-                guided_decoding, tokenizer, self.compilation_manager
+            self.attach_logits_processor(
+                request_id, params, tokenizer, priority, lora_request
             )
 
-            if processor:
-                if params.logits_processors is None:
-                    params.logits_processors = []
-                params.logits_processors.append(processor)
-
-            # So that super().add_request_async does not try to
-            # set the logits processor
-            params.guided_decoding = None
-
         return await super().add_request_async(
             request_id=request_id,
             prompt=prompt,
@@ -91,6 +161,172 @@ class _DotAsyncLLMEngine(_AsyncLLMEngine):
             inputs=inputs,
         )
 
+    def attach_logits_processor(
+        self,
+        request_id: str,
+        params: SamplingParams,
+        tokenizer: AnyTokenizer,
+        priority: int = 0,
+        lora_request: Optional[LoRARequest] = None,
+    ) -> LogitsProcessor:
+        """Replace the request's guided decoding parameters with our logits processor.
+
+        This submits the index for compilation but does not wait for it. The
+        compilation is queued with the request's priority, and its LoRA
+        adapter as the tenant. With `--guided-request-timings` the processor
+        records the timings of the request.
+
+        Args:
+            request_id: The unique ID of the request.
+            params: The sampling parameters, with `guided_decoding` set.
+            tokenizer: The tokenizer used by the request.
+            priority: The priority of the request.
+            lora_request: The LoRA adapter of the request, if any.
+
+        Returns:
+            The logits processor that was added to the sampling parameters.
+        """
+        logger.info(f"Using guided decoding for request {request_id}")
+
+        tenant = lora_request.lora_name if lora_request else None
+        timings = None
+        if self.dot_config.request_timings:
+            timings = RequestTimings(request_id=request_id, tenant=tenant)
+
+        # Validate the schema here
+        processor = get_logits_processor(
+            params.guided_decoding,
+            tokenizer,
+            self.compilation_manager,
+            priority,
+            tenant,
+            timings,
+        )
+
+        self._compilation_keys[request_id] = processor.compilation_key
+        if timings is not None:
+            self._request_timings[request_id] = timings
+        if params.logits_processors is None:
+            params.logits_processors = []
+        params.logits_processors.append(processor)
+
+        # So that super().add_request_async does not try to
+        # set the logits processor
+        params.guided_decoding = None
+
+        return processor
+
+    async def step_async(
+        self, virtual_engine: int
+    ) -> List[Union[RequestOutput, PoolingRequestOutput]]:
+        """Perform one decoding iteration and append the forced tokens."""
+        request_outputs = await super().step_async(virtual_engine)
+        if self.jump_forward:
+            for seq_group in self.scheduler[virtual_engine].running:
+                self._jump_forward(seq_group)
+
+        return request_outputs
+
+    def _jump_forward(self, seq_group: SequenceGroup) -> None:
+        """Append the tokens that the guide forces after the last sampled token.
+
+        The forced tokens are appended to the sequence and detokenized as if
+        they had been sampled, and the sequence is moved back to the prefill
+        stage so that the next forward pass processes the last sampled token
+        and the forced tokens together, as a multi-token extension, and
+        samples the token that follows them. Forced tokens get a logprob of 0.
+
+        Only single-sequence requests without stop strings are extended,
+        since the stop strings are only checked on the sampled tokens.
+
+        """
+        params = seq_group.sampling_params
+        if (
+            params is None
+            or params.n != 1
+            or params.stop
+            or seq_group.is_prefill()
+            or seq_group.is_finished()
+        ):
+            return
+
+        processor = next(
+            (
+                p
+                for p in params.logits_processors or []
+                if isinstance(p, LogitsProcessor)
+            ),
+            None,
+        )
+        if processor is None:
+            return
+
+        seq = seq_group.first_seq
+        # Leave room for one sampled token, so the length limits are still
+        # enforced by the stop checker
+        max_tokens = self.model_config.max_model_len - seq.get_len() - 1
+        if params.max_tokens is not None:
+            max_tokens = min(max_tokens, params.max_tokens - seq.get_output_len() - 1)
+        if max_tokens <= 0:
+            return
+
+        excluded_tokens = set(params.all_stop_token_ids)
+        if seq.eos_token_id is not None and not params.ignore_eos:
+            excluded_tokens.add(seq.eos_token_id)
+
+        forced_tokens = processor.forced_tokens(
+            seq.get_output_token_ids(), max_tokens, excluded_tokens
+        )
+        if not forced_tokens:
+            return
+
+        for token in forced_tokens:
+            seq.append_token_id(token, {token: Logprob(0.0)})
+            if params.detokenize and self.detokenizer is not None:
+                self.detokenizer.decode_sequence_inplace(seq, params)
+
+        # There is no public API to extend a running sequence; the scheduler
+        # computes the uncomputed tokens of sequences in the prefill stage.
+        seq.data._stage = SequenceStage.PREFILL
+        metrics.jump_forward_tokens.inc(len(forced_tokens))
+
+    def finish_requests(
+        self, request_outputs: List[Union[RequestOutput, PoolingRequestOutput]]
+    ) -> None:
+        """Record the timings of the finished requests and release their indexes.
+
+        This is called by `DotEngine.process_request_outputs`, which receives
+        the outputs of every step. With asynchronous output processing, which
+        vLLM enables by default, the outputs are handed to it by a callback
+        and `step_async` returns none of them.
+
+        Args:
+            request_outputs: The outputs of a step.
+        """
+        for request_output in request_outputs:
+            if not request_output.finished:
+                continue
+            timings = self._request_timings.get(request_output.request_id)
+            if timings is not None:
+                self.finished_timings.put(
+                    request_output.request_id, timings.finish(request_output.metrics)
+                )
+            self.release(request_output.request_id)
+
+    def abort_request(self, request_id: Union[str, Iterable[str]]) -> None:
+        """Abort requests and release their indexes."""
+        request_ids = [request_id] if isinstance(request_id, str) else list(request_id)
+        super().abort_request(request_ids)
+        for request_id in request_ids:
+            self.release(request_id)
+
+    def release(self, request_id: str) -> None:
+        """Unpin the index used by a request so it can be evicted."""
+        self._request_timings.pop(request_id, None)
+        compilation_key = self._compilation_keys.pop(request_id, None)
+        if compilation_key is not None:
+            self.compilation_manager.release(compilation_key)
+
 
 class DotEngine(AsyncLLMEngine):
     """Custom AsyncLLMEngine for DotLLM.
@@ -99,6 +335,132 @@ class DotEngine(AsyncLLMEngine):
     the DotLLM CLI and API server, including using our proprietary libraries for
     structured generation.
 
+    Guided requests are parked until their index is compiled, and only then
+    handed to the engine loop and the vLLM scheduler. This way a schema that
+    is slow to compile never stalls the decoding batch of the other requests,
+    which keep being scheduled while compilation runs in the background.
+
     """
 
     _engine_class: Type[_AsyncLLMEngine] = _DotAsyncLLMEngine
+    _prewarm_task: Optional[asyncio.Task] = None
+
+    async def add_request(
+        self,
+        request_id: str,
+        prompt: PromptType,
+        params: Union[SamplingParams, PoolingParams],
+        arrival_time: Optional[float] = None,
+        lora_request: Optional[LoRARequest] = None,
+        trace_headers: Optional[Mapping[str, str]] = None,
+        prompt_adapter_request: Optional[PromptAdapterRequest] = None,
+        priority: int = 0,
+    ) -> AsyncGenerator[Union[RequestOutput, PoolingRequestOutput], None]:
+        """Add a request, waiting for its index to be compiled if it is guided.
+
+        This runs in the coroutine that serves the request, not in the engine
+        loop, so waiting for the compilation here does not block the other
+        requests, and unguided requests keep streaming in the meantime. If the
+        compilation fails a `CompilationError` is raised for this request
+        only, instead of taking down the engine loop.
+
+        vLLM V0 cannot run the prefill of a request without also sampling its
+        first token, which requires the index, so the whole request is parked.
+        If the client disconnects while the request is parked, its compilation
+        is cancelled unless another request needs it.
+
+        """
+        if isinstance(params, SamplingParams) and params.guided_decoding is not None:
+            # The time spent parked counts towards the request's latency
+            if arrival_time is None:
+                arrival_time = time.time()
+
+            tokenizer = await self.get_tokenizer(lora_request)
+            processor = self.engine.attach_logits_processor(
+                request_id, params, tokenizer, priority, lora_request
+            )
+            start = time.perf_counter()
+            try:
+                await self.engine.compilation_manager.get_index_async(
+                    processor.compilation_key
+                )
+            except BaseException:
+                self.engine.release(request_id)
+                raise
+            if processor.timings is not None:
+                processor.timings.compile_wait = time.perf_counter() - start
+
+        return await super().add_request(
+            request_id,
+            prompt,
+            params,
+            arrival_time=arrival_time,
+            lora_request=lora_request,
+            trace_headers=trace_headers,
+            prompt_adapter_request=prompt_adapter_request,
+            priority=priority,
+        )
+
+    def process_request_outputs(
+        self, request_outputs: List[Union[RequestOutput, PoolingRequestOutput]]
+    ) -> bool:
+        """Release the finished requests' indexes, then stream the outputs.
+
+        vLLM calls this with the outputs of every step, from the engine loop
+        or from the callback of asynchronous output processing.
+
+        """
+        self.engine.finish_requests(request_outputs)
+        return super().process_request_outputs(request_outputs)
+
+    def configure(self, dot_config: DotConfig) -> None:
+        """Apply the DotLLM configuration to the underlying engine.
+
+        If a prewarming corpus is configured its compilation starts in the
+        background, so this must be called from the running event loop.
+
+        """
+        self.engine.configure(dot_config)
+        if dot_config.prewarm_path:
+            self._prewarm_task = asyncio.get_running_loop().create_task(
+                self._prewarm(dot_config)
+            )
+
+    def pop_request_timings(self, response_id: str) -> list[dict]:
+        """Return and forget the timings of the finished requests of a response.
+
+        Args:
+            response_id: The `id` of the OpenAI response.
+
+        Returns:
+            The timings of the requests, empty unless `--guided-request-timings`
+            is set.
+        """
+        return self.engine.finished_timings.pop(response_id)
+
+    async def _prewarm(self, dot_config: DotConfig) -> None:
+        compilation_manager = self.engine.compilation_manager
+        try:
+            await prewarm(
+                dot_config.prewarm_path,
+                await self.get_tokenizer(),
+                compilation_manager,
+                dot_config.prewarm_concurrency or compilation_manager.num_workers,
+            )
+        except Exception as e:
+            logger.error(f"Prewarming failed: {e}")
+
+    async def check_health(self) -> None:
+        """Raise an error if the engine is unhealthy.
+
+        With `--guided-prewarm-wait`, the engine is also reported as unhealthy
+        until the prewarming corpus is compiled.
+
+        """
+        if (
+            self.engine.dot_config.prewarm_wait
+            and self._prewarm_task is not None
+            and not self._prewarm_task.done()
+        ):
+            raise RuntimeError("The guided decoding indexes are being prewarmed")
+        await super().check_health()
@@ -0,0 +1,433 @@
+"""DotLLM executors that run the compilation of the indexes.
+
+- `process` compiles in a pool of processes. The index has to be serialized
+  in the worker and deserialized in the engine, but the compilation never
+  competes with the engine for the GIL.
+- `thread` compiles in a pool of threads, and keeps the compiled index object
+  as is. This avoids the serialization round-trip, and is the fastest option
+  with backends that release the GIL during compilation.
+- `inline` compiles in the caller's thread, which blocks the event loop. This
+  is only meant for debugging and benchmarking.
+
+Only the `process` executor can enforce `CompilationLimits`, since a thread
+that runs away cannot be stopped, and only its serialized indexes can be
+compressed.
+
+"""
+
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+from dotllm.compression import Codec, CompressedIndex
+from dotllm.processors.worker import compile_to_shared_memory, init_worker, ping
+from dotllm.shared_index import SharedIndex
+
+
+logger = logging.getLogger("dotllm.executors")
+
+# How often the watchdog checks the running compilations, in seconds
+WATCHDOG_INTERVAL = 0.5
+
+# How many times a compilation is retried when another worker broke the pool
+MAX_ATTEMPTS = 3
+
+
+class CompilationLimitError(RuntimeError):
+    """Raised when a compilation exceeds its time or memory limit."""
+
+
+@dataclass
+class CompilationLimits:
+    """Limits enforced on every compilation by the process executor.
+
+    Attributes:
+        timeout: Wall-clock time after which a compilation is killed, in
+            seconds. 0 means no limit.
+        max_rss_bytes: Resident memory above which a worker is killed.
+            0 means no limit.
+        max_tasks_per_worker: Number of compilations after which a worker is
+            replaced, to reclaim the memory it leaked. 0 means never.
+    """
+
+    timeout: float = 0
+    max_rss_bytes: int = 0
+    max_tasks_per_worker: int = 0
+
+
+def _rss_bytes(pid: int) -> int:
+    """Return the resident memory of process `pid`, or 0 if it is unknown."""
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class InMemoryIndex:
+    """Compiled index kept as a live object, without serialization.
+
+    It has the same interface as `SharedIndex` so the `CompilationManager` can
+    store both. Its size in the `IndexStore` is the index's `nbytes` if it has
+    one, and otherwise the length of its serialization. That is computed once,
+    in the compilation thread.
+
+    """
+
+    def __init__(self, index: Any):
+        self.index = index
+        nbytes = getattr(index, "nbytes", None)
+        if nbytes is None:
+            serialize = getattr(index, "serialize", None)
+            nbytes = len(serialize()) if serialize is not None else 0
+        self.nbytes = int(nbytes)
+
+    def load(self, load_index: Callable[[Any], Any]) -> Any:
+        """Return the index, which does not need to be deserialized."""
+        return self.index
+
+    def to_buffer(self) -> bytes:
+        """Serialize the index, e.g. to write it to the disk cache."""
+        return self.index.serialize()
+
+    def close(self):
+        pass
+
+
+class CompilationExecutor:
+    """Base class of the executors that compile the indexes."""
+
+    num_workers: int = 1
+    num_killed: int = 0
+
+    def submit(self, func: Callable, model_name: str, schema: str) -> Future:
+        """Compile an index in the background.
+
+        Args:
+            func: The function that compiles the index.
+            model_name: The name of the model.
+            schema: The schema or pattern to compile.
+
+        Returns:
+            A future whose result is a `SharedIndex` or an `InMemoryIndex`.
+        """
+        raise NotImplementedError
+
+    def warmup(self):
+        """Start the workers ahead of the first request."""
+
+    def shutdown(self):
+        """Stop the workers and cancel the pending compilations."""
+
+
+@dataclass
+class _ProcessJob:
+    func: Callable
+    model_name: str
+    schema: str
+    result: Future = field(default_factory=Future)
+    attempts: int = 0
+
+
+class ProcessCompilationExecutor(CompilationExecutor):
+    """Compile the indexes in a process pool and hand them over in shared memory.
+
+    The workers are started with the `spawn` method, since forking the engine
+    process after CUDA is initialized is unsafe. When the served model is known
+    each worker imports the backends and builds the model's vocabulary once,
+    when it starts.
+
+    Workers report the jobs they start on a queue, and a watchdog thread kills
+    the workers whose compilation exceeds the time or memory limit. Killing a
+    worker breaks the whole `ProcessPoolExecutor`, so the pool is replaced and
+    the other jobs that were running in it are submitted again. Workers are
+    also replaced after `max_tasks_per_worker` compilations.
+
+    If a codec is given, the workers compress the serialized indexes and the
+    executor returns `CompressedIndex`es.
+
+    """
+
+    def __init__(
+        self,
+        num_workers: int,
+        shared_memory_dir: str,
+        model_name: Optional[str],
+        limits: Optional[CompilationLimits] = None,
+        codec: Optional[Codec] = None,
+    ):
+        self.num_workers = num_workers
+        self.shared_memory_dir = shared_memory_dir
+        self.model_name = model_name
+        self.limits = limits or CompilationLimits()
+        self.codec = codec
+        self._context = multiprocessing.get_context("spawn")
+        self._jobs = {}
+        self._started = {}
+        self._killed = {}
+        self._job_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._closed = False
+
+        self._status_queue = None
+        if self.limits.timeout > 0 or self.limits.max_rss_bytes > 0:
+            self._status_queue = self._context.Queue()
+            threading.Thread(
+                target=self._watch, name="dotllm-compile-watchdog", daemon=True
+            ).start()
+
+        self.pool = self._make_pool()
+
+    def _make_pool(self) -> ProcessPoolExecutor:
+        kwargs = {}
+        if self.limits.max_tasks_per_worker > 0:
+            if sys.version_info >= (3, 11):
+                kwargs["max_tasks_per_child"] = self.limits.max_tasks_per_worker
+            else:
+                logger.warning("Recycling the compilation workers needs Python 3.11")
+        return ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=self._context,
+            initializer=init_worker,
+            initargs=(self.model_name, self._status_queue),
+            **kwargs,
+        )
+
+    def submit(self, func: Callable, model_name: str, schema: str) -> Future:
+        job_id = next(self._job_ids)
+        job = _ProcessJob(func, model_name, schema)
+        with self._lock:
+            self._jobs[job_id] = job
+        self._submit(job_id, job)
+        return job.result
+
+    def _submit(self, job_id: int, job: _ProcessJob):
+        """Submit a job to the current pool, replacing the pool if it is broken."""
+        job.attempts += 1
+        while True:
+            pool = self.pool
+            try:
+                future = pool.submit(
+                    compile_to_shared_memory,
+                    job.func,
+                    job.model_name,
+                    job.schema,
+                    self.shared_memory_dir,
+                    os.getpid(),
+                    job_id,
+                    self.codec.name if self.codec is not None else None,
+                )
+                break
+            except BrokenProcessPool:
+                self._replace_pool(pool)
+            except RuntimeError as e:
+                # The executor was shut down
+                self._finish(job_id, exception=e)
+                return
+
+        future.add_done_callback(lambda future: self._on_done(job_id, pool, future))
+
+    def _on_done(self, job_id: int, pool: ProcessPoolExecutor, future: Future):
+        with self._lock:
+            self._started.pop(job_id, None)
+            error = self._killed.pop(job_id, None)
+            job = self._jobs.get(job_id)
+        if job is None:
+            # Already resolved, e.g. by the shutdown or the watchdog, but the
+            # worker may still have written the index to shared memory
+            self._discard_result(future)
+            return
+
+        if future.cancelled():
+            self._finish(job_id, cancelled=True)
+            return
+
+        exception = future.exception()
+        if isinstance(exception, BrokenProcessPool):
+            if error is not None:
+                self._finish(job_id, exception=error)
+                return
+            if not self._closed and job.attempts < MAX_ATTEMPTS:
+                # Another worker died and took the pool down with it
+                self._replace_pool(pool)
+                self._submit(job_id, job)
+                return
+        if exception is not None:
+            self._finish(job_id, exception=exception)
+            return
+
+        shared_index = None
+        try:
+            result = shared_index = SharedIndex(future.result())
+            if self.codec is not None:
+                result = CompressedIndex(shared_index, self.codec)
+        except Exception as e:
+            if shared_index is not None:
+                shared_index.close()
+            self._finish(job_id, exception=e)
+            return
+        if not self._finish(job_id, result=result):
+            result.close()
+
+    def _discard_result(self, future: Future):
+        """Remove the shared memory file of a result that nobody will use."""
+        if future.cancelled() or future.exception() is not None:
+            return
+        try:
+            SharedIndex(future.result()).close()
+        except OSError as e:
+            logger.debug(f"Could not discard {future.result()}: {e}")
+
+    def _finish(
+        self, job_id: int, result=None, exception=None, cancelled=False
+    ) -> bool:
+        """Resolve the future returned by `submit`.
+
+        Returns:
+            Whether the future was resolved, rather than already done.
+        """
+        with self._lock:
+            job = self._jobs.pop(job_id, None)
+        if job is None or job.result.done():
+            return False
+        if cancelled:
+            job.result.cancel()
+        elif exception is not None:
+            job.result.set_exception(exception)
+        else:
+            job.result.set_result(result)
+        return True
+
+    def _replace_pool(self, pool: ProcessPoolExecutor):
+        """Replace `pool` with a new pool, unless this was already done."""
+        with self._lock:
+            if self._closed or self.pool is not pool:
+                return
+            logger.info("Replacing the compilation worker pool")
+            self.pool = self._make_pool()
+        pool.shutdown(wait=False)
+
+    def _watch(self):
+        """Kill the workers whose compilation exceeds the limits."""
+        while not self._closed:
+            try:
+                job_id, pid = self._status_queue.get(timeout=WATCHDOG_INTERVAL)
+                with self._lock:
+                    if job_id in self._jobs:
+                        self._started[job_id] = (pid, time.monotonic())
+            except queue.Empty:
+                pass
+            except (EOFError, OSError):
+                return
+            self._check_limits()
+
+    def _check_limits(self):
+        now = time.monotonic()
+        with self._lock:
+            started = list(self._started.items())
+
+        for job_id, (pid, start) in started:
+            if self.limits.timeout > 0 and now - start > self.limits.timeout:
+                error = CompilationLimitError(
+                    f"The compilation took more than {self.limits.timeout:g}s"
+                )
+            elif (
+                self.limits.max_rss_bytes > 0
+                and _rss_bytes(pid) > self.limits.max_rss_bytes
+            ):
+                error = CompilationLimitError(
+                    "The compilation used more than "
+                    f"{self.limits.max_rss_bytes / 1024**2:.0f} MiB of memory"
+                )
+            else:
+                continue
+
+            with self._lock:
+                if self._started.pop(job_id, None) is None:
+                    continue
+                self._killed[job_id] = error
+                self.num_killed += 1
+            logger.warning(f"Killing compilation worker {pid}: {error}")
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def warmup(self):
+        logger.info(f"Starting {self.num_workers} compilation workers")
+        wait([self.pool.submit(ping) for _ in range(self.num_workers)])
+        logger.info("Compilation workers are ready")
+
+    def shutdown(self):
+        self._closed = True
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+class ThreadCompilationExecutor(CompilationExecutor):
+    """Compile the indexes in a thread pool and keep the index objects."""
+
+    def __init__(self, num_workers: int):
+        self.num_workers = num_workers
+        self.pool = ThreadPoolExecutor(
+            max_workers=num_workers, thread_name_prefix="dotllm-compile"
+        )
+
+    def submit(self, func: Callable, model_name: str, schema: str) -> Future:
+        return self.pool.submit(lambda: InMemoryIndex(func(model_name, schema)))
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+class InlineCompilationExecutor(CompilationExecutor):
+    """Compile the indexes in the caller's thread."""
+
+    def submit(self, func: Callable, model_name: str, schema: str) -> Future:
+        future = Future()
+        try:
+            future.set_result(InMemoryIndex(func(model_name, schema)))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+def make_executor(
+    mode: str,
+    num_workers: int,
+    shared_memory_dir: str,
+    model_name: Optional[str],
+    limits: Optional[CompilationLimits] = None,
+    codec: Optional[Codec] = None,
+) -> CompilationExecutor:
+    """Create the compilation executor for `mode`.
+
+    Args:
+        mode: One of `process`, `thread` or `inline`.
+        num_workers: The number of processes or threads.
+        shared_memory_dir: Where the process workers write the indexes.
+        model_name: The name of the served model, if known.
+        limits: The limits enforced on every compilation, in `process` mode.
+        codec: The codec that compresses the indexes, in `process` mode.
+
+    Returns:
+        The compilation executor.
+    """
+    if mode == "process":
+        return ProcessCompilationExecutor(
+            num_workers, shared_memory_dir, model_name, limits, codec
+        )
+    if mode == "thread":
+        return ThreadCompilationExecutor(num_workers)
+    if mode == "inline":
+        return InlineCompilationExecutor()
+    raise ValueError(f"Unknown compilation mode {mode}")
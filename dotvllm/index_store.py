@@ -0,0 +1,183 @@
+"""DotLLM in-memory store for compiled indexes."""
+
+import logging
+import sys
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Any, Callable, Optional
+
+from dotllm.compression import CompressedIndex
+from dotllm.executors import InMemoryIndex
+from dotllm.shared_index import SharedIndex
+
+
+logger = logging.getLogger("dotllm.index_store")
+
+
+def sizeof(serialized_index: Any) -> int:
+    """Return the size of a serialized index in bytes."""
+    if isinstance(serialized_index, InMemoryIndex):
+        return serialized_index.nbytes
+    if isinstance(
+        serialized_index,
+        (bytes, bytearray, memoryview, SharedIndex, CompressedIndex),
+    ):
+        return len(serialized_index)
+    return sys.getsizeof(serialized_index)
+
+
+def live_sizeof(serialized_index: Any) -> int:
+    """Estimate the size in bytes of the index deserialized from `serialized_index`.
+
+    An `InMemoryIndex` is its own live index and is already counted by
+    `sizeof`. Other indexes are assumed to take as much room once
+    deserialized as their (decompressed) serialization.
+    """
+    if isinstance(serialized_index, InMemoryIndex):
+        return 0
+    if isinstance(serialized_index, CompressedIndex):
+        return serialized_index.decompressed_size or 0
+    return sizeof(serialized_index)
+
+
+class IndexStore:
+    """LRU store of serialized indexes with a byte budget and an entry cap.
+
+    When the store holds more than `max_entries` indexes, or more than
+    `max_bytes` bytes, the least recently used indexes are evicted. The size
+    of an entry includes the memory charged to it with `charge`, e.g. for its
+    deserialized index. Keys
+    can be pinned while requests that use them are in flight; pinned indexes
+    are never evicted, so the store can temporarily exceed its budget.
+
+    The store is accessed from the engine loop and from the callbacks of the
+    compilation futures, so all operations hold a lock.
+
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        max_entries: int,
+        on_evict: Optional[Callable[[str, Any], None]] = None,
+    ):
+        """Initialize the IndexStore.
+
+        Args:
+            max_bytes: The maximum total size of the indexes.
+            max_entries: The maximum number of indexes.
+            on_evict: Function called with the key and the value of every
+                evicted index.
+        """
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.num_bytes = 0
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._pins = defaultdict(int)
+        self.on_evict = on_evict
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key: str) -> Optional[Any]:
+        """Get the index corresponding to `key` and mark it as recently used.
+
+        Args:
+            key: The index's key
+
+        Returns:
+            The serialized index, or None if it is not in the store.
+        """
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key: str, serialized_index: Any):
+        """Add an index to the store and evict indexes if needed.
+
+        Args:
+            key: The index's key
+            serialized_index: The serialized index.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = serialized_index
+            self._sizes[key] = sizeof(serialized_index)
+            self.num_bytes += self._sizes[key]
+            self._evict()
+
+    def charge(self, key: str, serialized_index: Any, num_bytes: int) -> bool:
+        """Add `num_bytes` to the size of an entry, and evict indexes if needed.
+
+        Args:
+            key: The index's key
+            serialized_index: The entry the memory belongs to. Nothing is
+                charged if `key` was evicted, or replaced by another entry.
+            num_bytes: The number of bytes to add.
+
+        Returns:
+            False if the entry is no longer in the store.
+        """
+        with self._lock:
+            if self._entries.get(key) is not serialized_index:
+                return False
+            self._sizes[key] += num_bytes
+            self.num_bytes += num_bytes
+            self._evict()
+            return True
+
+    def pin(self, key: str):
+        """Prevent the index corresponding to `key` from being evicted."""
+        with self._lock:
+            self._pins[key] += 1
+
+    def is_pinned(self, key: str) -> bool:
+        """Return whether a request still holds a pin on `key`."""
+        with self._lock:
+            return key in self._pins
+
+    def unpin(self, key: str) -> int:
+        """Release a pin taken with `pin`, and return the pins left on `key`."""
+        with self._lock:
+            self._pins[key] -= 1
+            num_pins = self._pins[key]
+            if num_pins <= 0:
+                del self._pins[key]
+                self._evict()
+            return max(num_pins, 0)
+
+    def _evict(self):
+        """Evict the least recently used unpinned indexes. Must hold the lock."""
+        for key in list(self._entries):
+            if (
+                len(self._entries) <= self.max_entries
+                and self.num_bytes <= self.max_bytes
+            ):
+                break
+            if key in self._pins:
+                continue
+            serialized_index = self._entries.pop(key)
+            self.num_bytes -= self._sizes.pop(key)
+            logger.info(f"Evicted index {key[:12]} from memory")
+            if self.on_evict is not None:
+                self.on_evict(key, serialized_index)
+
+    def clear(self):
+        """Evict all the indexes, pinned or not."""
+        with self._lock:
+            while self._entries:
+                key, serialized_index = self._entries.popitem(last=False)
+                self.num_bytes -= self._sizes.pop(key)
+                if self.on_evict is not None:
+                    self.on_evict(key, serialized_index)
@@ -1,6 +1,10 @@
 """DotLLM custom logits processors."""
 
+import copy
 import logging
+import threading
+import time
+from concurrent.futures import Executor, Future
 from typing import Optional
 
 from transformers import PreTrainedTokenizerBase
@@ -9,10 +13,28 @@ import torch
 
 from vllm.sampling_params import GuidedDecodingParams
 
-from dotllm.processors.dotregex import compile_regex, build_regex_guide
-from dotllm.processors.dotgrammar import compile_grammar, build_grammar_guide
-from dotllm.processors.dotjson import compile_json, build_json_guide
+from dotllm.processors.dotregex import (
+    compile_regex,
+    load_regex_index,
+    build_regex_guide,
+)
+from dotllm.processors.dotgrammar import (
+    compile_grammar,
+    load_grammar_index,
+    build_grammar_guide,
+)
+from dotllm.processors.dotjson import compile_json, load_json_index, build_json_guide
+from dotllm import metrics
+from dotllm.bitmask import fill_token_bitmask
+from dotllm.canonicalize import (
+    canonicalize_grammar,
+    canonicalize_json_schema,
+    canonicalize_regex,
+)
 from dotllm.compilation_manager import CompilationManager
+from dotllm.disk_cache import tokenizer_fingerprint
+from dotllm.masking import apply_mask, build_mask, choose_mask_strategy
+from dotllm.request_timings import RequestTimings
 
 
 logger = logging.getLogger("dotllm.logits_processor")
@@ -22,6 +44,9 @@ def get_logits_processor(
     guided_decoding_params: GuidedDecodingParams,
     tokenizer: PreTrainedTokenizerBase,
     compilation_manager: Optional[CompilationManager] = None,
+    priority: int = 0,
+    tenant: Optional[str] = None,
+    timings: Optional[RequestTimings] = None,
 ):
     """Get a logits processor for the given guided decoding parameters.
 
@@ -30,55 +55,298 @@ def get_logits_processor(
         tokenizer: The tokenizer to use.
         compilation_manager: Optional compilation manager for asynchronous compilation.
             If provided, the index building will be performed in a background thread.
+        priority: The priority of the compilation. Lower values go first.
+        tenant: The tenant that sent the request.
+        timings: The timings of the request, filled by the compilation manager
+            and the logits processor.
 
     Returns:
         A logits processor for the given parameters.
 
     Raises:
-        ValueError: If the guided decoding mode is unknown.
+        ValueError: If the guided decoding mode is unknown, or if the structure
+            definition is malformed.
 
     """
     model_name = tokenizer.name_or_path
+    fingerprint = tokenizer_fingerprint(tokenizer)
 
     if guided_decoding_params.json:
+        schema = canonicalize_json_schema(guided_decoding_params.json)
         compilation_key = compilation_manager.submit(
-            compile_json, model_name, guided_decoding_params.json
+            compile_json, model_name, schema, fingerprint, priority, tenant, timings
         )
+        load_index = load_json_index
         build_guide = build_json_guide
     elif guided_decoding_params.regex:
+        schema = canonicalize_regex(guided_decoding_params.regex)
         compilation_key = compilation_manager.submit(
-            compile_regex, model_name, guided_decoding_params.regex
+            compile_regex, model_name, schema, fingerprint, priority, tenant, timings
         )
+        load_index = load_regex_index
         build_guide = build_regex_guide
     elif guided_decoding_params.grammar:
+        schema = canonicalize_grammar(guided_decoding_params.grammar)
         compilation_key = compilation_manager.submit(
-            compile_grammar, model_name, guided_decoding_params.grammar
+            compile_grammar,
+            model_name,
+            schema,
+            fingerprint,
+            priority,
+            tenant,
+            timings,
         )
+        load_index = load_grammar_index
         build_guide = build_grammar_guide
     else:
         raise ValueError(f"Unknown guided decoding mode {guided_decoding_params}")
 
-    return LogitsProcessor(compilation_key, compilation_manager, build_guide)
+    return LogitsProcessor(
+        compilation_key, compilation_manager, load_index, build_guide, timings
+    )
+
+
+def fork_guide(guide):
+    """Return a copy of `guide` in the same state, or None if it cannot be copied.
+
+    Guides opt in by implementing `__copy__`, which must share the index
+    rather than copy it, so that forking a guide is O(1).
+
+    """
+    if guide is None or not hasattr(guide, "__copy__"):
+        return None
+    return copy.copy(guide)
 
 
 class LogitsProcessor:
-    def __init__(self, compilation_key: str, compilation_manager, build_guide):
+    # Thresholds of the masking strategies of the per-sequence path, see
+    # `dotllm.masking`, when the masks are built at every step and when they
+    # are cached. They are set by the engine from the `DotConfig`.
+    sparse_max_tokens = 16384
+    complement_max_tokens = 1024
+    cached_sparse_max_tokens = 0
+    cached_complement_max_tokens = 2048
+
+    def __init__(
+        self,
+        compilation_key: str,
+        compilation_manager,
+        load_index,
+        build_guide,
+        timings: Optional[RequestTimings] = None,
+    ):
         """Initialize the base logits processor.
 
         Args:
-            guide: Pre-compiled guide instance. If None, compilation will be needed.
+            compilation_key: The key of the index in the compilation manager.
+            compilation_manager: The compilation manager.
+            load_index: Function that deserializes the index.
+            build_guide: Function that builds a guide from a deserialized index.
+            timings: The timings of the request, where the construction of
+                the guide and the computation of the masks are recorded.
 
         """
         self.compilation_key = compilation_key
         self.compilation_manager = compilation_manager
+        self.load_index = load_index
         self.build_guide = build_guide
+        self.timings = timings
         self.guide = None
 
+        # Number of generated tokens read by the guide, the tokens allowed
+        # after reading them, and the key of the guide's state. The guide may
+        # be advanced ahead of the sampler by `prefetch`, so the state is
+        # protected by a lock.
+        self._num_read = 0
+        self._allowed_tokens = None
+        self._state = None
+        self._prefix_hash = 0
+        self._lock = threading.RLock()
+        self._prefetch: Optional[Future] = None
+        self.prefetcher = None
+
+        # Masks of the guide states, shared by the processors of all requests
+        self.mask_cache = None
+        if compilation_manager is not None:
+            self.mask_cache = compilation_manager.mask_cache
+
+    def allowed_tokens(self, input_ids: list[int]):
+        """Return the tokens allowed at this step.
+
+        If the allowed tokens were prefetched we only wait for the remainder of
+        the computation, and record the time spent waiting.
+
+        Args:
+            input_ids: The token IDs generated so far.
+
+        Returns:
+            The ids of the allowed tokens.
+
+        """
+        return self._allowed_tokens_and_state(input_ids)[0]
+
+    def _allowed_tokens_and_state(self, input_ids: list[int]):
+        """Return the tokens allowed at this step, and the key of the guide state."""
+        if self._prefetch is not None:
+            start = time.perf_counter()
+            prefetch, self._prefetch = self._prefetch, None
+            prefetch.result()
+            if self.prefetcher is not None:
+                self.prefetcher.record_wait(time.perf_counter() - start)
+
+        with self._lock:
+            return self._advance(input_ids), self._state
+
+    def prefetch(self, input_ids: list[int], executor: Executor) -> None:
+        """Compute the tokens allowed after `input_ids` in the background.
+
+        This is called as soon as the last token in `input_ids` is sampled, so
+        the guide runs while the model computes the next forward pass.
+
+        Args:
+            input_ids: The token IDs generated so far.
+            executor: The executor that runs the computation.
+
+        """
+        self._prefetch = executor.submit(self._advance, list(input_ids))
+
+    def _advance(self, input_ids: list[int]):
+        """Advance the guide to the end of `input_ids` and return the allowed tokens."""
+        # The lock is reentrant, `_allowed_tokens_and_state` holds it too
+        with self._lock:
+            # During the first run we retrieve the deserialized index from the
+            # compilation manager and build the guide. The index is shared by
+            # all the requests that use it.
+            #
+            # Requests served by `DotEngine` are only scheduled once their index
+            # is compiled, so this does not block. Requests added directly to
+            # `_DotAsyncLLMEngine` wait for the compilation here.
+            if self.guide is None:
+                start = time.perf_counter()
+                index = self.compilation_manager.get_live_index(
+                    self.compilation_key, self.load_index
+                )
+                loaded = time.perf_counter()
+                self.guide = self.build_guide(index)
+                built = time.perf_counter()
+                metrics.guide_build_duration.observe(built - loaded)
+                if self.timings is not None:
+                    self.timings.index_load += loaded - start
+                    self.timings.guide_build += built - loaded
+
+            if self._allowed_tokens is not None and self._num_read == len(input_ids):
+                return self._allowed_tokens
+
+            if len(input_ids) == 0:
+                self._allowed_tokens = self.guide.get_start_tokens()
+            else:
+                for token in input_ids[self._num_read :]:
+                    self._allowed_tokens = self.guide.read_next_token(token)
+                    self._prefix_hash = hash((self._prefix_hash, token))
+            self._num_read = len(input_ids)
+
+            # The guide is deterministic, so the tokens read so far identify
+            # its state when it does not expose one.
+            get_state = getattr(self.guide, "get_state", None)
+            self._state = get_state() if get_state is not None else self._prefix_hash
+
+            return self._allowed_tokens
+
+    def is_terminated(self, input_ids: list[int], stop_token_ids) -> bool:
+        """Check whether the guide can only stop after `input_ids`.
+
+        This is the case when the guide allows no token at all, or only tokens
+        that stop the sequence, e.g. once a JSON object is closed. If the
+        allowed tokens are still being prefetched we do not wait for them:
+        this is called for every guided sequence on every step, and waiting
+        would serialize the prefetch before the next forward pass. The
+        sequence then goes on, and the next step's mask only allows the stop
+        tokens, so it stops after sampling one, like without this check.
+
+        Args:
+            input_ids: The token IDs generated so far.
+            stop_token_ids: The tokens that stop the sequence.
+
+        Returns:
+            True if the sequence cannot be continued.
+
+        """
+        if self._prefetch is not None and not self._prefetch.done():
+            return False
+        allowed_tokens = self.allowed_tokens(input_ids)
+        if len(allowed_tokens) > len(stop_token_ids):
+            return False
+        return all(int(token) in stop_token_ids for token in allowed_tokens)
+
+    def forced_tokens(
+        self, input_ids: list[int], max_tokens: int, excluded_tokens=()
+    ) -> list[int]:
+        """Return the tokens that the guide forces after `input_ids`.
+
+        Tokens are forced as long as the guide allows a single token, so
+        property names, braces and quotes in a JSON object are returned in one
+        call. The guide reads the forced tokens.
+
+        Args:
+            input_ids: The token IDs generated so far.
+            max_tokens: The maximum number of tokens to return.
+            excluded_tokens: Tokens that are never forced, e.g. the EOS token,
+                so that the sampler still ends the sequence.
+
+        Returns:
+            The forced tokens, possibly none.
+
+        """
+        input_ids = list(input_ids)
+        forced = []
+        while len(forced) < max_tokens:
+            allowed_tokens = self.allowed_tokens(input_ids)
+            if len(allowed_tokens) != 1:
+                break
+            token = int(allowed_tokens[0])
+            if token in excluded_tokens:
+                break
+            forced.append(token)
+            input_ids.append(token)
+        return forced
+
+    def fill_bitmask(self, input_ids: list[int], bitmask_row: np.ndarray) -> None:
+        """Set the bits of the allowed tokens in a row of a packed bitmask.
+
+        This is used by `dotllm.sampler.apply_logits_processors` to mask the
+        logits of all the guided sequences in a batch at once.
+
+        Args:
+            input_ids: The token IDs generated so far.
+            bitmask_row: A row of a bitmask allocated with `allocate_token_bitmask`.
+
+        """
+        start = time.perf_counter()
+        self._fill_bitmask(input_ids, bitmask_row)
+        if self.timings is not None:
+            self.timings.record_mask(time.perf_counter() - start)
+
+    def _fill_bitmask(self, input_ids: list[int], bitmask_row: np.ndarray) -> None:
+        allowed_tokens, state = self._allowed_tokens_and_state(input_ids)
+        if self.mask_cache is None:
+            fill_token_bitmask(bitmask_row, allowed_tokens)
+            return
+
+        key = (self.compilation_key, state, "bitmask", bitmask_row.shape[0])
+        cached_row = self.mask_cache.get(key)
+        if cached_row is not None:
+            np.copyto(bitmask_row, cached_row)
+            return
+
+        fill_token_bitmask(bitmask_row, allowed_tokens)
+        self.mask_cache.put(key, bitmask_row.copy())
+
     def __call__(self, input_ids: list[int], logits: torch.Tensor) -> torch.Tensor:
         """Mask the allowed tokens.
 
-        This implementation waits for guide compilation to complete if necessary,
-        then uses the guide to determine allowed tokens.
+        This is the per-sequence path used when the batched masking in
+        `dotllm.sampler` is disabled. The masking strategy depends on the
+        number of allowed tokens, see `dotllm.masking`.
 
         Args:
             input_ids: The input token IDs.
@@ -88,37 +356,88 @@ class LogitsProcessor:
             The processed logits.
 
         """
-        # During the first run we retrieve the compiled index from the compilation
-        # manager (and wait for it to be available) and build the guide.
-        #
-        # Ideally we would use a custom scheduler that does not schedule sequences
-        # for generation until the index is compiled. This would avoid reducing
-        # the throughput in cases where some schemas take a longer time to compile
-        # than others.
-        if self.guide is None:
-            serialized_index = self.compilation_manager.get_index(self.compilation_key)
-            if serialized_index is None:
-                return logits
-            self.guide = self.build_guide(serialized_index)
-
-        # Now use the guide to process logits
-        #
-        # This is a very low-performance implementation. This should be replaced, and
-        # then ideally move this computation to happen behind the forward pass, which
-        # may require modifying `DotLLMAsyncEngine` or subclassing the sampler.
-        if len(input_ids) == 0:
-            allowed_tokens = self.guide.get_start_tokens()
+        start = time.perf_counter()
+        allowed_tokens, state = self._allowed_tokens_and_state(input_ids)
+        computed = time.perf_counter()
+
+        vocab_size = logits.shape[-1]
+        # A cached mask is built once per guide state and then only applied,
+        # which makes the full-vocabulary mask competitive for more states
+        if self.mask_cache is not None and self.mask_cache.max_bytes > 0:
+            strategy = choose_mask_strategy(
+                len(allowed_tokens),
+                vocab_size,
+                self.cached_sparse_max_tokens,
+                self.cached_complement_max_tokens,
+            )
         else:
-            last_token = input_ids[-1]
-            allowed_tokens = self.guide.read_next_token(last_token)
-
-        mask = torch.full((logits.shape[-1],), -torch.inf, device=logits.device)
-        allowed_tokens = np.array(allowed_tokens, dtype=np.int64)
-        allowed_tokens = torch.tensor(allowed_tokens, device=logits.device)
-        mask.index_fill_(0, allowed_tokens, 0)
-        return logits.add_(mask)
-
-    def __clone__(self):
-        return LogitsProcessor(
-            self.compilation_key, self.compilation_manager, self.build_guide
+            strategy = choose_mask_strategy(
+                len(allowed_tokens),
+                vocab_size,
+                self.sparse_max_tokens,
+                self.complement_max_tokens,
+            )
+        key = (self.compilation_key, state, strategy, vocab_size, logits.device)
+        mask = self.mask_cache.get(key) if self.mask_cache is not None else None
+        if mask is None:
+            mask = build_mask(strategy, allowed_tokens, vocab_size, logits.device)
+            if self.mask_cache is not None:
+                self.mask_cache.put(key, mask)
+        logits = apply_mask(strategy, logits, mask)
+
+        applied = time.perf_counter()
+        metrics.mask_compute_duration.labels(path="per-sequence").observe(
+            computed - start
+        )
+        metrics.mask_apply_duration.labels(path="per-sequence").observe(
+            applied - computed
+        )
+        if self.timings is not None:
+            self.timings.record_mask(applied - start)
+        return logits
+
+    def clone(self) -> "LogitsProcessor":
+        """Fork the processor for another sequence of the same request.
+
+        vLLM calls this through `SamplingParams.clone` when a request with
+        `n > 1` is split into one sequence group per sample, so each sequence
+        gets its own guide. The fork continues from the parent's state with a
+        copy of its guide that shares the index. If the guide cannot be
+        copied, the fork builds a guide over the same live index on its first
+        call and replays the tokens read by the parent. The fork shares the
+        parent's timings.
+
+        Returns:
+            The forked logits processor.
+
+        """
+        processor = LogitsProcessor(
+            self.compilation_key,
+            self.compilation_manager,
+            self.load_index,
+            self.build_guide,
+            self.timings,
         )
+        with self._lock:
+            guide = fork_guide(self.guide)
+            if guide is not None:
+                processor.guide = guide
+                processor._num_read = self._num_read
+                processor._allowed_tokens = self._allowed_tokens
+                processor._state = self._state
+                processor._prefix_hash = self._prefix_hash
+        return processor
+
+    def __deepcopy__(self, memo) -> "LogitsProcessor":
+        # The guide and the compilation manager must not be deep-copied
+        return self.clone()
+
+    def reset(self) -> None:
+        """Go back to the start state of the guide."""
+        with self._lock:
+            self.guide = None
+            self._num_read = 0
+            self._allowed_tokens = None
+            self._state = None
+            self._prefix_hash = 0
+            self._prefetch = None
@@ -0,0 +1,117 @@
+"""DotLLM cache of the token masks of the guide states."""
+
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+import numpy as np
+import torch
+
+from dotllm import metrics
+
+
+logger = logging.getLogger("dotllm.mask_cache")
+
+
+def mask_nbytes(mask: Any) -> int:
+    """Return the size of a cached mask in bytes."""
+    if isinstance(mask, torch.Tensor):
+        return mask.element_size() * mask.nelement()
+    if isinstance(mask, np.ndarray):
+        return mask.nbytes
+    return 0
+
+
+class MaskCache:
+    """LRU cache of ready-made token masks, keyed by index and guide state.
+
+    Requests that share a schema go through the same guide states over and
+    over, starting with the start state, and the allowed tokens of a state
+    only depend on the index. The masks built for a state (a packed bitmask
+    row, or a dense additive mask on the logits' device) are cached so that
+    the next request in the same state only has to copy or apply them.
+
+    The cache is shared by all the logits processors and holds at most
+    `max_bytes` bytes of masks; the least recently used masks are evicted
+    first.
+
+    """
+
+    def __init__(self, max_bytes: int):
+        """Initialize the MaskCache.
+
+        Args:
+            max_bytes: The maximum total size of the cached masks. 0 disables
+                the cache.
+        """
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Get the mask corresponding to `key` and mark it as recently used.
+
+        Args:
+            key: The key of the mask, e.g. `(compilation_key, state, kind)`.
+
+        Returns:
+            The cached mask, or None if it is not in the cache.
+        """
+        if self.max_bytes <= 0:
+            return None
+
+        with self._lock:
+            mask = self._entries.get(key)
+            if mask is None:
+                self.misses += 1
+                metrics.mask_cache_misses.inc()
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            metrics.mask_cache_hits.inc()
+            return mask
+
+    def put(self, key: Hashable, mask: Any):
+        """Add a mask to the cache and evict the coldest masks if needed.
+
+        Args:
+            key: The key of the mask.
+            mask: The mask. It must not be modified once cached.
+        """
+        num_bytes = mask_nbytes(mask)
+        if num_bytes > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = mask
+            self.num_bytes += num_bytes
+            while self.num_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.num_bytes -= mask_nbytes(evicted)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self) -> dict:
+        """Return the hit rate and the size of the cache.
+
+        Returns:
+            A dictionary with the hits and misses, the hit rate, and the
+            number of masks and bytes held in the cache.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "mask_cache_hits": self.hits,
+                "mask_cache_misses": self.misses,
+                "mask_cache_hit_rate": self.hits / lookups if lookups else 0.0,
+                "num_cached_masks": len(self._entries),
+                "mask_cache_bytes": self.num_bytes,
+            }
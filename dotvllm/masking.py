@@ -0,0 +1,97 @@
+"""DotLLM strategies to mask the logits of a single sequence.
+
+The cheapest way to mask the logits depends on the number of allowed tokens:
+
+- `sparse`: when only a handful of tokens are allowed, as inside the structure
+  of a JSON object, we gather their logits, fill the row with `-inf`, and
+  scatter them back. Nothing of the size of the vocabulary is allocated.
+- `complement`: when almost every token is allowed, as inside a free-text
+  string, we only set the logits of the disallowed tokens to `-inf`.
+- `dense`: otherwise we add a full-vocabulary mask of `0` and `-inf`.
+
+What each strategy applies (the allowed ids, the disallowed ids, or the dense
+mask) is built once per guide state and kept in the `MaskCache`, so the
+`sparse` and `complement` strategies also take less room in the cache.
+
+`benchmarks/bench_adaptive_masking.py` measures the crossover points.
+
+"""
+
+import numpy as np
+import torch
+
+
+def choose_mask_strategy(
+    num_allowed: int,
+    vocab_size: int,
+    sparse_max_tokens: int,
+    complement_max_tokens: int,
+) -> str:
+    """Choose how to mask the logits of a sequence.
+
+    Args:
+        num_allowed: The number of allowed tokens.
+        vocab_size: The size of the logits.
+        sparse_max_tokens: Use the `sparse` strategy up to this many allowed
+            tokens.
+        complement_max_tokens: Use the `complement` strategy up to this many
+            disallowed tokens.
+
+    Returns:
+        One of `sparse`, `complement` or `dense`.
+    """
+    if num_allowed <= sparse_max_tokens:
+        return "sparse"
+    if vocab_size - num_allowed <= complement_max_tokens:
+        return "complement"
+    return "dense"
+
+
+def build_allowed_tokens(allowed_tokens, device) -> torch.Tensor:
+    """Copy the ids of the allowed tokens to `device`, for the `sparse` strategy."""
+    allowed_tokens = np.asarray(allowed_tokens, dtype=np.int64)
+    return torch.from_numpy(allowed_tokens).to(device)
+
+
+def build_disallowed_tokens(allowed_tokens, vocab_size: int, device) -> torch.Tensor:
+    """Return the ids of the tokens that are not allowed, for the `complement` strategy."""
+    disallowed = np.ones(vocab_size, dtype=bool)
+    disallowed[np.asarray(allowed_tokens, dtype=np.int64)] = False
+    return torch.from_numpy(np.flatnonzero(disallowed)).to(device)
+
+
+def build_dense_mask(allowed_tokens, vocab_size: int, device) -> torch.Tensor:
+    """Build an additive mask, `0` for the allowed tokens and `-inf` elsewhere."""
+    mask = torch.full((vocab_size,), -torch.inf, device=device)
+    mask.index_fill_(0, build_allowed_tokens(allowed_tokens, device), 0)
+    return mask
+
+
+def build_mask(strategy: str, allowed_tokens, vocab_size: int, device) -> torch.Tensor:
+    """Build what `apply_mask` needs to apply `strategy`."""
+    if strategy == "sparse":
+        return build_allowed_tokens(allowed_tokens, device)
+    if strategy == "complement":
+        return build_disallowed_tokens(allowed_tokens, vocab_size, device)
+    return build_dense_mask(allowed_tokens, vocab_size, device)
+
+
+def apply_mask(strategy: str, logits: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+    """Mask the logits of a sequence in place.
+
+    Args:
+        strategy: The strategy returned by `choose_mask_strategy`.
+        logits: The `(vocab_size,)` logits of the sequence.
+        mask: The output of `build_mask` for the same strategy.
+
+    Returns:
+        The masked logits.
+    """
+    if strategy == "sparse":
+        # Gather the allowed logits, and scatter them back over `-inf`
+        values = logits.index_select(0, mask)
+        logits.fill_(-torch.inf)
+        return logits.index_copy_(0, mask, values)
+    if strategy == "complement":
+        return logits.index_fill_(0, mask, -torch.inf)
+    return logits.add_(mask)
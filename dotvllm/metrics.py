@@ -0,0 +1,137 @@
+"""DotLLM Prometheus metrics.
+
+The metrics are registered in `prometheus_client`'s default registry, which
+vLLM serves on the `/metrics` endpoint mounted by `build_app`. They are
+prefixed with `dotvllm:`, next to vLLM's `vllm:` metrics.
+
+Labels only take a handful of values (the backend, the masking path, the
+cache tier, the outcome of a compilation): schemas, request ids and tenants
+are never used as labels.
+
+"""
+
+from typing import Callable
+
+from prometheus_client import Counter, Gauge, Histogram
+
+
+COMPILE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+LOAD_BUCKETS = (1e-4, 5e-4, 1e-3, 5e-3, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+MASK_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 0.01, 0.05)
+
+
+compile_duration = Histogram(
+    "dotvllm:compile_duration_seconds",
+    "Time spent compiling an index, from its dispatch to a worker.",
+    ["backend", "status"],
+    buckets=COMPILE_BUCKETS,
+)
+compile_queue_wait = Histogram(
+    "dotvllm:compile_queue_wait_seconds",
+    "Time spent by a compilation in the queue before being dispatched.",
+    buckets=COMPILE_BUCKETS,
+)
+compile_queue_depth = Gauge(
+    "dotvllm:compile_queue_depth",
+    "Number of compilations waiting in the queue.",
+)
+compile_running = Gauge(
+    "dotvllm:compile_running",
+    "Number of compilations running in the workers.",
+)
+
+index_cache_hits = Counter(
+    "dotvllm:index_cache_hits_total",
+    "Indexes found in the in-memory or on-disk cache.",
+    ["tier"],
+)
+index_cache_misses = Counter(
+    "dotvllm:index_cache_misses_total",
+    "Indexes that had to be compiled.",
+)
+index_cache_evictions = Counter(
+    "dotvllm:index_cache_evictions_total",
+    "Indexes evicted from the in-memory cache.",
+)
+index_cache_bytes = Gauge(
+    "dotvllm:index_cache_bytes",
+    "Bytes of serialized indexes resident in memory.",
+)
+index_cache_entries = Gauge(
+    "dotvllm:index_cache_entries",
+    "Number of indexes resident in memory.",
+)
+
+index_wait = Histogram(
+    "dotvllm:index_wait_seconds",
+    "Time spent waiting for an index in `get_index` (sync, blocks the engine "
+    "loop) or `get_index_async` (async, parks the request).",
+    ["mode"],
+    buckets=COMPILE_BUCKETS,
+)
+index_load_duration = Histogram(
+    "dotvllm:index_load_seconds",
+    "Time spent deserializing an index.",
+    buckets=LOAD_BUCKETS,
+)
+index_decompress_duration = Histogram(
+    "dotvllm:index_decompress_seconds",
+    "Time spent decompressing an index before deserializing it.",
+    ["codec"],
+    buckets=LOAD_BUCKETS,
+)
+index_compression_ratio = Histogram(
+    "dotvllm:index_compression_ratio",
+    "Ratio of the decompressed to the compressed size of the indexes.",
+    ["codec"],
+    buckets=(1, 1.5, 2, 3, 4, 6, 8, 12, 16, 24, 32, 64),
+)
+guide_build_duration = Histogram(
+    "dotvllm:guide_build_seconds",
+    "Time spent building the guide of a request over a deserialized index.",
+    buckets=LOAD_BUCKETS,
+)
+
+mask_compute_duration = Histogram(
+    "dotvllm:mask_compute_seconds",
+    "Time spent computing the token masks of a step.",
+    ["path"],
+    buckets=MASK_BUCKETS,
+)
+mask_cache_hits = Counter(
+    "dotvllm:mask_cache_hits_total",
+    "Token masks found in the cache of the guide states.",
+)
+mask_cache_misses = Counter(
+    "dotvllm:mask_cache_misses_total",
+    "Token masks that had to be built from the allowed tokens.",
+)
+mask_cache_bytes = Gauge(
+    "dotvllm:mask_cache_bytes",
+    "Bytes of token masks held in the cache of the guide states.",
+)
+mask_apply_duration = Histogram(
+    "dotvllm:mask_apply_seconds",
+    "Time spent applying the token masks of a step to the logits.",
+    ["path"],
+    buckets=MASK_BUCKETS,
+)
+
+jump_forward_tokens = Counter(
+    "dotvllm:jump_forward_tokens_total",
+    "Tokens forced by the guides and appended without being sampled.",
+)
+early_terminations = Counter(
+    "dotvllm:early_terminations_total",
+    "Sequences stopped as soon as their guide could only stop, without "
+    "sampling the stop token.",
+)
+
+
+def backend_label(func: Callable) -> str:
+    """Return the backend of a compilation function, e.g. `json` for `compile_json`."""
+    name = getattr(func, "__name__", "")
+    if name.startswith("compile_"):
+        return name[len("compile_") :]
+    return "other"
+
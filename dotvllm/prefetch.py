@@ -0,0 +1,113 @@
+"""DotLLM computation of the next token masks during the forward pass."""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from vllm.model_executor.layers.sampler import SamplerOutput
+from vllm.model_executor.sampling_metadata import SamplingMetadata
+
+from dotllm.logits_processor import LogitsProcessor
+
+
+logger = logging.getLogger("dotllm.prefetch")
+
+
+class MaskPrefetcher:
+    """Advance the guides in the background as soon as tokens are sampled.
+
+    Once the sampler has picked the tokens of step `t`, the guides of the
+    guided sequences are advanced in a thread pool while the model runs the
+    forward pass of step `t + 1`. The logits processors then only wait for the
+    part of the computation that is not finished yet.
+
+    The time spent waiting is the part of the mask computation that is still
+    exposed to the inter-token latency, and is recorded per step.
+
+    """
+
+    def __init__(self, num_workers: int):
+        """Initialize the MaskPrefetcher.
+
+        Args:
+            num_workers: The number of threads that advance the guides.
+        """
+        self.executor = ThreadPoolExecutor(
+            max_workers=num_workers, thread_name_prefix="dotllm-prefetch"
+        )
+        self._lock = threading.Lock()
+        self._step_wait_time = 0.0
+        self.last_step_wait_time = 0.0
+        self.max_step_wait_time = 0.0
+        self.total_wait_time = 0.0
+        self.num_steps = 0
+
+    def submit(
+        self, sampling_metadata: SamplingMetadata, sampler_output: SamplerOutput
+    ) -> None:
+        """Prefetch the allowed tokens of the sequences that were just sampled.
+
+        Sequences that the sampled token finishes, because it is a stop token
+        (EOS included) or because it reaches `max_tokens`, are skipped: their
+        guide would read a token it is never asked about, or that it does not
+        allow.
+
+        Args:
+            sampling_metadata: vLLM's sampling metadata for the batch.
+            sampler_output: The output of the sampler for the batch.
+        """
+        for seq_group, group_output in zip(
+            sampling_metadata.seq_groups, sampler_output.outputs
+        ):
+            params = seq_group.sampling_params
+            logits_processors = params.logits_processors or []
+            processor = next(
+                (p for p in logits_processors if isinstance(p, LogitsProcessor)), None
+            )
+            # Processors shared by several sequences cannot be advanced ahead
+            if processor is None or len(group_output.samples) != 1:
+                continue
+
+            sample = group_output.samples[0]
+            seq_data = seq_group.seq_data[sample.parent_seq_id]
+            input_ids = list(seq_data.output_token_ids) + [sample.output_token]
+            if sample.output_token in params.all_stop_token_ids or (
+                params.max_tokens is not None and len(input_ids) >= params.max_tokens
+            ):
+                continue
+
+            processor.prefetcher = self
+            processor.prefetch(input_ids, self.executor)
+
+        self.end_step()
+
+    def record_wait(self, seconds: float) -> None:
+        """Record time the sampler spent waiting for a prefetched mask."""
+        with self._lock:
+            self._step_wait_time += seconds
+
+    def end_step(self) -> None:
+        """Close the statistics of the current step."""
+        with self._lock:
+            self.last_step_wait_time = self._step_wait_time
+            self.max_step_wait_time = max(self.max_step_wait_time, self._step_wait_time)
+            self.total_wait_time += self._step_wait_time
+            self.num_steps += 1
+            self._step_wait_time = 0.0
+
+        logger.debug(f"Mask wait time: {self.last_step_wait_time * 1e3:.3f}ms")
+
+    def stats(self) -> dict:
+        """Return the mask wait time statistics.
+
+        Returns:
+            A dictionary with the wait time of the last step, the maximum and
+            mean wait time per step, in seconds, and the number of steps.
+        """
+        with self._lock:
+            return {
+                "last_step_wait_time": self.last_step_wait_time,
+                "max_step_wait_time": self.max_step_wait_time,
+                "mean_step_wait_time": self.total_wait_time / max(self.num_steps, 1),
+                "num_steps": self.num_steps,
+            }
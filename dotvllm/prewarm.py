@@ -0,0 +1,124 @@
+"""DotLLM compilation of a corpus of structure definitions at startup."""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import List
+
+from vllm.sampling_params import GuidedDecodingParams
+
+from dotllm.compilation_manager import CompilationManager
+from dotllm.logits_processor import get_logits_processor
+
+
+logger = logging.getLogger("dotllm.prewarm")
+
+JSON_EXTENSIONS = {".json"}
+REGEX_EXTENSIONS = {".regex", ".re"}
+GRAMMAR_EXTENSIONS = {".lark", ".ebnf", ".grammar"}
+
+# Prewarming compilations are queued behind the requests' compilations
+PREWARM_PRIORITY = 1000
+
+
+def load_definitions(path: str) -> List[GuidedDecodingParams]:
+    """Load the structure definitions in a file or a directory.
+
+    The type of a definition is given by the extension of its file: `.json`
+    files contain a JSON schema, `.regex` and `.re` files a regular expression,
+    and `.lark`, `.ebnf` and `.grammar` files a grammar. A `.jsonl` file
+    contains one definition per line, as `{"type": "json" | "regex" |
+    "grammar", "definition": ...}`. Directories are walked recursively.
+
+    Args:
+        path: The path to a file or a directory.
+
+    Returns:
+        The guided decoding parameters of every definition.
+    """
+    if os.path.isdir(path):
+        definitions = []
+        for root, _, filenames in sorted(os.walk(path)):
+            for filename in sorted(filenames):
+                definitions.extend(load_definitions(os.path.join(root, filename)))
+        return definitions
+
+    extension = os.path.splitext(path)[1]
+    with open(path) as f:
+        content = f.read()
+
+    if extension in JSON_EXTENSIONS:
+        return [GuidedDecodingParams(json=content)]
+    if extension in REGEX_EXTENSIONS:
+        return [GuidedDecodingParams(regex=content.rstrip("\n"))]
+    if extension in GRAMMAR_EXTENSIONS:
+        return [GuidedDecodingParams(grammar=content)]
+    if extension == ".jsonl":
+        definitions = []
+        for line in content.splitlines():
+            if line.strip():
+                entry = json.loads(line)
+                definitions.append(
+                    GuidedDecodingParams(**{entry["type"]: entry["definition"]})
+                )
+        return definitions
+
+    logger.warning(f"Ignoring {path}: unknown extension")
+    return []
+
+
+async def prewarm(
+    path: str,
+    tokenizer,
+    compilation_manager: CompilationManager,
+    concurrency: int,
+) -> None:
+    """Compile the structure definitions in `path` and keep them in the caches.
+
+    At most `concurrency` definitions are compiled at the same time, so the
+    requests that arrive during prewarming still get a compilation worker.
+
+    Args:
+        path: The path to a file or a directory of definitions.
+        tokenizer: The tokenizer of the served model.
+        compilation_manager: The compilation manager.
+        concurrency: The maximum number of concurrent compilations.
+    """
+    definitions = load_definitions(path)
+    logger.info(f"Prewarming {len(definitions)} indexes from {path}")
+
+    semaphore = asyncio.Semaphore(concurrency)
+    num_bytes = compilation_manager.stats()["num_bytes"]
+    start = time.perf_counter()
+
+    async def compile_one(guided_decoding_params: GuidedDecodingParams) -> bool:
+        async with semaphore:
+            try:
+                processor = get_logits_processor(
+                    guided_decoding_params,
+                    tokenizer,
+                    compilation_manager,
+                    priority=PREWARM_PRIORITY,
+                )
+            except ValueError as e:
+                logger.warning(f"Skipping malformed definition: {e}")
+                return False
+
+            try:
+                await compilation_manager.get_index_async(processor.compilation_key)
+                return True
+            except ValueError:
+                return False
+            finally:
+                compilation_manager.release(processor.compilation_key)
+
+    results = await asyncio.gather(*(compile_one(d) for d in definitions))
+
+    elapsed = time.perf_counter() - start
+    num_bytes = compilation_manager.stats()["num_bytes"] - num_bytes
+    logger.info(
+        f"Prewarmed {sum(results)}/{len(definitions)} indexes in {elapsed:.1f}s, "
+        f"using {num_bytes / 1024**2:.1f} MiB of memory"
+    )
@@ -1,5 +1,7 @@
 import logging
 
+from dotllm.processors.worker import get_vocabulary
+
 
 logger = logging.getLogger("dotllm.processors.dotgrammar")
 
@@ -22,14 +24,19 @@ def compile_grammar(model_name: str, grammar: str):
         lazy_build_scanner_fsm=False,
     )
     parser = PartialParser.from_lark(lp)
-    vocabulary = Vocabulary.from_pretrained(model_name)
+    vocabulary = get_vocabulary(Vocabulary, model_name)
     index = CFGVocabularyIndex.build(parser, vocabulary)
     logger.info("Grammar index compilation complete")
-    return index.serialize()
+    return index
+
+
+def load_grammar_index(serialized_index):
+    from dotcfg import CFGVocabularyIndex
+
+    return CFGVocabularyIndex.deserialize(serialized_index)
 
 
-def build_grammar_guide(serialized_index):
-    from dotcfg import Guide, CFGVocabularyIndex
+def build_grammar_guide(index):
+    from dotcfg import Guide
 
-    index = CFGVocabularyIndex.deserialize(serialized_index)
     return Guide(index)
@@ -1,5 +1,7 @@
 import logging
 
+from dotllm.processors.worker import get_vocabulary
+
 
 logger = logging.getLogger("dotllm.processors.dotjson")
 
@@ -8,14 +10,19 @@ def compile_json(model_name: str, json_schema: str):
     from dotregex import Vocabulary, Index
 
     logger.info(f"Compiling JSON index for schema: {json_schema[:50]}...")
-    vocabulary = Vocabulary.from_pretrained(model_name)
+    vocabulary = get_vocabulary(Vocabulary, model_name)
     index = Index.from_schema(json_schema, vocabulary)
     logger.info("JSON index compilation complete")
-    return index.serialize()
+    return index
+
+
+def load_json_index(serialized_index):
+    from dotregex import Index
+
+    return Index.deserialize(serialized_index)
 
 
-def build_json_guide(serialized_index):
-    from dotregex import Index, Guide
+def build_json_guide(index):
+    from dotregex import Guide
 
-    index = Index.deserialize(serialized_index)
     return Guide(index)
@@ -1,5 +1,7 @@
 import logging
 
+from dotllm.processors.worker import get_vocabulary
+
 
 logger = logging.getLogger("dotllm.processors.dotregex")
 
@@ -8,14 +10,19 @@ def compile_regex(model_name: str, regex_str: str):
     from dotregex import Vocabulary, Index
 
     logger.info(f"Compiling regex index for pattern: {regex_str[:50]}...")
-    vocabulary = Vocabulary.from_pretrained(model_name)
+    vocabulary = get_vocabulary(Vocabulary, model_name)
     index = Index(regex_str, vocabulary)
     logger.info("Regex index compilation complete")
-    return index.serialize()
+    return index
+
+
+def load_regex_index(serialized_index):
+    from dotregex import Index
+
+    return Index.deserialize(serialized_index)
 
 
-def build_regex_guide(serialized_index):
-    from dotregex import Index, Guide
+def build_regex_guide(index):
+    from dotregex import Guide
 
-    index = Index.deserialize(serialized_index)
     return Guide(index)
@@ -0,0 +1,86 @@
+import logging
+import os
+from typing import Optional
+
+from dotllm.compression import get_codec
+from dotllm.shared_index import write_shared_index
+
+
+logger = logging.getLogger("dotllm.processors.worker")
+
+# Vocabularies built in this worker, keyed by backend and model name
+_vocabularies = {}
+
+# Queue on which the worker reports the jobs it starts to the engine process
+_status_queue = None
+
+
+def get_vocabulary(vocabulary_cls, model_name: str):
+    """Return the vocabulary of `model_name`, building it only once per worker."""
+    key = (vocabulary_cls.__module__, model_name)
+    if key not in _vocabularies:
+        logger.info(f"Loading {vocabulary_cls.__module__} vocabulary for {model_name}")
+        _vocabularies[key] = vocabulary_cls.from_pretrained(model_name)
+    return _vocabularies[key]
+
+
+def init_worker(model_name: Optional[str], status_queue=None):
+    """Initialize a compilation worker.
+
+    This runs once when the worker process starts. It imports the backends
+    and builds the vocabulary of the served model so that the first
+    compilations do not pay for it.
+
+    Args:
+        model_name: The name of the served model, if known.
+        status_queue: Queue on which the worker reports the jobs it starts,
+            so that the engine process can enforce the compilation limits.
+    """
+    global _status_queue
+    _status_queue = status_queue
+
+    if model_name is None:
+        return
+
+    try:
+        from dotregex import Vocabulary
+
+        get_vocabulary(Vocabulary, model_name)
+    except ImportError:
+        logger.warning("dotregex is not installed")
+
+    try:
+        from dotcfg import Vocabulary
+
+        get_vocabulary(Vocabulary, model_name)
+    except ImportError:
+        logger.warning("dotcfg is not installed")
+
+
+def compile_to_shared_memory(
+    func,
+    model_name: str,
+    schema: str,
+    directory: str,
+    owner_pid: int,
+    job_id: Optional[int] = None,
+    codec: Optional[str] = None,
+) -> str:
+    """Compile and serialize an index, and write it to shared memory.
+
+    Only the path of the file is sent back to the engine process, instead of
+    pickling the serialized index through the process pool's pipe. If a codec
+    is given, the index is compressed before it is written.
+
+    """
+    if _status_queue is not None and job_id is not None:
+        _status_queue.put((job_id, os.getpid()))
+    serialized_index = func(model_name, schema).serialize()
+    if codec is not None:
+        serialized_index = get_codec(codec).compress(serialized_index)
+    return write_shared_index(serialized_index, directory, owner_pid)
+
+
+def ping():
+    """No-op task used to start the workers."""
+    return None
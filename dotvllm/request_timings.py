@@ -0,0 +1,125 @@
+"""DotLLM per-request timings of structured generation.
+
+The Prometheus histograms tell that a step of structured generation is slow,
+but not which requests it slowed down. With `--guided-request-timings` every
+guided request carries a `RequestTimings`, filled along its path: the index
+cache lookup in `CompilationManager.submit`, the wait for the compilation,
+the deserialization of the index and the construction of the guide in the
+`LogitsProcessor`, and the computation of its token masks. When the request
+finishes the timings are logged as one JSON line, and the API server returns
+them in the `dotvllm_timings` field of the response.
+
+"""
+
+import json
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+
+logger = logging.getLogger("dotllm.request_timings")
+
+
+@dataclass
+class RequestTimings:
+    """Where the structured generation time of a guided request went.
+
+    Durations are in seconds. The forks of a request with `n > 1` share its
+    timings, so the mask timings cover all its sequences.
+
+    """
+
+    request_id: Optional[str] = None
+    tenant: Optional[str] = None
+    compilation_key: Optional[str] = None
+    # `memory` or `disk` if the index was cached, `miss` if it was compiled
+    index_cache: Optional[str] = None
+    # Time spent parked until the index was compiled
+    compile_wait: float = 0.0
+    # Time spent getting the deserialized index when the guide was built,
+    # including the compilation for requests that were not parked
+    index_load: float = 0.0
+    guide_build: float = 0.0
+    mask_total: float = 0.0
+    mask_max: float = 0.0
+    num_masks: int = 0
+    # From vLLM's request metrics, once the request is finished. The time in
+    # the queue includes the compilation wait.
+    queue_time: Optional[float] = None
+    first_token_time: Optional[float] = None
+    total_time: Optional[float] = None
+
+    def record_mask(self, duration: float) -> None:
+        """Record the time spent computing the mask of one token."""
+        self.mask_total += duration
+        self.mask_max = max(self.mask_max, duration)
+        self.num_masks += 1
+
+    def finish(self, request_metrics=None) -> dict:
+        """Complete the timings with vLLM's metrics of the finished request.
+
+        Args:
+            request_metrics: The `RequestMetrics` of the request's output,
+                if vLLM collected them.
+
+        Returns:
+            The timings, as a dictionary that can be serialized to JSON.
+        """
+        if request_metrics is not None:
+            arrival_time = request_metrics.arrival_time
+            self.queue_time = request_metrics.time_in_queue
+            if request_metrics.first_token_time is not None:
+                self.first_token_time = request_metrics.first_token_time - arrival_time
+            if request_metrics.finished_time is not None:
+                self.total_time = request_metrics.finished_time - arrival_time
+
+        timings = asdict(self)
+        logger.info(f"Request timings: {json.dumps(timings)}")
+        return timings
+
+
+class FinishedTimings:
+    """The timings of the last finished requests, until the API server reads them.
+
+    The server builds the response of a request after its last output, so
+    the timings are kept here in between. Timings that are never read, e.g.
+    those of streamed responses, are dropped once `max_entries` is reached.
+
+    """
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self._timings: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, request_id: str, timings: dict) -> None:
+        with self._lock:
+            self._timings[request_id] = timings
+            while len(self._timings) > self.max_entries:
+                self._timings.popitem(last=False)
+
+    def pop(self, response_id: str) -> list[dict]:
+        """Return and forget the timings of the requests behind a response.
+
+        vLLM's completions endpoint adds one request per prompt, with ids
+        `<response_id>-<index>`, so they are returned together.
+
+        Args:
+            response_id: The `id` of the OpenAI response.
+
+        Returns:
+            The timings of the requests, possibly none.
+        """
+        with self._lock:
+            request_ids = [
+                request_id
+                for request_id in self._timings
+                if request_id == response_id
+                or (
+                    request_id.startswith(f"{response_id}-")
+                    and request_id[len(response_id) + 1 :].isdigit()
+                )
+            ]
+            return [self._timings.pop(request_id) for request_id in request_ids]
@@ -0,0 +1,135 @@
+"""DotLLM batched application of the logits processors.
+
+vLLM V0 calls every logits processor once per sequence, and our
+`LogitsProcessor.__call__` allocates and fills a full-vocabulary mask each
+time. Instead we replace vLLM's `_apply_logits_processors` with a function that
+collects the allowed tokens of every guided sequence in the batch into a
+packed bitmask, and applies it to the logits in one vectorized operation.
+
+"""
+
+import logging
+import time
+from typing import Optional
+
+import numpy as np
+import torch
+import vllm.model_executor.layers.logits_processor as vllm_logits_processor
+from vllm.model_executor.layers.logits_processor import (
+    _apply_logits_processors_single_seq,
+)
+from vllm.model_executor.layers.sampler import Sampler, SamplerOutput
+from vllm.model_executor.sampling_metadata import SamplingMetadata
+
+from dotllm import metrics
+from dotllm.bitmask import allocate_token_bitmask, apply_token_bitmask
+from dotllm.logits_processor import LogitsProcessor
+from dotllm.prefetch import MaskPrefetcher
+
+
+logger = logging.getLogger("dotllm.sampler")
+
+_vllm_apply_logits_processors = vllm_logits_processor._apply_logits_processors
+_vllm_sampler_forward = Sampler.forward
+
+
+def apply_logits_processors(
+    logits: torch.Tensor, sampling_metadata: SamplingMetadata
+) -> torch.Tensor:
+    """Apply the logits processors, masking the guided sequences in one batch.
+
+    Args:
+        logits: The `(num_rows, vocab_size)` logits of the batch.
+        sampling_metadata: vLLM's sampling metadata for the batch.
+
+    Returns:
+        The processed logits.
+    """
+    guided = []
+    for seq_group in sampling_metadata.seq_groups:
+        logits_processors = seq_group.sampling_params.logits_processors
+        if not logits_processors:
+            continue
+
+        # If a sequence has several of our processors, only the first one is
+        # batched and the others are applied per sequence.
+        dot_processor = next(
+            (p for p in logits_processors if isinstance(p, LogitsProcessor)), None
+        )
+        other_processors = [p for p in logits_processors if p is not dot_processor]
+        for seq_id, logits_row_idx in zip(seq_group.seq_ids, seq_group.sample_indices):
+            seq_data = seq_group.seq_data[seq_id]
+            if other_processors:
+                logits[logits_row_idx] = _apply_logits_processors_single_seq(
+                    logits[logits_row_idx],
+                    other_processors,
+                    seq_data.output_token_ids,
+                    seq_data.prompt_token_ids,
+                )
+            if dot_processor is not None:
+                guided.append(
+                    (logits_row_idx, dot_processor, seq_data.output_token_ids)
+                )
+
+    if not guided:
+        return logits
+
+    start = time.perf_counter()
+    # The bitmask covers every row, so that it is applied to the logits in
+    # place rather than to a copy of the guided rows. The other rows allow
+    # every token.
+    bitmask = allocate_token_bitmask(logits.shape[0], logits.shape[-1])
+    bitmask.fill(np.uint32(0xFFFFFFFF))
+    for logits_row_idx, processor, output_token_ids in guided:
+        bitmask[logits_row_idx] = 0
+        processor.fill_bitmask(output_token_ids, bitmask[logits_row_idx])
+    computed = time.perf_counter()
+
+    apply_token_bitmask(logits, bitmask)
+
+    metrics.mask_compute_duration.labels(path="batched").observe(computed - start)
+    metrics.mask_apply_duration.labels(path="batched").observe(
+        time.perf_counter() - computed
+    )
+    return logits
+
+
+def install_batched_logits_processors(enabled: bool = True) -> None:
+    """Replace vLLM's per-sequence application of the logits processors.
+
+    This patches the function called by vLLM's `LogitsProcessor` layer, which
+    runs in the driver worker. Sampling happens in the engine process with V0
+    executors, so patching this module is enough.
+
+    Args:
+        enabled: Whether to use the batched implementation. If False, restore
+            vLLM's original implementation.
+    """
+    if enabled:
+        vllm_logits_processor._apply_logits_processors = apply_logits_processors
+        logger.info("Using batched bitmask masking for guided decoding")
+    else:
+        vllm_logits_processor._apply_logits_processors = _vllm_apply_logits_processors
+
+
+def install_mask_prefetcher(prefetcher: Optional[MaskPrefetcher]) -> None:
+    """Advance the guides in the background as soon as tokens are sampled.
+
+    Args:
+        prefetcher: The prefetcher to hand the sampled tokens to. If None,
+            restore vLLM's original sampler.
+    """
+    if prefetcher is None:
+        Sampler.forward = _vllm_sampler_forward
+        return
+
+    def forward(
+        self: Sampler, logits: torch.Tensor, sampling_metadata: SamplingMetadata
+    ) -> Optional[SamplerOutput]:
+        sampler_output = _vllm_sampler_forward(self, logits, sampling_metadata)
+        if sampler_output is not None:
+            prefetcher.submit(sampling_metadata, sampler_output)
+        return sampler_output
+
+    Sampler.forward = forward
+    logger.info("Computing the token masks during the forward pass")
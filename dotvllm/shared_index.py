@@ -0,0 +1,100 @@
+"""DotLLM serialized indexes shared between processes through memory maps."""
+
+import logging
+import mmap
+import os
+import tempfile
+import uuid
+from typing import Any, Callable
+
+
+logger = logging.getLogger("dotllm.shared_index")
+
+
+def default_shared_memory_dir() -> str:
+    """Return a directory backed by shared memory, if there is one."""
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def write_shared_index(serialized_index: bytes, directory: str, owner_pid: int) -> str:
+    """Write a serialized index to a file that the engine process can map.
+
+    Args:
+        serialized_index: The serialized index.
+        directory: The directory where the file is created.
+        owner_pid: The pid of the engine process, which owns the file.
+
+    Returns:
+        The path of the file.
+    """
+    path = os.path.join(directory, f"dotvllm-{owner_pid}-{uuid.uuid4().hex}.idx")
+    with open(path, "wb") as f:
+        f.write(serialized_index)
+    return path
+
+
+class SharedIndex:
+    """Read-only memory map of a serialized index.
+
+    Compilation workers write the serialized index to a file in a directory
+    backed by shared memory, and only send its path back through the process
+    pool's pipe. The engine process maps the file and the index is deserialized
+    from the mapped buffer, without intermediate `bytes` copies.
+
+    Files written by the workers are owned by the engine and unlinked when the
+    index is closed, i.e. when it is evicted from the `IndexStore`. Files of the
+    on-disk cache can be mapped too, in which case they are not unlinked.
+
+    """
+
+    def __init__(self, path: str, owned: bool = True):
+        """Map the file at `path`.
+
+        Args:
+            path: The path of the file that contains the serialized index.
+            owned: Whether to unlink the file when the index is closed.
+        """
+        self.path = path
+        self.owned = owned
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buffer = memoryview(self._mmap)
+
+    def __len__(self) -> int:
+        return len(self.buffer)
+
+    def load(self, load_index: Callable[[Any], Any]) -> Any:
+        """Deserialize the index from the mapped buffer.
+
+        Args:
+            load_index: Function that deserializes the index.
+
+        Returns:
+            A deserialized index
+        """
+        try:
+            return load_index(self.buffer)
+        except TypeError:
+            # The backend only accepts `bytes`
+            return load_index(bytes(self.buffer))
+
+    def to_buffer(self) -> memoryview:
+        """Return the serialized index, e.g. to write it to the disk cache."""
+        return self.buffer
+
+    def close(self):
+        """Unmap the index, and remove the file if it is owned."""
+        try:
+            self.buffer.release()
+            self._mmap.close()
+        except BufferError:
+            # Still referenced, the mapping is released when collected
+            logger.debug(f"{self.path} is still in use")
+
+        if self.owned:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,95 @@
+"""DotLLM early termination of the guided sequences.
+
+Once a JSON object is closed or a regex fully matched, the guide only allows
+the EOS token, or no token at all. vLLM would still run one more decoding step
+to sample the EOS token. `GuidedStopChecker` stops the sequence as soon as the
+token that completes the structure is sampled, so the request finishes in the
+same step and its slot in the batch is freed for the next step.
+
+"""
+
+import logging
+from typing import Optional
+
+from vllm.engine.output_processor.stop_checker import StopChecker
+from vllm.lora.request import LoRARequest
+from vllm.sampling_params import SamplingParams
+from vllm.sequence import Sequence, SequenceStatus
+
+from dotllm import metrics
+from dotllm.logits_processor import LogitsProcessor
+
+
+logger = logging.getLogger("dotllm.stop_checker")
+
+
+class GuidedStopChecker:
+    """Wrap vLLM's `StopChecker` to stop the sequences whose guide can only stop.
+
+    The sequence is stopped like with an EOS token (`finish_reason` is
+    `stop`), except that the EOS token is not appended to the output.
+
+    """
+
+    def __init__(self, stop_checker: StopChecker):
+        """Initialize the GuidedStopChecker.
+
+        Args:
+            stop_checker: The stop checker of the engine's output processor.
+        """
+        self.stop_checker = stop_checker
+
+    def __getattr__(self, name: str):
+        return getattr(self.stop_checker, name)
+
+    def maybe_stop_sequence(
+        self,
+        seq: Sequence,
+        new_char_count: int,
+        sampling_params: SamplingParams,
+        lora_req: Optional[LoRARequest] = None,
+    ) -> None:
+        """Apply vLLM's stop conditions, then stop the sequence if its guide is done."""
+        self.stop_checker.maybe_stop_sequence(
+            seq, new_char_count, sampling_params, lora_req
+        )
+        if seq.is_finished():
+            return
+
+        # `min_tokens` masks the stop tokens until it is reached
+        if seq.get_output_len() < sampling_params.min_tokens:
+            return
+
+        processor = next(
+            (
+                p
+                for p in sampling_params.logits_processors or []
+                if isinstance(p, LogitsProcessor)
+            ),
+            None,
+        )
+        if processor is None:
+            return
+
+        stop_token_ids = set(sampling_params.all_stop_token_ids)
+        if seq.eos_token_id is not None and not sampling_params.ignore_eos:
+            stop_token_ids.add(seq.eos_token_id)
+        if processor.is_terminated(seq.get_output_token_ids(), stop_token_ids):
+            seq.status = SequenceStatus.FINISHED_STOPPED
+            metrics.early_terminations.inc()
+
+
+def install_guided_stop_checker(output_processor, enabled: bool = True) -> None:
+    """Stop the guided sequences of an engine as soon as their guide is done.
+
+    Args:
+        output_processor: The output processor of the engine.
+        enabled: Whether to stop the sequences early. If False, restore
+            vLLM's stop checker.
+    """
+    stop_checker = output_processor.stop_checker
+    if isinstance(stop_checker, GuidedStopChecker):
+        stop_checker = stop_checker.stop_checker
+    if enabled:
+        stop_checker = GuidedStopChecker(stop_checker)
+    output_processor.stop_checker = stop_checker
@@ -0,0 +1,447 @@
+"""DotLLM structured output backend for the vLLM V1 engine.
+
+vLLM V1 fills the token bitmask of all the guided requests of a step in the
+scheduler, from the `StructuredOutputGrammar` of each request, and applies it
+on the GPU workers. `DotStructuredOutputBackend` plugs our guides into this
+pipeline: the indexes are compiled by the `CompilationManager`, and the rows
+of the bitmask are filled by our `LogitsProcessor`, with the mask cache.
+
+vLLM only knows its own backends, so `install_structured_output_backend`
+patches the two places where they are picked: the validation of the requests
+in the frontend process, and the creation of the backend in the engine core
+process. V1 cannot fail a single request once the engine core has it, so the
+frontend also compiles the index of each guided request before handing it
+over, and returns a `CompilationError` to the client like the V0 engine. The DotLLM configuration is passed to the engine core process in the
+`DOTVLLM_CONFIG` environment variable; `register` is declared as a vLLM plugin
+so that the backend is also installed when the engine core process is spawned
+rather than forked.
+
+"""
+
+import dataclasses
+import json
+import logging
+import os
+import time
+import weakref
+from collections import deque
+from typing import Optional
+
+import numpy as np
+import torch
+from vllm.config import VllmConfig
+from vllm.sampling_params import GuidedDecodingParams, SamplingParams
+from vllm.transformers_utils.tokenizer_group import init_tokenizer_from_configs
+from vllm.v1.engine.async_llm import AsyncLLM
+from vllm.v1.engine.processor import Processor
+from vllm.v1.structured_output import StructuredOutputManager
+from vllm.v1.structured_output.backend_types import (
+    StructuredOutputBackend,
+    StructuredOutputGrammar,
+    StructuredOutputOptions,
+)
+
+from dotllm.canonicalize import (
+    canonicalize_grammar,
+    canonicalize_json_schema,
+    canonicalize_regex,
+)
+from dotllm.compilation_manager import CompilationManager
+from dotllm.config import DotConfig
+from dotllm.logits_processor import LogitsProcessor, get_logits_processor
+from dotllm.request_timings import RequestTimings
+
+
+logger = logging.getLogger("dotllm.structured_output")
+
+BACKEND_NAME = "dotvllm"
+CONFIG_ENV = "DOTVLLM_CONFIG"
+
+_vllm_validate_structured_output = Processor._validate_structured_output
+_vllm_grammar_init = StructuredOutputManager.grammar_init
+_vllm_add_request = AsyncLLM.add_request
+_vllm_shutdown = AsyncLLM.shutdown
+
+
+class DotStructuredOutputGrammar(StructuredOutputGrammar):
+    """The state of the guide of a request, as seen by the V1 scheduler.
+
+    The guide is driven by a `LogitsProcessor`, which reads the accepted
+    tokens and fills the request's row of the bitmask. Our guides can only
+    move forward, so before each token the processor is forked, and
+    `rollback` goes back to the fork. Only the last `max_rollback_tokens`
+    forks are kept; rolling back further replays the remaining tokens in a
+    new guide.
+
+    """
+
+    # Speculative decoding rolls back at most the number of draft tokens
+    max_rollback_tokens = 64
+
+    def __init__(
+        self,
+        processor: Optional[LogitsProcessor],
+        eos_token_id: Optional[int],
+    ):
+        """Initialize the DotStructuredOutputGrammar.
+
+        Args:
+            processor: The logits processor of the request, or None if its
+                index failed to compile or its guide failed, in which case
+                only the EOS token is allowed.
+            eos_token_id: The id of the EOS token, which terminates the guide
+                without being read by it.
+        """
+        self.processor = processor
+        self.eos_token_id = eos_token_id
+        self.token_ids: list[int] = []
+        # The processors before each of the last accepted tokens
+        self._states: deque[LogitsProcessor] = deque(maxlen=self.max_rollback_tokens)
+        self._terminated = False
+
+    def allowed_tokens(self):
+        """Return the tokens allowed after the accepted tokens."""
+        if self.processor is None:
+            return [self.eos_token_id]
+        return self.processor.allowed_tokens(self.token_ids)
+
+    def accept_tokens(self, request_id: str, tokens: list[int]) -> bool:
+        """Advance the guide with the tokens sampled for the request.
+
+        Args:
+            request_id: The id of the request.
+            tokens: The sampled tokens.
+
+        Returns:
+            False if one of the tokens is not allowed. The tokens before it
+            are accepted.
+        """
+        timings = self.processor.timings if self.processor is not None else None
+        if timings is not None and timings.request_id is None and request_id:
+            timings.request_id = request_id
+        for token in tokens:
+            if not self._accept_token(token):
+                logger.warning(f"Token {token} rejected for request {request_id}")
+                return False
+        return True
+
+    def _accept_token(self, token: int) -> bool:
+        """Advance the guide with one token, or return False if it is not allowed.
+
+        The guide rejects a disallowed token when it reads it, so only the EOS
+        token, which the guide does not read, is looked up in the allowed
+        tokens.
+        """
+        if self._terminated:
+            return False
+        if token == self.eos_token_id:
+            try:
+                allowed_tokens = self.allowed_tokens()
+            except Exception as e:
+                self._fail(e)
+                allowed_tokens = self.allowed_tokens()
+            self._terminated = bool(np.any(np.asarray(allowed_tokens) == token))
+            return self._terminated
+        if self.processor is None:
+            return False
+
+        state = self.processor.clone()
+        self.token_ids.append(token)
+        try:
+            self.processor.allowed_tokens(self.token_ids)
+        except ValueError:
+            self.token_ids.pop()
+            self.processor = state
+            return False
+        except Exception as e:
+            # An exception would take down the engine core, and all the
+            # requests with it, so only this request's guide is given up
+            self.token_ids.pop()
+            self._fail(e)
+            return False
+        self._states.append(state)
+        return True
+
+    def _fail(self, error: Exception) -> None:
+        """Give up the guide after an unexpected error, and only allow EOS."""
+        logger.error(f"Guide failed, only allowing EOS: {error!r}")
+        self.processor = None
+        self._states.clear()
+
+    def validate_tokens(self, tokens: list[int]) -> list[int]:
+        """Return the longest prefix of `tokens` allowed, without accepting it."""
+        accepted = []
+        for token in tokens:
+            if not self.accept_tokens("", [token]):
+                break
+            accepted.append(token)
+        self.rollback(len(accepted))
+        return accepted
+
+    def rollback(self, num_tokens: int) -> None:
+        """Forget the last `num_tokens` accepted tokens."""
+        if num_tokens <= 0:
+            return
+        if self._terminated:
+            self._terminated = False
+            num_tokens -= 1
+        num_tokens = min(num_tokens, len(self.token_ids))
+        if num_tokens == 0:
+            return
+        del self.token_ids[-num_tokens:]
+        if self.processor is None:
+            return
+        if num_tokens <= len(self._states):
+            for _ in range(num_tokens - 1):
+                self._states.pop()
+            self.processor = self._states.pop()
+        else:
+            self._states.clear()
+            self.processor.reset()
+
+    def fill_bitmask(self, bitmask: torch.Tensor, batch_index: int) -> None:
+        """Overwrite row `batch_index` of the bitmask with the allowed tokens.
+
+        Args:
+            bitmask: A bitmask allocated by
+                `DotStructuredOutputBackend.allocate_token_bitmask`.
+            batch_index: The row of the request in the batch.
+        """
+        bitmask_row = bitmask[batch_index].numpy().view(np.uint32)
+        bitmask_row.fill(0)
+        if self.processor is not None:
+            try:
+                self.processor.fill_bitmask(self.token_ids, bitmask_row)
+                return
+            except Exception as e:
+                bitmask_row.fill(0)
+                self._fail(e)
+        bitmask_row[self.eos_token_id >> 5] = np.uint32(1) << (self.eos_token_id & 31)
+
+    def is_terminated(self) -> bool:
+        return self._terminated
+
+    def reset(self):
+        self.rollback(len(self.token_ids) + int(self._terminated))
+
+
+class DotStructuredOutputBackend(StructuredOutputBackend):
+    """Compile the guides of the V1 engine with the `CompilationManager`."""
+
+    def __init__(self, vllm_config: VllmConfig):
+        """Initialize the backend and start the compilation workers.
+
+        The backend is created by the engine core process when the first
+        guided request arrives. Its configuration is read from the
+        `DOTVLLM_CONFIG` environment variable.
+
+        Args:
+            vllm_config: The configuration of the engine.
+        """
+        self.vllm_config = vllm_config
+        tokenizer_group = init_tokenizer_from_configs(
+            model_config=vllm_config.model_config,
+            scheduler_config=vllm_config.scheduler_config,
+            parallel_config=vllm_config.parallel_config,
+            lora_config=vllm_config.lora_config,
+        )
+        tokenizer_group.ping()
+        self.tokenizer = tokenizer_group.get_lora_tokenizer(None)
+        self.vocab_size = vllm_config.model_config.get_vocab_size()
+
+        self.dot_config = load_config()
+        self.compilation_manager = CompilationManager(
+            self.dot_config, self.tokenizer.name_or_path
+        )
+        self.compilation_manager.warmup()
+
+    def compile_grammar(
+        self, request_type: StructuredOutputOptions, grammar_spec: str
+    ) -> StructuredOutputGrammar:
+        """Compile the index of a request and build its guide.
+
+        This runs in the thread pool of vLLM's `StructuredOutputManager`, and
+        the request is only scheduled once it returns, so we wait for the
+        compilation here.
+
+        Args:
+            request_type: The kind of structure definition.
+            grammar_spec: The structure definition.
+
+        Returns:
+            The grammar of the request. If the compilation failed, the grammar
+            only allows the EOS token. This is a last resort: the frontend
+            already compiled the index, see `add_request`, and rejected the
+            request if it failed.
+        """
+        timings = RequestTimings() if self.dot_config.request_timings else None
+        processor = get_logits_processor(
+            guided_decoding_params(request_type, grammar_spec),
+            self.tokenizer,
+            self.compilation_manager,
+            timings=timings,
+        )
+        start = time.perf_counter()
+        try:
+            self.compilation_manager.get_index(processor.compilation_key)
+            if timings is not None:
+                timings.compile_wait = time.perf_counter() - start
+            processor.allowed_tokens([])
+        except Exception as e:
+            self.compilation_manager.release(processor.compilation_key)
+            logger.error(f"Guide compilation failed, only allowing EOS: {e}")
+            return DotStructuredOutputGrammar(None, self.tokenizer.eos_token_id)
+
+        grammar = DotStructuredOutputGrammar(processor, self.tokenizer.eos_token_id)
+        # vLLM does not tell the backend when a request finishes, so the index
+        # is unpinned, and the timings logged, when the grammar is collected.
+        weakref.finalize(grammar, self._finish, processor.compilation_key, timings)
+        return grammar
+
+    def _finish(self, compilation_key: str, timings: Optional[RequestTimings]):
+        """Unpin the index of a finished request and log its timings."""
+        self.compilation_manager.release(compilation_key)
+        if timings is not None:
+            timings.finish()
+
+    def allocate_token_bitmask(self, max_num_seqs: int) -> torch.Tensor:
+        """Allocate a bitmask in which all the tokens are allowed.
+
+        It uses the layout of `dotllm.bitmask`, which is the one vLLM applies
+        on the workers.
+        """
+        return torch.full(
+            (max_num_seqs, (self.vocab_size + 31) // 32), -1, dtype=torch.int32
+        )
+
+    def destroy(self):
+        self.compilation_manager.shutdown()
+
+
+def guided_decoding_params(
+    request_type: StructuredOutputOptions, grammar_spec: str
+) -> GuidedDecodingParams:
+    """Convert the structured output key of a V1 request to guided decoding parameters.
+
+    Raises:
+        ValueError: If the kind of structure is not supported, like with V0.
+    """
+    if request_type == StructuredOutputOptions.JSON:
+        return GuidedDecodingParams(json=grammar_spec)
+    if request_type == StructuredOutputOptions.REGEX:
+        return GuidedDecodingParams(regex=grammar_spec)
+    if request_type == StructuredOutputOptions.GRAMMAR:
+        return GuidedDecodingParams(grammar=grammar_spec)
+    raise ValueError(f"Unsupported guided decoding mode {request_type.name}")
+
+
+def validate_structured_output(self: Processor, params: SamplingParams) -> None:
+    """Check the structure definition of a request and select our backend.
+
+    This replaces `Processor._validate_structured_output`, which only accepts
+    vLLM's backends.
+    """
+    guided_decoding = params.guided_decoding
+    if not guided_decoding:
+        return
+    if guided_decoding.json_object or guided_decoding.choice:
+        raise ValueError(f"Unknown guided decoding mode {guided_decoding}")
+    if guided_decoding.json:
+        canonicalize_json_schema(guided_decoding.json)
+    elif guided_decoding.regex:
+        canonicalize_regex(guided_decoding.regex)
+    elif guided_decoding.grammar:
+        canonicalize_grammar(guided_decoding.grammar)
+    guided_decoding.backend = BACKEND_NAME
+
+
+async def add_request(
+    self: AsyncLLM,
+    request_id: str,
+    prompt,
+    params,
+    arrival_time: Optional[float] = None,
+    lora_request=None,
+    *args,
+    **kwargs,
+):
+    """Compile the index of a guided request before handing it to the engine core.
+
+    This replaces `AsyncLLM.add_request`. An exception in `compile_grammar`
+    takes down the engine core, so there a definition that fails to compile
+    only gets a grammar that allows EOS, and an empty response. Compiling the
+    index here first raises the `CompilationError` for this request only,
+    which the OpenAI server returns as a 400 like with the V0 engine.
+
+    The frontend writes the index to the disk cache, where the engine core
+    usually finds it rather than compiling it again. Without a disk cache,
+    each new definition is compiled in both processes.
+    """
+    if isinstance(params, SamplingParams) and params.guided_decoding:
+        tokenizer = await self.get_tokenizer(lora_request)
+        compilation_manager = getattr(self, "dot_compilation_manager", None)
+        if compilation_manager is None:
+            compilation_manager = CompilationManager(
+                load_config(), tokenizer.name_or_path
+            )
+            self.dot_compilation_manager = compilation_manager
+        processor = get_logits_processor(
+            params.guided_decoding, tokenizer, compilation_manager
+        )
+        try:
+            await compilation_manager.get_index_async(processor.compilation_key)
+        finally:
+            compilation_manager.release(processor.compilation_key)
+
+    return await _vllm_add_request(
+        self, request_id, prompt, params, arrival_time, lora_request, *args, **kwargs
+    )
+
+
+def shutdown(self: AsyncLLM) -> None:
+    """Stop the compilation workers of the frontend with the engine."""
+    compilation_manager = getattr(self, "dot_compilation_manager", None)
+    if compilation_manager is not None:
+        compilation_manager.shutdown()
+    _vllm_shutdown(self)
+
+
+def grammar_init(self: StructuredOutputManager, request) -> None:
+    """Create our backend before vLLM's `grammar_init` picks one of its own."""
+    if request.structured_output_request is not None and self.backend is None:
+        self.backend = DotStructuredOutputBackend(self.vllm_config)
+    _vllm_grammar_init(self, request)
+
+
+def load_config() -> DotConfig:
+    """Read the configuration set by `install_structured_output_backend`."""
+    return DotConfig(**json.loads(os.environ.get(CONFIG_ENV, "{}")))
+
+
+def install_structured_output_backend(dot_config: Optional[DotConfig]) -> None:
+    """Use our guides for the guided requests of the vLLM V1 engine.
+
+    Args:
+        dot_config: The DotLLM configuration. If None, restore vLLM's
+            structured output backends.
+    """
+    if dot_config is None:
+        os.environ.pop(CONFIG_ENV, None)
+        Processor._validate_structured_output = _vllm_validate_structured_output
+        StructuredOutputManager.grammar_init = _vllm_grammar_init
+        AsyncLLM.add_request = _vllm_add_request
+        AsyncLLM.shutdown = _vllm_shutdown
+        return
+
+    os.environ[CONFIG_ENV] = json.dumps(dataclasses.asdict(dot_config))
+    Processor._validate_structured_output = validate_structured_output
+    StructuredOutputManager.grammar_init = grammar_init
+    AsyncLLM.add_request = add_request
+    AsyncLLM.shutdown = shutdown
+    logger.info("Using the DotLLM structured output backend for the V1 engine")
+
+
+def register() -> None:
+    """Entry point of the vLLM plugin, called in every vLLM process."""
+    if CONFIG_ENV in os.environ:
+        install_structured_output_backend(load_config())